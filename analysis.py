@@ -0,0 +1,202 @@
+"""Offline batch analysis with the game's rules engine.
+
+Takes a stream of FEN positions or PGN games and yields one result per
+item: legal moves, check, checkmate and stalemate for positions, and
+validity and final position for replayed games. One OnlineChessBoard is
+reused and reloaded with set_fen() for every item, and --processes splits
+the stream into chunks handled by a process pool, results kept in order.
+
+    python analysis.py fen positions.fen --processes 4 > results.jsonl
+    python analysis.py pgn games.pgn --processes 4 > results.jsonl
+    python analysis.py fen --random 100000     # throughput on random positions
+
+Throughput is reported on stderr in positions per second.
+"""
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+from bitboard import PAWN, PAWN_PROMOTION_ROW
+from online_chess_board import START_FEN, OnlineChessBoard
+from pgn import parse_san, read_pgn, square_name
+
+DEFAULT_CHUNK = 2000
+# Chunks each worker process may have queued, bounding memory on large inputs
+CHUNKS_PER_PROCESS = 2
+
+SQUARE_NAMES = [square_name(sq >> 3, sq & 7) for sq in range(64)]
+# UCI text by from_sq * 64 + to_sq, built once
+UCI_MOVES = [SQUARE_NAMES[from_sq] + SQUARE_NAMES[to_sq] for from_sq in range(64) for to_sq in range(64)]
+
+
+def move_uci(board, move):
+    """UCI text for a move on the board, e.g. e2e4, or e7e8q for a promotion"""
+    (from_row, from_col), (to_row, to_col) = move
+    return _uci(board.squares, from_row * 8 + from_col, to_row * 8 + to_col)
+
+
+def _uci(squares, from_sq, to_sq):
+    code = squares[from_sq]
+    if (code & 7) - 1 == PAWN and to_sq >> 3 == PAWN_PROMOTION_ROW[code >> 3]:
+        return UCI_MOVES[from_sq * 64 + to_sq] + 'q'
+    return UCI_MOVES[from_sq * 64 + to_sq]
+
+
+def analyze_position(board, fen):
+    """Load fen into board and describe the side to move's situation"""
+    try:
+        board.set_fen(fen)
+    except ValueError as error:
+        return {'fen': fen, 'error': str(error)}
+    color = board.turn
+    moves = board.legal_move_squares(color)
+    check = board.is_in_check(color)
+    squares = board.squares
+    return {
+        'fen': fen,
+        'side_to_move': color,
+        'legal_moves': [_uci(squares, moves[i], moves[i + 1]) for i in range(0, len(moves), 2)],
+        'check': check,
+        'checkmate': check and not moves,
+        'stalemate': not check and not moves,
+    }
+
+
+def analyze_positions(fens):
+    """analyze_position() for each FEN string, sharing one board"""
+    board = OnlineChessBoard()
+    for fen in fens:
+        fen = fen.strip()
+        if fen:
+            yield analyze_position(board, fen)
+
+
+def analyze_game(board, tags, moves, result):
+    """Replay a parsed PGN game, stopping at the first move that is not legal"""
+    summary = {'event': tags.get('Event'), 'white': tags.get('White'), 'black': tags.get('Black'),
+               'result': result, 'plies': 0, 'valid': True}
+    try:
+        board.set_fen(tags.get('FEN', START_FEN))
+    except ValueError as error:
+        return dict(summary, valid=False, error=str(error))
+    for ply, san in enumerate(moves):
+        move = parse_san(board, san)
+        if move is None:
+            return dict(summary, plies=ply, valid=False, error=f'illegal or ambiguous move {san!r} at ply {ply + 1}',
+                        final_fen=board.to_fen())
+        board.push(move)
+    color = board.turn
+    check = board.is_in_check(color)
+    no_moves = not board.get_all_valid_moves(color)
+    return dict(summary, plies=len(moves), final_fen=board.to_fen(),
+                checkmate=check and no_moves, stalemate=not check and no_moves)
+
+
+def analyze_games(games):
+    """analyze_game() for each (tags, moves, result) from pgn.read_pgn(), sharing one board"""
+    board = OnlineChessBoard()
+    for tags, moves, result in games:
+        yield analyze_game(board, tags, moves, result)
+
+
+def _fen_chunk(fens):
+    return list(analyze_positions(fens))
+
+
+def _game_chunk(games):
+    return list(analyze_games(games))
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _pooled(function, items, processes, chunk_size):
+    # Pool.imap reads its whole input ahead of the workers; keep at most
+    # CHUNKS_PER_PROCESS chunks per worker queued or done but not yet yielded
+    window = processes * CHUNKS_PER_PROCESS
+    pending = collections.deque()
+    with multiprocessing.Pool(processes) as pool:
+        for chunk in _chunks(items, chunk_size):
+            if len(pending) >= window:
+                yield from pending.popleft().get()
+            pending.append(pool.apply_async(function, (chunk,)))
+        while pending:
+            yield from pending.popleft().get()
+
+
+def analyze_fens(fens, processes=1, chunk_size=DEFAULT_CHUNK):
+    """Results for a stream of FEN strings, in order, using processes worker processes"""
+    if processes == 1:
+        return analyze_positions(fens)
+    return _pooled(_fen_chunk, fens, processes, chunk_size)
+
+
+def analyze_pgn(lines, processes=1, chunk_size=DEFAULT_CHUNK // 20):
+    """Results for the games in a stream of PGN lines, in order"""
+    games = read_pgn(lines)
+    if processes == 1:
+        return analyze_games(games)
+    return _pooled(_game_chunk, games, processes, chunk_size)
+
+
+def random_fens(count, seed=0, max_plies=80):
+    """FENs of positions reached by random play, for benchmarking"""
+    rng = random.Random(seed)
+    fens = []
+    while len(fens) < count:
+        board = OnlineChessBoard()
+        for _ in range(rng.randrange(max_plies)):
+            moves = board.get_all_valid_moves(board.turn)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+            fens.append(board.to_fen())
+    return fens[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('mode', choices=('fen', 'pgn'))
+    parser.add_argument('path', nargs='?', help='input file, one FEN per line or PGN (default: stdin)')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes (0: one per core)')
+    parser.add_argument('--chunk-size', type=int, default=None)
+    parser.add_argument('--random', type=int, metavar='N', help='analyze N random positions instead of a file')
+    parser.add_argument('--quiet', action='store_true', help='only report throughput')
+    args = parser.parse_args(argv)
+    processes = args.processes or multiprocessing.cpu_count()
+
+    if args.random:
+        source = random_fens(args.random)
+    else:
+        source = open(args.path) if args.path else sys.stdin
+    options = {'chunk_size': args.chunk_size} if args.chunk_size else {}
+    analyze = analyze_fens if args.mode == 'fen' else analyze_pgn
+    start = time.perf_counter()
+    items = positions = errors = 0
+    for result in analyze(source, processes, **options):
+        items += 1
+        # A replayed game visits its starting position and one per move
+        positions += 1 + result.get('plies', 0)
+        errors += 'error' in result
+        if not args.quiet:
+            sys.stdout.write(json.dumps(result, separators=(',', ':')) + '\n')
+    seconds = time.perf_counter() - start
+    unit = 'positions' if args.mode == 'fen' else 'games'
+    print(f'{items} {unit}, {errors} with errors, {seconds:.2f} s, '
+          f'{positions / seconds:,.0f} positions/s with {processes} process(es)', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
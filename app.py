@@ -1,21 +1,419 @@
-from flask import Flask, render_template, request, redirect, url_for
+# Patch the standard library before anything imports it, so the threading
+# locks, sockets and sleeps used by the game registry, game store and
+# schedulers yield to other green threads instead of blocking the hub
+try:
+    import eventlet
+    eventlet.monkey_patch()
+except ImportError:
+    pass
+
+from flask import Flask, Response, jsonify, render_template, request, redirect, url_for
 from flask_socketio import SocketIO, emit, join_room, leave_room
+import hmac
+import math
+import os
+import signal
+import sys
+import traceback
 import uuid
-import random
-import string
 from online_chess_board import OnlineChessBoard  # Your provided file
 import time
-import threading
+import wire_json
+from deadline_scheduler import DeadlineScheduler
+from engine import (BOT_DIFFICULTIES, BOT_PLAYER_IDS, DEFAULT_DIFFICULTY, DIFFICULTIES, ENGINE_PROCESSES, EnginePool,
+                    move_deadline)
+from game_clock import GameClock, monotonic_ms
+from game_eviction import ARCHIVE_DIR, DirectoryArchive, GameEvictor, process_memory
+from game_registry import GameRegistry, ShardedDict
+from game_routing import generate_game_code, owner_url
+from game_store import open_game_store
+from metrics import BYTE_BUCKETS, CONTENT_TYPE, MetricsRegistry, sampler, timed
+from move_cache import valid_moves_cache
+from move_journal import JOURNAL_DIR, MoveJournal
+from pgn import PGN_ARCHIVE_DIR, PgnArchive, game_pgn
+from profiler import SamplingProfiler
+from registry_snapshot import SNAPSHOT_INTERVAL, SNAPSHOT_PATH, Snapshotter
+from wire_json import RawJSON
 
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# With several app.py workers, SOCKETIO_MESSAGE_QUEUE (e.g. redis://host:6379)
+# fans room broadcasts out to clients connected to any worker. Flask-SocketIO
+# talks to the queue through the redis package, listed in requirements.txt.
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+socketio = SocketIO(app, cors_allowed_origins="*", json=wire_json, message_queue=SOCKETIO_MESSAGE_QUEUE)
+
+# Games by code and player sessions by Socket.IO sid. Change a game only
+# while holding its lock: with games.locked(game_code) as game: ...
+# GAME_STORE_URL moves games out of this process so workers can share them;
+# sids belong to one worker's connections and always stay local.
+games = open_game_store()
+players = ShardedDict()
+
+# Send the side to move's legal moves with each state update so clients can
+# highlight moves without a get_valid_moves round trip
+INCLUDE_LEGAL_MOVES = os.environ.get('INCLUDE_LEGAL_MOVES', '1') != '0'
+
+# Longest game time or per-move increment or delay a client can ask for, in seconds
+MAX_CLOCK_SECONDS = 24 * 3600
+
+# Board encodings a client can ask for. 'json' is the 64-cell list of dicts
+# older clients expect; 'packed' sends the board as a 32-byte binary
+# attachment and legal moves as (from_square, to_square) byte pairs.
+WIRE_FORMATS = ('json', 'packed')
+
+# Handler and board call latency, payload sizes and timer lag, served on
+# /metrics. One in METRICS_PAYLOAD_SAMPLE state payloads is encoded a second
+# time to measure its size (0 turns that off).
+METRICS_PAYLOAD_SAMPLE = int(os.environ.get('METRICS_PAYLOAD_SAMPLE', 16))
+metrics = MetricsRegistry()
+handler_seconds = metrics.histogram('chess_handler_seconds', 'Socket.IO handler latency by event', ('event',))
+handler_errors = metrics.counter('chess_handler_errors_total', 'Socket.IO handlers that raised, by event', ('event',))
+board_seconds = metrics.histogram('chess_board_call_seconds', 'OnlineChessBoard calls made by handlers', ('method',))
+payload_bytes = metrics.histogram('chess_payload_bytes', 'Encoded size of sampled state payloads',
+                                  ('event', 'wire_format'), buckets=BYTE_BUCKETS)
+flag_timer_lag = metrics.histogram('chess_flag_timer_lag_seconds', 'How long after its deadline a flag-fall timeout ran')
+sample_payload = sampler(METRICS_PAYLOAD_SAMPLE)
+
+# Traces PROFILE_PERCENT% of make_move and get_valid_moves calls into folded
+# stacks for flame graphs. An admin_profile event carrying ADMIN_TOKEN changes
+# the percentage or dumps what was collected; without ADMIN_TOKEN it is refused.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+profiler = SamplingProfiler()
+
+# Games against the computer: create_game with opponent 'computer' adds a bot
+# player whose moves are searched in ENGINE_PROCESSES worker processes by a
+# background task per move
+engine_pool = EnginePool() if ENGINE_PROCESSES > 0 else None
+# Game code -> zobrist key of the position being searched, one search per game
+engine_searches = ShardedDict()
+engine_seconds = metrics.histogram('chess_engine_move_seconds', 'Time from requesting a computer move to playing it',
+                                   ('difficulty',))
+
+
+def seconds_option(data, key):
+    """A number of seconds from event data, 0 when missing or invalid, at most MAX_CLOCK_SECONDS"""
+    try:
+        seconds = float(data[key])
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return 0.0
+    if not math.isfinite(seconds):
+        return 0.0
+    return min(max(0.0, seconds), MAX_CLOCK_SECONDS)
+
+
+def legal_moves_payload(game):
+    """Legal moves for the side to move as [from_row, from_col, to_row, to_col] lists"""
+    if not INCLUDE_LEGAL_MOVES or game['game_over']:
+        return None
+    with board_seconds.time(('get_all_valid_moves',)):
+        moves = game['board'].get_all_valid_moves(game['current_player'])
+    return [[from_row, from_col, to_row, to_col] for (from_row, from_col), (to_row, to_col) in moves]
+
+
+def game_snapshot(game):
+    """Full board and game fields shared by every state broadcast"""
+    with board_seconds.time(('get_board_state',)):
+        board_state = game['board'].get_board_state()
+    return {
+        'board_state': board_state['board'],
+        'white_king': board_state['white_king'],
+        'black_king': board_state['black_king'],
+        'white_in_check': board_state['white_in_check'],
+        'black_in_check': board_state['black_in_check'],
+        'current_player': game['current_player'],
+        'game_over': game['game_over'],
+        'winner': game['winner'],
+        'timer': game['timer'],
+        'increment': game['clock'].increment_ms / 1000,
+        'delay': game['clock'].delay_ms / 1000,
+        'remaining_time': game['clock'].remaining_seconds(),
+        'remaining_ms': game['clock'].remaining_ms(),
+        'captured': {
+            'white': list(board_state['captured']['white']),
+            'black': list(board_state['captured']['black'])
+        },
+        'material_diff': board_state['material_diff'],
+        'legal_moves': legal_moves_payload(game) if game['game_started'] else None
+    }
+
+
+def schedule_flag_fall(game_code, game):
+    """Arm the timeout for the running clock, or disarm it once the clock is stopped"""
+    deadline = game['clock'].deadline()
+    if game['game_over'] or deadline is None:
+        flag_scheduler.cancel(game_code)
+    else:
+        flag_scheduler.schedule(game_code, deadline)
+
+
+def handle_flag_fall(game_code):
+    """End the game when the side to move runs out of time"""
+    with games.locked(game_code) as game:
+        if game is None or not game['game_started'] or game['game_over']:
+            return
+        clock = game['clock']
+        turn = game['current_player']
+        if clock.running != turn:
+            return
+        if not clock.expired(turn):
+            # Woke early; wait for the real deadline
+            schedule_flag_fall(game_code, game)
+            return
+        clock.flag()
+        game['game_over'] = True
+        game['winner'] = 'black' if turn == 'white' else 'white'
+        record_result(game_code, game)
+        evictor.track(game_code, game)
+        emit_delta('move_made', game_code, game)
+
+
+# One pending timeout per running game, replacing a loop over every game each second
+flag_scheduler = DeadlineScheduler(socketio, handle_flag_fall, on_late=flag_timer_lag.observe)
+
+
+def forget_game(game_code):
+    """Drop an evicted game's timeout and record the eviction in the journal"""
+    flag_scheduler.cancel(game_code)
+    if journal is not None:
+        journal.log_drop(game_code)
+
+
+# Drops games idle past the TTL for their phase, and the oldest beyond MAX_GAMES
+evictor = GameEvictor(socketio, games,
+                      archive=DirectoryArchive(ARCHIVE_DIR) if ARCHIVE_DIR else None,
+                      on_evict=forget_game)
+
+
+def touch(game_code, game):
+    """Record activity on a game and re-index it for eviction. Call with the game's lock held"""
+    game['last_activity'] = time.time()
+    evictor.track(game_code, game)
+
+
+def record_result(game_code, game):
+    """Journal a finished game's result and add it to the PGN archive"""
+    if journal is not None:
+        journal.log_end(game_code, game)
+    if pgn_archive is not None:
+        pgn_archive.append(game_code, game)
+
+
+def restore_game(game_code, game):
+    """Re-arm timers for a game loaded from the snapshot on first use"""
+    # Its first use after the restart counts as activity
+    touch(game_code, game)
+    schedule_flag_fall(game_code, game)
+    request_engine_move(game_code, game)
+
+
+def journal_game(game_code, game_players):
+    """A game started after the last snapshot, rebuilt from the journal; replay sets its clock"""
+    return {
+        'board': OnlineChessBoard(),
+        'players': game_players,
+        'current_player': 'white',
+        'game_started': False,
+        'game_over': False,
+        'winner': None,
+        'last_activity': time.time(),
+        'timer': 300,
+        'clock': GameClock(300 * 1000),
+        'seq': 0,
+        'last_state': None
+    }
+
+
+# JOURNAL_DIR records every start, move, result and reset as it happens, so
+# a crash loses at most the last commit window. SNAPSHOT_PATH keeps games
+# across restarts: they are restored lazily from a memory-mapped snapshot
+# written every SNAPSHOT_INTERVAL seconds, and the journal is replayed on top.
+# Only a snapshot lets journal segments be deleted, so with a journal and no
+# SNAPSHOT_PATH the snapshot is kept in JOURNAL_DIR.
+journal = None
+snapshotter = None
+# PGN_ARCHIVE_DIR collects every finished game as PGN, in rotating files
+pgn_archive = PgnArchive(PGN_ARCHIVE_DIR) if PGN_ARCHIVE_DIR else None
+if isinstance(games, GameRegistry):
+    snapshot_path = SNAPSHOT_PATH
+    if JOURNAL_DIR:
+        journal = MoveJournal(socketio, JOURNAL_DIR)
+        snapshot_path = snapshot_path or os.path.join(JOURNAL_DIR, 'games.snapshot')
+    if snapshot_path:
+        snapshotter = Snapshotter(socketio, games, snapshot_path, SNAPSHOT_INTERVAL,
+                                  ttls=evictor.ttls, on_load=restore_game, journal=journal)
+
+# Values the server already tracks, read when /metrics is scraped. Counting a
+# shared store would mean scanning it, so only local games are reported.
+metrics.gauge('chess_games', 'Games held in this worker',
+              lambda: len(games) if isinstance(games, GameRegistry) else None)
+metrics.gauge('chess_connected_sids', 'Socket.IO sessions with a player', lambda: len(players))
+metrics.gauge('chess_flag_timers', 'Running clocks with a pending flag-fall timeout', lambda: len(flag_scheduler))
+metrics.gauge('chess_resident_memory_bytes', 'Resident set size of this worker',
+              lambda: process_memory().get('rss_bytes'))
+metrics.gauge('chess_evicted_games_total', 'Games evicted, by reason',
+              lambda: {(reason,): count for reason, count in evictor.evicted.items()}, ('reason',), kind='counter')
+metrics.gauge('chess_valid_moves_cache_hits_total', 'Move cache hits', lambda: valid_moves_cache.hits, kind='counter')
+metrics.gauge('chess_valid_moves_cache_misses_total', 'Move cache misses', lambda: valid_moves_cache.misses,
+              kind='counter')
+metrics.gauge('chess_journal_records_total', 'Records appended to the move journal',
+              lambda: journal.records if journal is not None else None, kind='counter')
+metrics.gauge('chess_journal_commits_total', 'Group commits (fsyncs) of the move journal',
+              lambda: journal.commits if journal is not None else None, kind='counter')
+
 
-games = {}
-players = {}
+def requested_difficulty(data):
+    """The engine difficulty for a game against the computer, or None for a game between players"""
+    if engine_pool is None or not data or data.get('opponent') != 'computer':
+        return None
+    difficulty = data.get('difficulty')
+    return difficulty if difficulty in DIFFICULTIES else DEFAULT_DIFFICULTY
 
 
-def generate_game_code():
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+def request_engine_move(game_code, game):
+    """Start a search if the computer is to move. Call with the game's lock held"""
+    if engine_pool is None or not game['game_started'] or game['game_over']:
+        return
+    for player_id, player in game['players'].items():
+        if player_id in BOT_DIFFICULTIES and player['color'] == game['current_player']:
+            break
+    else:
+        return
+    key = game['board'].zobrist_key
+    if engine_searches.get(game_code) == key:
+        return
+    engine_searches[game_code] = key
+    color = game['current_player']
+    clock = game['clock']
+    difficulty = BOT_DIFFICULTIES[player_id]
+    # Thinking time counts from now, whatever the wait for a free worker
+    deadline = move_deadline(difficulty, clock.remaining_ms()[color], clock.increment_ms, clock.delay_ms)
+    socketio.start_background_task(play_engine_move, game_code, key, color, difficulty,
+                                   game['board'].to_bytes(), deadline)
+
+
+def play_engine_move(game_code, key, color, difficulty, board_bytes, deadline):
+    """Search in a worker, waiting without blocking the event loop, then play the move"""
+    start = time.perf_counter()
+    try:
+        move = engine_pool.search(board_bytes, difficulty, deadline)['move']
+    except Exception:
+        traceback.print_exc()
+        move = None
+    try:
+        with games.locked(game_code) as game:
+            # The game may have been reset, finished or left meanwhile
+            if (game is None or move is None or game['game_over'] or game['current_player'] != color
+                    or game['board'].zobrist_key != key):
+                return
+            (from_row, from_col), (to_row, to_col) = move
+            play_move(game_code, game, color, [from_row, from_col], [to_row, to_col])
+    finally:
+        # Whatever happened, a later request for this position may search again
+        if engine_searches.get(game_code) == key:
+            engine_searches.pop(game_code)
+    engine_seconds.observe(time.perf_counter() - start, (difficulty,))
+
+
+def emit_snapshot(event, game_code, game):
+    """Broadcast the full state to the room and start a new delta sequence from it"""
+    state = game_snapshot(game)
+    game['seq'] += 1
+    game['last_state'] = state
+    broadcast_state(event, game_code, game, dict(state, seq=game['seq']))
+
+
+def emit_delta(event, game_code, game):
+    """Broadcast only the squares and fields that changed since the last broadcast.
+    
+    Each update carries a sequence number; a client that sees a gap asks for
+    a full snapshot with get_game_state.
+    """
+    previous = game['last_state']
+    if previous is None:
+        emit_snapshot(event, game_code, game)
+        return
+    state = game_snapshot(game)
+    squares = []
+    for row in range(8):
+        for col in range(8):
+            cell = state['board_state'][row][col]
+            if cell != previous['board_state'][row][col]:
+                squares.append([row, col, cell['piece_type'], cell['color']])
+    delta = {key: value for key, value in state.items()
+             if key != 'board_state' and previous[key] != value}
+    game['seq'] += 1
+    game['last_state'] = state
+    broadcast_state(event, game_code, game, dict(delta, seq=game['seq'], delta=True, squares=squares))
+
+
+def state_room(game_code, wire_format):
+    """Room holding the clients of a game that use the given wire format"""
+    return f'{game_code}:{wire_format}'
+
+
+def join_game_rooms(game_code, wire_format):
+    """Join the game room and the state room for this client's wire format"""
+    join_room(game_code)
+    for other in WIRE_FORMATS:
+        if other != wire_format:
+            leave_room(state_room(game_code, other))
+    join_room(state_room(game_code, wire_format))
+
+
+def requested_wire_format(data):
+    wire_format = data.get('wire_format') if data else None
+    return wire_format if wire_format in WIRE_FORMATS else 'json'
+
+
+def packed_payload(game, payload):
+    """Replace the JSON board and legal moves of a state payload with packed bytes.
+    
+    Packed clients always get the whole 32-byte board, which is smaller
+    than a squares delta, so they apply it directly.
+    """
+    packed = {key: value for key, value in payload.items()
+              if key not in ('board_state', 'squares', 'legal_moves')}
+    packed['board_packed'] = game['board'].to_packed()
+    if 'legal_moves' in payload:
+        moves = payload['legal_moves']
+        packed['legal_moves_packed'] = None if moves is None else bytes(
+            value for from_row, from_col, to_row, to_col in moves
+            for value in (from_row * 8 + from_col, to_row * 8 + to_col))
+    return packed
+
+
+def json_payload(game, payload):
+    """Splice the board's cached JSON into a full state payload instead of re-encoding it"""
+    if 'board_state' in payload:
+        payload = dict(payload, board_state=RawJSON(game['board'].get_board_json()))
+    return payload
+
+
+def room_has_members(room):
+    """Whether a room may have clients; with a message queue those of other workers can't be seen"""
+    if SOCKETIO_MESSAGE_QUEUE:
+        return True
+    return next(socketio.server.manager.get_participants('/', room), None) is not None
+
+
+def broadcast_state(event, game_code, game, payload):
+    """Send a state payload to a game's clients, encoded the way each asked for.
+
+    Only the encodings some client of the game uses are built and sent.
+    """
+    sampled = sample_payload()
+    for wire_format, encode in (('json', json_payload), ('packed', packed_payload)):
+        room = state_room(game_code, wire_format)
+        if not room_has_members(room):
+            continue
+        state = encode(game, payload)
+        socketio.emit(event, state, room=room)
+        if sampled:
+            observe_payload(event, wire_format, state)
+
+
+def observe_payload(event, wire_format, payload):
+    payload_bytes.observe(wire_json.encoded_size([event, payload]), (event, wire_format))
 
 
 @app.route('/')
@@ -23,6 +421,43 @@ def index():
     return render_template('index.html')
 
 
+@app.route('/stats')
+def stats():
+    """Eviction, memory, move cache, snapshot, journal, archive and engine counters for this worker"""
+    return jsonify({
+        'eviction': evictor.stats(),
+        'valid_moves_cache': valid_moves_cache.stats(),
+        'snapshot': snapshotter.stats() if snapshotter is not None else None,
+        'journal': journal.stats() if journal is not None else None,
+        'pgn_archived': pgn_archive.archived if pgn_archive is not None else None,
+        'engine': engine_pool.stats() if engine_pool is not None else None,
+    })
+
+
+@app.route('/metrics')
+def metrics_export():
+    """Handler, board call, payload and timer metrics in the Prometheus text format"""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+@app.route('/game/<game_code>/pgn')
+def game_pgn_export(game_code):
+    """One game's moves so far as PGN"""
+    with games.locked(game_code.upper()) as game:
+        if game is None:
+            return Response('Game not found\n', status=404, mimetype='text/plain')
+        pgn = game_pgn(game_code.upper(), game, site=request.host)
+    return Response(pgn, mimetype='application/x-chess-pgn')
+
+
+@app.route('/archive.pgn')
+def pgn_archive_export():
+    """Every archived game, streamed file by file"""
+    if pgn_archive is None:
+        return Response('No PGN archive is configured\n', status=404, mimetype='text/plain')
+    return Response(pgn_archive.stream(), mimetype='application/x-chess-pgn')
+
+
 @app.route('/game/<game_code>')
 def game(game_code):
     game_code = game_code.upper()
@@ -30,6 +465,10 @@ def game(game_code):
     # print(f"DEBUG: Active games: {list(games.keys())}")
     
     if game_code not in games:
+        # The code names its worker; send the browser there if that is another one
+        url = owner_url(game_code)
+        if url:
+            return redirect(f'{url}/game/{game_code}')
         # print(f"DEBUG: Game {game_code} not found, redirecting to home")
         return redirect(url_for('index'))
     
@@ -37,122 +476,146 @@ def game(game_code):
 
 
 @socketio.on('create_game')
+@timed(handler_seconds, 'create_game', handler_errors)
 def handle_create_game(data=None):
-    timer = 300  # default 5 min
-    if data and 'timer' in data:
-        try:
-            timer = int(data['timer'])
-        except Exception:
-            timer = 300
-    game_code = generate_game_code()
-    while game_code in games:
-        game_code = generate_game_code()
-    
-    games[game_code] = {
+    # Whole seconds, at least 1; missing, invalid, zero or negative gets the default 5 min
+    seconds = seconds_option(data, 'timer')
+    timer = max(1, int(seconds)) if seconds > 0 else 300
+    # Optional Fischer increment and Bronstein delay, in seconds per move
+    increment = seconds_option(data, 'increment')
+    delay = seconds_option(data, 'delay')
+    
+    # Against the computer the creator may take black; the bot is always ready
+    difficulty = requested_difficulty(data)
+    color = 'black' if difficulty and data.get('color') == 'black' else 'white'
+    
+    player_id = str(uuid.uuid4())
+    game_players = {
+        player_id: {
+            'sid': request.sid,
+            'color': color,
+            'ready': False,
+            'last_seen': time.time()
+        }
+    }
+    if difficulty:
+        game_players[BOT_PLAYER_IDS[difficulty]] = {
+            'sid': None,
+            'color': 'white' if color == 'black' else 'black',
+            'ready': True,
+            'last_seen': time.time()
+        }
+    game = {
         'board': OnlineChessBoard(),
-        'players': {},
+        'players': game_players,
         'current_player': 'white',
         'game_started': False,
         'game_over': False,
         'winner': None,
         'last_activity': time.time(),
         'timer': timer,
-        'remaining_time': {
-            'white': timer,
-            'black': timer
-        },
-        'last_move_time': None
+        'clock': GameClock(timer * 1000, increment_ms=int(increment * 1000), delay_ms=int(delay * 1000)),
+        'seq': 0,
+        'last_state': None
     }
+    game_code = games.create(generate_game_code, game)
+    evictor.track(game_code, game)
+    evictor.enforce_cap()
     
-    player_id = str(uuid.uuid4())
+    wire_format = requested_wire_format(data)
     players[request.sid] = {
         'game_code': game_code,
         'player_id': player_id,
-        'color': 'white'
-    }
-    
-    games[game_code]['players'][player_id] = {
-        'sid': request.sid,
-        'color': 'white',
-        'ready': False,
-        'last_seen': time.time()
+        'color': color,
+        'wire_format': wire_format
     }
     
-    join_room(game_code)
+    join_game_rooms(game_code, wire_format)
     
     # print(f"DEBUG: Game created with code: {game_code}, timer: {timer}")
     
     emit('game_created', {
         'game_code': game_code,
-        'player_color': 'white',
-        'player_id': player_id
+        'player_color': color,
+        'player_id': player_id,
+        'opponent': 'computer' if difficulty else None,
+        'difficulty': difficulty
     })
 
 
 @socketio.on('join_game')
+@timed(handler_seconds, 'join_game', handler_errors)
 def handle_join_game(data):
     game_code = data['game_code'].upper()
     
-    if game_code not in games:
-        emit('error', {'message': 'Game not found'})
-        return
-    
-    game = games[game_code]
-    
-    player_id = data.get('player_id')
-    if player_id and player_id in game['players']:
-        color = game['players'][player_id]['color']
-        game['players'][player_id]['sid'] = request.sid
-        game['players'][player_id]['last_seen'] = time.time()
-        players[request.sid] = {
-            'game_code': game_code,
-            'player_id': player_id,
-            'color': color
-        }
-        # print(f"DEBUG: Player {player_id} rejoined as {color}")
-    else:
-        if len(game['players']) >= 2:
-            emit('error', {'message': 'Game is full'})
+    with games.locked(game_code) as game:
+        if game is None:
+            url = owner_url(game_code)
+            if url:
+                emit('redirect', {'url': f'{url}/game/{game_code}'})
+            else:
+                emit('error', {'message': 'Game not found'})
             return
-        
-        player_id = str(uuid.uuid4())
-        color = 'black' if len(game['players']) == 1 else 'white'
-        
-        game['players'][player_id] = {
-            'sid': request.sid,
-            'color': color,
-            'ready': False,
-            'last_seen': time.time()
-        }
-        players[request.sid] = {
-            'game_code': game_code,
-            'player_id': player_id,
-            'color': color
-        }
-        # print(f"DEBUG: New player {player_id} joined as {color}")
-    
-    join_room(game_code)
-    game['last_activity'] = time.time()
     
-    emit('game_joined', {
-        'game_code': game_code,
-        'player_color': color,
-        'player_id': player_id
-    })
-    
-    socketio.emit('player_joined', {
-        'players_count': len(game['players']),
-        'can_start': len(game['players']) == 2
-    }, room=game_code)
+        wire_format = requested_wire_format(data)
+    
+        player_id = data.get('player_id')
+        if player_id and player_id in game['players'] and player_id not in BOT_DIFFICULTIES:
+            color = game['players'][player_id]['color']
+            game['players'][player_id]['sid'] = request.sid
+            game['players'][player_id]['last_seen'] = time.time()
+            players[request.sid] = {
+                'game_code': game_code,
+                'player_id': player_id,
+                'color': color,
+                'wire_format': wire_format
+            }
+            # print(f"DEBUG: Player {player_id} rejoined as {color}")
+        else:
+            if len(game['players']) >= 2:
+                emit('error', {'message': 'Game is full'})
+                return
+    
+            player_id = str(uuid.uuid4())
+            color = 'black' if len(game['players']) == 1 else 'white'
+    
+            game['players'][player_id] = {
+                'sid': request.sid,
+                'color': color,
+                'ready': False,
+                'last_seen': time.time()
+            }
+            players[request.sid] = {
+                'game_code': game_code,
+                'player_id': player_id,
+                'color': color,
+                'wire_format': wire_format
+            }
+            # print(f"DEBUG: New player {player_id} joined as {color}")
+    
+        join_game_rooms(game_code, wire_format)
+        touch(game_code, game)
+    
+        emit('game_joined', {
+            'game_code': game_code,
+            'player_color': color,
+            'player_id': player_id
+        })
     
-    if len(game['players']) == 2:
-        socketio.emit('both_players_connected', {
+        socketio.emit('player_joined', {
             'players_count': len(game['players']),
-            'can_start': True
+            'can_start': len(game['players']) == 2
         }, room=game_code)
+    
+        if len(game['players']) == 2:
+            socketio.emit('both_players_connected', {
+                'players_count': len(game['players']),
+                'can_start': True
+            }, room=game_code)
 
 
 @socketio.on('get_game_state')
+@timed(handler_seconds, 'get_game_state', handler_errors)
 def handle_get_game_state(data):
     game_code = data.get('game_code', '').upper()
     player_id = data.get('player_id')
@@ -162,206 +625,205 @@ def handle_get_game_state(data):
         emit('error', {'message': 'Player ID required'})
         return
     
-    if game_code not in games:
-        # print(f"DEBUG: get_game_state failed - Game {game_code} not found")
-        emit('error', {'message': 'Game not found'})
-        return
-    
-    game = games[game_code]
+    with games.locked(game_code) as game:
+        if game is None:
+            # print(f"DEBUG: get_game_state failed - Game {game_code} not found")
+            emit('error', {'message': 'Game not found'})
+            return
     
-    if player_id not in game['players']:
-        # print(f"DEBUG: get_game_state failed - Not authorized for player {player_id} in {game_code}")
-        emit('error', {'message': 'Not authorized for this game'})
-        return
+        if player_id not in game['players'] or player_id in BOT_DIFFICULTIES:
+            # print(f"DEBUG: get_game_state failed - Not authorized for player {player_id} in {game_code}")
+            emit('error', {'message': 'Not authorized for this game'})
+            return
     
-    color = game['players'][player_id]['color']
-    game['players'][player_id]['sid'] = request.sid
-    game['players'][player_id]['last_seen'] = time.time()
-    players[request.sid] = {
-        'game_code': game_code,
-        'player_id': player_id,
-        'color': color
-    }
+        color = game['players'][player_id]['color']
+        wire_format = requested_wire_format(data)
+        game['players'][player_id]['sid'] = request.sid
+        game['players'][player_id]['last_seen'] = time.time()
+        players[request.sid] = {
+            'game_code': game_code,
+            'player_id': player_id,
+            'color': color,
+            'wire_format': wire_format
+        }
     
-    join_room(game_code)
+        join_game_rooms(game_code, wire_format)
+        touch(game_code, game)
     
-    player_status = {
-        'white': 'You' if color == 'white' else 'Opponent' if 'white' in [p['color'] for p in game['players'].values()] else 'Waiting...',
-        'black': 'You' if color == 'black' else 'Opponent' if 'black' in [p['color'] for p in game['players'].values()] else 'Waiting...'
-    }
+        player_status = {
+            'white': 'You' if color == 'white' else 'Opponent' if 'white' in [p['color'] for p in game['players'].values()] else 'Waiting...',
+            'black': 'You' if color == 'black' else 'Opponent' if 'black' in [p['color'] for p in game['players'].values()] else 'Waiting...'
+        }
     
-    board_state = game['board'].get_board_state()
-    emit('game_state', {
-        'board_state': board_state['board'],
-        'white_king': board_state['white_king'],
-        'black_king': board_state['black_king'],
-        'white_in_check': board_state['white_in_check'],
-        'black_in_check': board_state['black_in_check'],
-        'player_color': color,
-        'game_started': game['game_started'],
-        'current_player': game['current_player'],
-        'players': player_status,
-        'timer': game['timer'],
-        'remaining_time': game['remaining_time'],
-        'captured': board_state['captured'],
-        'material_diff': board_state['material_diff']
-    })
-    # print(f"DEBUG: Sent game state to player {player_id} in {game_code}")
+        state = game_snapshot(game)
+        state.update({
+            'seq': game['seq'],
+            'player_color': color,
+            'game_started': game['game_started'],
+            'players': player_status
+        })
+        if wire_format == 'packed':
+            state = packed_payload(game, state)
+        else:
+            state = json_payload(game, state)
+        emit('game_state', state)
+        if sample_payload():
+            observe_payload('game_state', wire_format, state)
+        # print(f"DEBUG: Sent game state to player {player_id} in {game_code}")
 
 
 @socketio.on('player_ready')
+@timed(handler_seconds, 'player_ready', handler_errors)
 def handle_player_ready(data):
     # print(f"DEBUG: Received player_ready from sid: {request.sid}")
-    if request.sid not in players:
+    player_info = players.get(request.sid)
+    if player_info is None:
         # print(f"DEBUG: player_ready failed - SID not in players")
         return
     
-    player_info = players[request.sid]
     game_code = player_info['game_code']
     player_id = player_info['player_id']
     
-    if game_code not in games:
-        # print(f"DEBUG: player_ready failed - Game {game_code} not found")
-        return
-    
-    game = games[game_code]
-    if player_id in game['players']:
-        game['players'][player_id]['ready'] = True
-        # print(f"DEBUG: Player {player_id} marked as ready in {game_code}")
-    
-    ready_status = {pid: p['ready'] for pid, p in game['players'].items()}
-    # print(f"DEBUG: Current ready statuses in {game_code}: {ready_status}")
+    with games.locked(game_code) as game:
+        if game is None:
+            # print(f"DEBUG: player_ready failed - Game {game_code} not found")
+            return
     
-    all_ready = all(p['ready'] for p in game['players'].values()) and len(game['players']) == 2
-    if all_ready:
-        game['game_started'] = True
-        game['last_move_time'] = time.time()
-        board_state = game['board'].get_board_state()
-        socketio.emit('game_started', {
-            'board_state': board_state['board'],
-            'white_king': board_state['white_king'],
-            'black_king': board_state['black_king'],
-            'white_in_check': board_state['white_in_check'],
-            'black_in_check': board_state['black_in_check'],
-            'current_player': game['current_player'],
-            'timer': game['timer'],
-            'remaining_time': game['remaining_time'],
-            'captured': board_state['captured'],
-            'material_diff': board_state['material_diff']
-        }, room=game_code)
-        # print(f"DEBUG: Game {game_code} started - both players ready")
+        if player_id in game['players']:
+            game['players'][player_id]['ready'] = True
+            # print(f"DEBUG: Player {player_id} marked as ready in {game_code}")
+    
+        ready_status = {pid: p['ready'] for pid, p in game['players'].items()}
+        # print(f"DEBUG: Current ready statuses in {game_code}: {ready_status}")
+    
+        touch(game_code, game)
+        all_ready = all(p['ready'] for p in game['players'].values()) and len(game['players']) == 2
+        if all_ready:
+            game['game_started'] = True
+            game['clock'].start('white')
+            if journal is not None:
+                journal.log_start(game_code, game)
+            schedule_flag_fall(game_code, game)
+            emit_snapshot('game_started', game_code, game)
+            request_engine_move(game_code, game)
+            # print(f"DEBUG: Game {game_code} started - both players ready")
+        else:
+            # print(f"DEBUG: Not all ready yet in {game_code} - waiting for other player")
+            socketio.emit('message', {'message': 'Waiting for other player to ready up', 'type': 'info'}, room=game_code)
+
+
+def play_move(game_code, game, player_color, from_pos, to_pos):
+    """Play a move for player_color, a player's or the computer's.
+    
+    Returns False if the move is not legal. A move that arrives after the
+    mover's flag fell ends the game on time instead. Call with the game's
+    lock held.
+    """
+    # Timer logic: a move that arrives after the flag fell loses on time
+    clock = game['clock']
+    now = monotonic_ms()
+    if clock.running == player_color and clock.expired(player_color, now):
+        clock.flag()
+        game['game_over'] = True
+        game['winner'] = 'black' if player_color == 'white' else 'white'
+        record_result(game_code, game)
+        flag_scheduler.cancel(game_code)
+        touch(game_code, game)
+        emit_delta('move_made', game_code, game)
+        return True
+    # Removed promotion from call - your class handles it internally
+    # print(f"DEBUG: Attempting move from {from_pos} to {to_pos} by {player_color}")
+    with board_seconds.time(('make_move',)):
+        success = game['board'].make_move(from_pos[0], from_pos[1], to_pos[0], to_pos[1])
+    if not success:
+        return False
+    
+    # print(f"DEBUG: Move successful in {game_code}")
+    game['current_player'] = 'black' if game['current_player'] == 'white' else 'white'
+    if clock.running == player_color:
+        clock.press(now)
+    
+    with board_seconds.time(('is_checkmate',)):
+        checkmate = game['board'].is_checkmate(game['current_player'])
+    if checkmate:
+        game['game_over'] = True
+        game['winner'] = player_color
+        # print(f"DEBUG: Checkmate - {player_color} wins in {game_code}")
     else:
-        # print(f"DEBUG: Not all ready yet in {game_code} - waiting for other player")
-        socketio.emit('message', {'message': 'Waiting for other player to ready up', 'type': 'info'}, room=game_code)
+        with board_seconds.time(('is_stalemate',)):
+            stalemate = game['board'].is_stalemate(game['current_player'])
+        if stalemate:
+            game['game_over'] = True
+            game['winner'] = None
+            # print(f"DEBUG: Stalemate in {game_code}")
+    if game['game_over']:
+        clock.stop(now)
+    if journal is not None:
+        journal.log_move(game_code, game, from_pos, to_pos)
+    if game['game_over']:
+        record_result(game_code, game)
+    
+    schedule_flag_fall(game_code, game)
+    touch(game_code, game)
+    emit_delta('move_made', game_code, game)
+    # print(f"DEBUG: Broadcasted move_made to {game_code}")
+    request_engine_move(game_code, game)
+    return True
 
 
 @socketio.on('make_move')
+@timed(handler_seconds, 'make_move', handler_errors)
+@profiler.sampled('make_move')
 def handle_make_move(data):
     # print(f"DEBUG: Received make_move from sid: {request.sid} - data: {data}")
-    if request.sid not in players:
+    player_info = players.get(request.sid)
+    if player_info is None:
         # print("DEBUG: make_move failed - SID not in players")
         return
     
-    player_info = players[request.sid]
     game_code = player_info['game_code']
     player_color = player_info['color']
     
-    if game_code not in games:
-        # print(f"DEBUG: make_move failed - Game {game_code} not found")
-        return
-    
-    game = games[game_code]
-    if game['current_player'] != player_color or game['game_over']:
-        # print(f"DEBUG: Invalid move - not {player_color}'s turn or game over")
-        emit('invalid_move', {'message': 'Not your turn or game over'})
-        return
+    # The move, the clock and the timeout check all happen under the game's lock
+    with games.locked(game_code) as game:
+        if game is None:
+            # print(f"DEBUG: make_move failed - Game {game_code} not found")
+            return
     
-    from_pos = data['from']
-    to_pos = data['to']
-    # Timer logic
-    now = time.time()
-    if game['last_move_time']:
-        elapsed = now - game['last_move_time']
-        color = player_color
-        game['remaining_time'][color] -= int(elapsed)
-        if game['remaining_time'][color] <= 0:
-            game['remaining_time'][color] = 0
-            game['game_over'] = True
-            game['winner'] = 'black' if color == 'white' else 'white'
-            board_state = game['board'].get_board_state()
-            socketio.emit('move_made', {
-                'board_state': board_state['board'],
-                'white_king': board_state['white_king'],
-                'black_king': board_state['black_king'],
-                'white_in_check': board_state['white_in_check'],
-                'black_in_check': board_state['black_in_check'],
-                'current_player': game['current_player'],
-                'game_over': game['game_over'],
-                'winner': game['winner'],
-                'timer': game['timer'],
-                'remaining_time': game['remaining_time'],
-                'captured': board_state['captured'],
-                'material_diff': board_state['material_diff']
-            }, room=game_code)
+        if game['current_player'] != player_color or game['game_over']:
+            # print(f"DEBUG: Invalid move - not {player_color}'s turn or game over")
+            emit('invalid_move', {'message': 'Not your turn or game over'})
             return
-    game['last_move_time'] = now
-    # Removed promotion from call - your class handles it internally
-    # print(f"DEBUG: Attempting move from {from_pos} to {to_pos} by {player_color}")
-    success = game['board'].make_move(from_pos[0], from_pos[1], to_pos[0], to_pos[1])
     
-    if success:
-        # print(f"DEBUG: Move successful in {game_code}")
-        game['current_player'] = 'black' if game['current_player'] == 'white' else 'white'
-        
-        if game['board'].is_checkmate(game['current_player']):
-            game['game_over'] = True
-            game['winner'] = player_color
-            # print(f"DEBUG: Checkmate - {player_color} wins in {game_code}")
-        elif game['board'].is_stalemate(game['current_player']):
-            game['game_over'] = True
-            game['winner'] = None
-            # print(f"DEBUG: Stalemate in {game_code}")
-        
-        board_state = game['board'].get_board_state()
-        socketio.emit('move_made', {
-            'board_state': board_state['board'],
-            'white_king': board_state['white_king'],
-            'black_king': board_state['black_king'],
-            'white_in_check': board_state['white_in_check'],
-            'black_in_check': board_state['black_in_check'],
-            'current_player': game['current_player'],
-            'game_over': game['game_over'],
-            'winner': game['winner'],
-            'timer': game['timer'],
-            'remaining_time': game['remaining_time'],
-            'captured': board_state['captured'],
-            'material_diff': board_state['material_diff']
-        }, room=game_code)
-        # print(f"DEBUG: Broadcasted move_made to {game_code}")
-    else:
-        # print(f"DEBUG: Move failed in {game_code} - invalid move (check validation or path blocked?)")
-        emit('invalid_move', {'message': 'Invalid move'})
+        from_pos = data['from']
+        to_pos = data['to']
+        if not play_move(game_code, game, player_color, from_pos, to_pos):
+            # print(f"DEBUG: Move failed in {game_code} - invalid move (check validation or path blocked?)")
+            emit('invalid_move', {'message': 'Invalid move'})
 
 
 @socketio.on('get_valid_moves')
+@timed(handler_seconds, 'get_valid_moves', handler_errors)
+@profiler.sampled('get_valid_moves')
 def handle_get_valid_moves(data):
     # print(f"DEBUG: Received get_valid_moves from sid: {request.sid} - position: {data['position']}")
-    if request.sid not in players:
+    player_info = players.get(request.sid)
+    if player_info is None:
         # print("DEBUG: get_valid_moves failed - SID not in players")
         return
     
-    player_info = players[request.sid]
     game_code = player_info['game_code']
     
-    if game_code not in games:
-        # print(f"DEBUG: get_valid_moves failed - Game {game_code} not found")
-        return
+    with games.locked(game_code) as game:
+        if game is None:
+            # print(f"DEBUG: get_valid_moves failed - Game {game_code} not found")
+            return
     
-    game = games[game_code]
-    pos = data['position']
+        pos = data['position']
     
-    valid_moves = game['board'].get_valid_moves(pos[0], pos[1])
-    # print(f"DEBUG: Valid moves for {pos} in {game_code}: {valid_moves}")
+        with board_seconds.time(('get_valid_moves',)):
+            valid_moves = game['board'].get_valid_moves(pos[0], pos[1])
+        # print(f"DEBUG: Valid moves for {pos} in {game_code}: {valid_moves}")
     
     emit('valid_moves', {
         'position': pos,
@@ -370,108 +832,95 @@ def handle_get_valid_moves(data):
 
 
 @socketio.on('reset_game')
+@timed(handler_seconds, 'reset_game', handler_errors)
 def handle_reset_game():
-    if request.sid not in players:
+    player_info = players.get(request.sid)
+    if player_info is None:
         return
     
-    player_info = players[request.sid]
     game_code = player_info['game_code']
     
-    if game_code not in games:
-        return
+    with games.locked(game_code) as game:
+        if game is None:
+            return
     
-    game = games[game_code]
-    game['board'] = OnlineChessBoard()
-    game['current_player'] = 'white'
-    game['game_over'] = False
-    game['winner'] = None
-    game['remaining_time'] = {'white': game['timer'], 'black': game['timer']}
-    game['last_move_time'] = None
+        game['board'] = OnlineChessBoard()
+        game['current_player'] = 'white'
+        game['game_over'] = False
+        game['winner'] = None
+        game['clock'].reset()
+        flag_scheduler.cancel(game_code)
+        if journal is not None:
+            journal.log_reset(game_code, game)
     
-    for player in game['players'].values():
-        player['ready'] = False
+        for player_id, player in game['players'].items():
+            player['ready'] = player_id in BOT_DIFFICULTIES
+        touch(game_code, game)
     
-    board_state = game['board'].get_board_state()
-    socketio.emit('game_reset', {
-        'board_state': board_state['board'],
-        'white_king': board_state['white_king'],
-        'black_king': board_state['black_king'],
-        'white_in_check': board_state['white_in_check'],
-        'black_in_check': board_state['black_in_check'],
-        'current_player': game['current_player'],
-        'timer': game['timer'],
-        'remaining_time': game['remaining_time'],
-        'captured': board_state['captured'],
-        'material_diff': board_state['material_diff']
-    }, room=game_code)
+        emit_snapshot('game_reset', game_code, game)
+
+
+@socketio.on('admin_profile')
+@timed(handler_seconds, 'admin_profile', handler_errors)
+def handle_admin_profile(data):
+    """Set the profiled percentage of calls with 'percent', and write the stacks collected so far with 'dump'"""
+    data = data or {}
+    if not ADMIN_TOKEN or not hmac.compare_digest(str(data.get('token', '')).encode(), ADMIN_TOKEN.encode()):
+        emit('error', {'message': 'Not authorized'})
+        return
+    
+    if 'percent' in data:
+        try:
+            profiler.set_percent(data['percent'])
+        except (TypeError, ValueError):
+            emit('error', {'message': 'percent must be a number from 0 to 100'})
+            return
+    path = profiler.dump() if data.get('dump') else None
+    emit('profile_status', dict(profiler.stats(), dumped=path))
 
 
 @socketio.on('disconnect')
+@timed(handler_seconds, 'disconnect', handler_errors)
 def handle_disconnect():
     # print(f"DEBUG: Player disconnected with sid: {request.sid}")
-    if request.sid in players:
-        player_info = players[request.sid]
+    player_info = players.pop(request.sid)
+    if player_info is not None:
         game_code = player_info['game_code']
         player_id = player_info['player_id']
-        
-        if game_code in games:
-            if player_id in games[game_code]['players']:
-                games[game_code]['players'][player_id]['sid'] = None
-                games[game_code]['players'][player_id]['last_seen'] = time.time()
-            
-            socketio.emit('player_disconnected', {
-                'players_count': len([p for p in games[game_code]['players'].values() if p['sid'] is not None])
-            }, room=game_code)
-        
-        del players[request.sid]
+    
+        with games.locked(game_code) as game:
+            if game is not None:
+                if player_id in game['players']:
+                    game['players'][player_id]['sid'] = None
+                    game['players'][player_id]['last_seen'] = time.time()
+                # Once nobody is connected the shorter abandoned TTL applies
+                touch(game_code, game)
+    
+                socketio.emit('player_disconnected', {
+                    'players_count': len([p for p in game['players'].values() if p['sid'] is not None])
+                }, room=game_code)
+    
         leave_room(game_code)
-        
-        def cleanup_game():
-            if game_code in games and all(p['sid'] is None for p in games[game_code]['players'].values()) and time.time() - games[game_code]['last_activity'] > 300:
-                del games[game_code]
-                # print(f"DEBUG: Cleaned up inactive game {game_code}")
-        
-        socketio.start_background_task(cleanup_game)
-
-
-# Add a background task to check timers every second and end the game if a timer reaches zero.
-def timer_check_task():
-    while True:
-        time.sleep(1)
-        for game_code, game in list(games.items()):
-            if not game.get('game_started') or game.get('game_over'):
-                continue
-            now = time.time()
-            if game['last_move_time']:
-                turn = game['current_player']
-                elapsed = int(now - game['last_move_time'])
-                remaining = game['remaining_time'][turn] - elapsed
-                if remaining <= 0:
-                    game['remaining_time'][turn] = 0
-                    game['game_over'] = True
-                    game['winner'] = 'black' if turn == 'white' else 'white'
-                    board_state = game['board'].get_board_state()
-                    socketio.emit('move_made', {
-                        'board_state': board_state['board'],
-                        'white_king': board_state['white_king'],
-                        'black_king': board_state['black_king'],
-                        'white_in_check': board_state['white_in_check'],
-                        'black_in_check': board_state['black_in_check'],
-                        'current_player': game['current_player'],
-                        'game_over': game['game_over'],
-                        'winner': game['winner'],
-                        'timer': game['timer'],
-                        'remaining_time': game['remaining_time'],
-                        'captured': board_state['captured'],
-                        'material_diff': board_state['material_diff']
-                    }, room=game_code)
-                    game['last_move_time'] = None
-                else:
-                    game['remaining_time'][turn] = remaining
-
-# Start the timer check task in the background
-threading.Thread(target=timer_check_task, daemon=True).start()
+
+
+# Start the engine workers, so the first computer move doesn't wait for an
+# interpreter to start, then the flag-fall and eviction schedulers
+if engine_pool is not None:
+    engine_pool.start()
+flag_scheduler.start()
+evictor.start()
+# Restore the snapshot, replay the journal on top of it, then start both
+# writers. Timers are re-armed only once games are at their replayed position.
+if snapshotter is not None:
+    snapshotter.restore()
+if journal is not None:
+    journal.recover(games, journal_game, on_replayed=restore_game)
+    journal.start()
+if snapshotter is not None:
+    snapshotter.start()
 
 
 if __name__ == '__main__':
+    # Exit through sys.exit on SIGTERM so the final snapshot is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     socketio.run(app, host='0.0.0.0', port=5000, use_reloader=False)
@@ -0,0 +1,230 @@
+"""Move generation benchmark suite with machine-readable results.
+
+Runs perft from standard test positions and checks every node count, then
+times the board operations handlers call on every request. Node counts are
+for this game's rules (no castling, no en passant, queen-only promotion);
+they equal the standard counts only where those rules never come up, such
+as the start position up to depth 4. perft.py checks the move generator
+against the original chess_pieces rules; this suite checks that it stays
+correct and measures how fast it is.
+
+    python benchmark.py --output results.json
+    python benchmark.py --depth 4 --compare results.json
+
+A perft count mismatch exits with status 1, and so does --compare when an
+operation got slower than --tolerance allows.
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from bitboard import COLOR_INDEX
+from move_cache import valid_moves_cache
+from online_chess_board import START_FEN, OnlineChessBoard
+from perft import ReferenceBoard
+
+# name -> (FEN, node counts at depth 1, 2, ...)
+PERFT_POSITIONS = {
+    'start': (START_FEN, (20, 400, 8902, 197281)),
+    'kiwipete': ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+                 (46, 1865, 86585, 3488552)),
+    'position3': ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', (14, 191, 2810, 43087)),
+    'position4': ('r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+                  (6, 222, 7855, 305965)),
+    'position5': ('rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8', (40, 1339, 51750, 1729274)),
+}
+
+
+def perft(board, depth):
+    """Leaf nodes of the legal move tree below the board's position"""
+    moves = board.get_all_valid_moves(board.turn)
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        board.push(move)
+        nodes += perft(board, depth - 1)
+        board.pop()
+    return nodes
+
+
+def run_perft(depth):
+    results = {}
+    for name, (fen, counts) in PERFT_POSITIONS.items():
+        position_depth = min(depth, len(counts))
+        board = OnlineChessBoard.from_fen(fen)
+        start = time.perf_counter()
+        nodes = perft(board, position_depth)
+        seconds = time.perf_counter() - start
+        results[name] = {
+            'depth': position_depth,
+            'nodes': nodes,
+            'expected': counts[position_depth - 1],
+            'ok': nodes == counts[position_depth - 1],
+            'seconds': seconds,
+            'nodes_per_second': nodes / seconds,
+        }
+    return results
+
+
+def sample_fens(count, seed):
+    """Positions from random games, a mix of openings, middlegames and endings"""
+    rng = random.Random(seed)
+    fens = []
+    while len(fens) < count:
+        board = OnlineChessBoard()
+        for _ in range(rng.randrange(1, 120)):
+            moves = board.get_all_valid_moves(board.turn)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        fens.append(board.to_fen())
+    return fens
+
+
+def _time_per_board(fens, operation, repeat):
+    """Mean microseconds of operation(board) over freshly loaded boards, so no result is cached.
+
+    The best of repeat passes is kept, which filters out scheduling noise.
+    """
+    best = None
+    for _ in range(repeat):
+        boards = [OnlineChessBoard.from_fen(fen) for fen in fens]
+        valid_moves_cache.clear()
+        start = time.perf_counter()
+        for board in boards:
+            operation(board)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best / len(fens) * 1e6
+
+
+def _get_valid_moves(board):
+    squares = board.squares
+    color = COLOR_INDEX[board.turn]
+    for sq in range(64):
+        if squares[sq] and squares[sq] >> 3 == color:
+            board.get_valid_moves(sq >> 3, sq & 7)
+
+
+def _reference_moves(board):
+    ReferenceBoard(board).get_all_valid_moves(board.turn)
+
+
+def run_micro(fens, reference_positions, repeat=3):
+    """Microseconds per call of the operations handlers use, on cold boards"""
+    results = {
+        'get_valid_moves_all_pieces': _time_per_board(fens, _get_valid_moves, repeat),
+        'get_all_valid_moves': _time_per_board(fens, lambda board: board.get_all_valid_moves(board.turn), repeat),
+        'is_checkmate': _time_per_board(fens, lambda board: board.is_checkmate(board.turn), repeat),
+        'is_stalemate': _time_per_board(fens, lambda board: board.is_stalemate(board.turn), repeat),
+        'get_board_state': _time_per_board(fens, lambda board: board.get_board_state(), repeat),
+        'make_move_and_pop': _time_per_board(fens, _make_move_and_pop, repeat),
+        'from_fen': min(_time_fen(fens) for _ in range(repeat)),
+    }
+    if reference_positions:
+        # The original chess_pieces square-by-square generator, for comparison
+        results['chess_pieces_all_valid_moves'] = _time_per_board(fens[:reference_positions], _reference_moves, 1)
+    return results
+
+
+def _make_move_and_pop(board):
+    moves = board.get_all_valid_moves(board.turn)
+    if moves:
+        (from_row, from_col), (to_row, to_col) = moves[0]
+        board.make_move(from_row, from_col, to_row, to_col)
+        board.pop()
+
+
+def _time_fen(fens):
+    board = OnlineChessBoard()
+    start = time.perf_counter()
+    for fen in fens:
+        board.set_fen(fen)
+    return (time.perf_counter() - start) / len(fens) * 1e6
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing each change against a baseline, and whether any got slower than tolerance"""
+    lines = []
+    regressed = False
+    for name, result in results['perft'].items():
+        old = baseline.get('perft', {}).get(name)
+        if old and old['depth'] == result['depth']:
+            ratio = result['nodes_per_second'] / old['nodes_per_second']
+            slower = ratio < 1 - tolerance
+            regressed |= slower
+            lines.append(f"perft {name:<12} {ratio:6.2f}x nodes/s{'  SLOWER' if slower else ''}")
+    for name, micros in results['micro'].items():
+        old = baseline.get('micro', {}).get(name)
+        if old:
+            ratio = old / micros
+            slower = ratio < 1 - tolerance
+            regressed |= slower
+            lines.append(f"{name:<30} {ratio:6.2f}x speed{'  SLOWER' if slower else ''}")
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=3, help='perft depth, capped per position (max 4)')
+    parser.add_argument('--positions', type=int, default=2000, help='random positions for the timings')
+    parser.add_argument('--reference-positions', type=int, default=100,
+                        help='positions to time the chess_pieces generator on (0 to skip)')
+    parser.add_argument('--repeat', type=int, default=3, help='passes per timing; the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.20,
+                        help='fraction slower than the baseline that counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = {'environment': environment(), 'perft': run_perft(args.depth)}
+    for name, result in results['perft'].items():
+        status = 'ok' if result['ok'] else f"MISMATCH, expected {result['expected']}"
+        print(f"perft {name:<12} depth {result['depth']}: {result['nodes']:>9} nodes "
+              f"{result['nodes_per_second']:>10,.0f} nodes/s  {status}")
+    fens = sample_fens(args.positions, args.seed)
+    results['micro'] = run_micro(fens, args.reference_positions, args.repeat)
+    for name, micros in results['micro'].items():
+        print(f'{name:<30} {micros:10.1f} us')
+
+    status = 0
+    if not all(result['ok'] for result in results['perft'].values()):
+        status = 1
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            lines, regressed = compare(results, json.load(baseline_file), args.tolerance)
+        print(f"against {args.compare}:")
+        for line in lines:
+            print('  ' + line)
+        if regressed:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+"""Bitboard move generation used by OnlineChessBoard.
+
+Squares are numbered ``row * 8 + col`` using the same (row, col) coordinates
+as OnlineChessBoard, so row 0 is black's back rank and square 0 is a8. A
+position is described by twelve 64-bit ints, one per (color, piece type),
+indexed ``color * 6 + piece_type``.
+
+The rules mirror chess_pieces: no castling, no en passant and pawns always
+promote to a queen.
+"""
+
+WHITE, BLACK = 0, 1
+COLORS = ('white', 'black')
+COLOR_INDEX = {'white': WHITE, 'black': BLACK}
+
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+PIECE_TYPES = ('pawn', 'knight', 'bishop', 'rook', 'queen', 'king')
+PIECE_INDEX = {name: index for index, name in enumerate(PIECE_TYPES)}
+
+FULL = (1 << 64) - 1
+
+# One-byte piece codes used for board buffers and the packed wire format:
+# piece type + 1 in the low three bits, 8 added for black, 0 for empty
+QUEEN_MINUS_PAWN = 4
+CODE_INDEX = [-1] * 16  # code -> color * 6 + piece type, the bitboard index
+for _color in (WHITE, BLACK):
+    for _piece_type in range(6):
+        CODE_INDEX[(_piece_type + 1) | (_color << 3)] = _color * 6 + _piece_type
+
+
+def piece_code(color, piece_type):
+    """Return the byte code for a piece of the given color and type indexes"""
+    return (piece_type + 1) | (color << 3)
+
+# Pawn rules per color: (row step, start row, promotion row)
+PAWN_STEP = (-1, 1)
+PAWN_START_ROW = (6, 1)
+PAWN_PROMOTION_ROW = (0, 7)
+
+
+def square(row, col):
+    """Return the square index for a (row, col) position"""
+    return row * 8 + col
+
+
+def bit_squares(bb):
+    """Yield the square index of every set bit, lowest first"""
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def _leaper_table(offsets):
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        bb = 0
+        for dr, dc in offsets:
+            r, c = row + dr, col + dc
+            if 0 <= r < 8 and 0 <= c < 8:
+                bb |= 1 << (r * 8 + c)
+        table.append(bb)
+    return table
+
+
+def _ray_table(dr, dc):
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        bb = 0
+        r, c = row + dr, col + dc
+        while 0 <= r < 8 and 0 <= c < 8:
+            bb |= 1 << (r * 8 + c)
+            r, c = r + dr, c + dc
+        table.append(bb)
+    return table
+
+
+KNIGHT_ATTACKS = _leaper_table([(-2, -1), (-2, 1), (-1, -2), (-1, 2),
+                                (1, -2), (1, 2), (2, -1), (2, 1)])
+KING_ATTACKS = _leaper_table([(-1, -1), (-1, 0), (-1, 1), (0, -1),
+                              (0, 1), (1, -1), (1, 0), (1, 1)])
+# PAWN_ATTACKS[color][sq] is the set of squares a pawn of that color on sq attacks
+PAWN_ATTACKS = (_leaper_table([(-1, -1), (-1, 1)]),
+                _leaper_table([(1, -1), (1, 1)]))
+
+# Sliding directions as (ray table, increasing square index, diagonal)
+ORTHOGONAL_DIRECTIONS = [
+    (_ray_table(-1, 0), False, False),
+    (_ray_table(1, 0), True, False),
+    (_ray_table(0, -1), False, False),
+    (_ray_table(0, 1), True, False),
+]
+DIAGONAL_DIRECTIONS = [
+    (_ray_table(-1, -1), False, True),
+    (_ray_table(-1, 1), False, True),
+    (_ray_table(1, -1), True, True),
+    (_ray_table(1, 1), True, True),
+]
+DIRECTIONS = ORTHOGONAL_DIRECTIONS + DIAGONAL_DIRECTIONS
+
+
+def _between_table():
+    # BETWEEN[a][b] holds the squares strictly between a and b on a shared line
+    table = [[0] * 64 for _ in range(64)]
+    for rays, positive, _ in DIRECTIONS:
+        for a in range(64):
+            ray = rays[a]
+            for b in bit_squares(ray):
+                table[a][b] = ray & ~rays[b] & ~(1 << b)
+    return table
+
+
+BETWEEN = _between_table()
+
+
+def _nearest(blockers, positive):
+    if positive:
+        return (blockers & -blockers).bit_length() - 1
+    return blockers.bit_length() - 1
+
+
+def _slide(sq, occupied, directions):
+    attacks = 0
+    for rays, positive, _ in directions:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[_nearest(blockers, positive)]
+        attacks |= ray
+    return attacks
+
+
+def bishop_attacks(sq, occupied):
+    """Squares attacked diagonally from sq given the occupancy"""
+    return _slide(sq, occupied, DIAGONAL_DIRECTIONS)
+
+
+def rook_attacks(sq, occupied):
+    """Squares attacked orthogonally from sq given the occupancy"""
+    return _slide(sq, occupied, ORTHOGONAL_DIRECTIONS)
+
+
+def piece_attacks(piece_type, color, sq, occupied):
+    """Squares attacked by a piece of the given type and color standing on sq"""
+    if piece_type == PAWN:
+        return PAWN_ATTACKS[color][sq]
+    if piece_type == KNIGHT:
+        return KNIGHT_ATTACKS[sq]
+    if piece_type == KING:
+        return KING_ATTACKS[sq]
+    if piece_type == BISHOP:
+        return bishop_attacks(sq, occupied)
+    if piece_type == ROOK:
+        return rook_attacks(sq, occupied)
+    return bishop_attacks(sq, occupied) | rook_attacks(sq, occupied)
+
+
+def attackers_of(sq, by_color, pieces, occupied):
+    """Bitboard of the by_color pieces that attack sq"""
+    base = by_color * 6
+    queens = pieces[base + QUEEN]
+    attackers = PAWN_ATTACKS[1 - by_color][sq] & pieces[base + PAWN]
+    attackers |= KNIGHT_ATTACKS[sq] & pieces[base + KNIGHT]
+    attackers |= KING_ATTACKS[sq] & pieces[base + KING]
+    attackers |= bishop_attacks(sq, occupied) & (pieces[base + BISHOP] | queens)
+    attackers |= rook_attacks(sq, occupied) & (pieces[base + ROOK] | queens)
+    return attackers
+
+
+def pseudo_targets(piece_type, color, sq, own, enemy):
+    """Destination squares for a piece ignoring whether its king is left in check"""
+    occupied = own | enemy
+    if piece_type == PAWN:
+        targets = PAWN_ATTACKS[color][sq] & enemy
+        step = PAWN_STEP[color] * 8
+        one = sq + step
+        if 0 <= one < 64 and not (occupied >> one) & 1:
+            targets |= 1 << one
+            if sq // 8 == PAWN_START_ROW[color]:
+                two = one + step
+                if not (occupied >> two) & 1:
+                    targets |= 1 << two
+        return targets
+    return piece_attacks(piece_type, color, sq, occupied) & ~own
+
+
+class LegalityContext:
+    """Check and pin information for one side, computed once per position"""
+
+    def __init__(self, pieces, occupancy, color, enemy_attacks=None):
+        self.pieces = pieces
+        self.color = color
+        self.own = occupancy[color]
+        self.enemy = occupancy[1 - color]
+        self.occupied = self.own | self.enemy
+        # Squares the other side attacks, when the caller keeps an attack map
+        self.enemy_attacks = enemy_attacks
+        self.check_mask = FULL
+        self.pins = {}
+        self.king_sq = None
+        self.checkers = 0
+        self.double_check = False
+
+        king = pieces[color * 6 + KING]
+        if not king:
+            return
+        ksq = self.king_sq = king.bit_length() - 1
+        them = 1 - color
+        if enemy_attacks is None or enemy_attacks & king:
+            checkers = self.checkers = attackers_of(ksq, them, pieces, self.occupied)
+        else:
+            checkers = 0
+        if checkers:
+            if checkers & (checkers - 1):
+                self.double_check = True
+                self.check_mask = 0
+            else:
+                self.check_mask = checkers | BETWEEN[ksq][checkers.bit_length() - 1]
+
+        base = them * 6
+        diagonal_sliders = pieces[base + BISHOP] | pieces[base + QUEEN]
+        orthogonal_sliders = pieces[base + ROOK] | pieces[base + QUEEN]
+        for rays, positive, diagonal in DIRECTIONS:
+            sliders = diagonal_sliders if diagonal else orthogonal_sliders
+            ray = rays[ksq]
+            if not ray & sliders:
+                continue
+            blockers = ray & self.occupied
+            first = _nearest(blockers, positive)
+            if not (self.own >> first) & 1:
+                continue
+            rest = blockers & ~(1 << first)
+            if not rest:
+                continue
+            second = _nearest(rest, positive)
+            if (sliders >> second) & 1:
+                self.pins[first] = BETWEEN[ksq][second] | (1 << second)
+
+    def king_can_enter(self, to_sq):
+        """Check that the king would not be attacked after stepping to to_sq"""
+        if not self.checkers and self.enemy_attacks is not None:
+            # No slider sees the king, so lifting it cannot open a new ray
+            return not (self.enemy_attacks >> to_sq) & 1
+        occupied = self.occupied & ~(1 << self.king_sq)
+        return not attackers_of(to_sq, 1 - self.color, self.pieces, occupied)
+
+    def allows(self, from_sq, to_sq):
+        """Check that moving from_sq to to_sq leaves this side's king safe"""
+        if from_sq == self.king_sq:
+            return self.king_can_enter(to_sq)
+        mask = self.check_mask & self.pins.get(from_sq, FULL)
+        return bool((mask >> to_sq) & 1)
+
+    def targets(self, piece_type, sq):
+        """Legal destination squares for the piece of this side on sq"""
+        if sq == self.king_sq:
+            targets = 0
+            for to_sq in bit_squares(KING_ATTACKS[sq] & ~self.own):
+                if self.king_can_enter(to_sq):
+                    targets |= 1 << to_sq
+            return targets
+        targets = pseudo_targets(piece_type, self.color, sq, self.own, self.enemy)
+        targets &= self.check_mask
+        pin = self.pins.get(sq)
+        if pin is not None:
+            targets &= pin
+        return targets
@@ -1,4 +1,6 @@
 class ChessPiece:
+    __slots__ = ('color', 'piece_type', 'row', 'col', 'has_moved')
+    
     def __init__(self, color, piece_type, row, col):
         self.color = color
         self.piece_type = piece_type
@@ -27,6 +29,8 @@ class ChessPiece:
         return moves
 
 class Pawn(ChessPiece):
+    __slots__ = ()
+    
     def __init__(self, color, row, col):
         super().__init__(color, 'pawn', row, col)
     
@@ -61,6 +65,8 @@ class Pawn(ChessPiece):
         return False
 
 class Rook(ChessPiece):
+    __slots__ = ()
+    
     def __init__(self, color, row, col):
         super().__init__(color, 'rook', row, col)
     
@@ -98,6 +104,8 @@ class Rook(ChessPiece):
         return target_piece is None or target_piece.color != self.color
 
 class Bishop(ChessPiece):
+    __slots__ = ()
+    
     def __init__(self, color, row, col):
         super().__init__(color, 'bishop', row, col)
     
@@ -132,6 +140,8 @@ class Bishop(ChessPiece):
         return target_piece is None or target_piece.color != self.color
 
 class Knight(ChessPiece):
+    __slots__ = ()
+    
     def __init__(self, color, row, col):
         super().__init__(color, 'knight', row, col)
     
@@ -158,6 +168,8 @@ class Knight(ChessPiece):
         return target_piece is None or target_piece.color != self.color
 
 class Queen(ChessPiece):
+    __slots__ = ()
+    
     def __init__(self, color, row, col):
         super().__init__(color, 'queen', row, col)
     
@@ -209,6 +221,8 @@ class Queen(ChessPiece):
         return target_piece is None or target_piece.color != self.color
 
 class King(ChessPiece):
+    __slots__ = ()
+    
     def __init__(self, color, row, col):
         super().__init__(color, 'king', row, col)
     
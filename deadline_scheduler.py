@@ -0,0 +1,107 @@
+"""Fire callbacks at deadlines without polling.
+
+Deadlines are time.monotonic() values kept in a heap. Scheduling a key
+again replaces its earlier deadline; the old heap entry is marked dead and
+dropped when it reaches the top, so schedule and cancel cost O(log n) and
+an idle scheduler costs nothing.
+"""
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+_CANCELLED = object()
+
+
+class DeadlineScheduler:
+    """Calls callback(key) once the deadline scheduled for key has passed.
+
+    on_late, if given, is called with the seconds each key fired after its
+    deadline, just before its callback runs.
+    """
+
+    def __init__(self, socketio, callback, on_late=None):
+        self.socketio = socketio
+        self.callback = callback
+        self.on_late = on_late
+        self._heap = []
+        self._entries = {}  # key -> its live [deadline, order, key] heap entry
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        """Start the background task, using the server's async mode (threading, eventlet or gevent)"""
+        if self._task is None:
+            self._wakeup = self.socketio.server.eio.create_event()
+            self._task = self.socketio.start_background_task(self._run)
+
+    def schedule(self, key, deadline):
+        """Fire key at the given time.monotonic() deadline, replacing any earlier one"""
+        with self._lock:
+            self._drop(key)
+            entry = [deadline, next(self._order), key]
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            earliest = self._heap[0] is entry
+        if earliest and self._wakeup is not None:
+            # The task may be sleeping until a later deadline
+            self._wakeup.set()
+
+    def schedule_in(self, key, seconds):
+        self.schedule(key, time.monotonic() + seconds)
+
+    def cancel(self, key):
+        with self._lock:
+            self._drop(key)
+
+    def deadline(self, key):
+        """The pending deadline for key, or None"""
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def pop_next(self):
+        """Remove and return the key with the earliest deadline without firing it, or None"""
+        with self._lock:
+            while self._heap:
+                deadline, order, key = heapq.heappop(self._heap)
+                if key is not _CANCELLED:
+                    del self._entries[key]
+                    return key
+            return None
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[2] = _CANCELLED
+
+    def _pop_due(self, now):
+        """Remove and return the (key, deadline) pairs due at now, and the seconds until the next deadline"""
+        due = []
+        heap = self._heap
+        while heap and (heap[0][2] is _CANCELLED or heap[0][0] <= now):
+            deadline, order, key = heapq.heappop(heap)
+            if key is not _CANCELLED:
+                del self._entries[key]
+                due.append((key, deadline))
+        return due, (heap[0][0] - now if heap else None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                due, timeout = self._pop_due(time.monotonic())
+                self._wakeup.clear()
+            for key, deadline in due:
+                if self.on_late is not None:
+                    self.on_late(time.monotonic() - deadline)
+                try:
+                    self.callback(key)
+                except Exception:
+                    traceback.print_exc()
+            if not due:
+                self._wakeup.wait(timeout)
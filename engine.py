@@ -0,0 +1,554 @@
+"""Computer opponent: iterative-deepening alpha-beta search over OnlineChessBoard.
+
+The evaluation is material, the PIECE_VALUES of get_board_state() in
+centipawns, plus piece-square tables, with a king table that moves the
+king to the centre once queens or most pieces are off. The search is
+negamax with alpha-beta pruning and a transposition table keyed by
+zobrist_key. Moves are tried table move first, then captures by most
+valuable victim and least valuable attacker, promotions, killer moves
+and the history table, and a quiescence search over captures keeps the
+evaluation from stopping halfway through an exchange.
+
+Searches run in an EnginePool of worker processes, each keeping its
+transposition table between searches, so a long think never holds up
+the event loop serving other games. The workers are separate
+interpreters running this file, spoken to over their stdin and stdout.
+
+    ENGINE_PROCESSES  worker processes for computer moves (1; 0 disables bot games)
+"""
+import os
+import pickle
+import queue
+import random
+import select
+import signal
+import struct
+import subprocess
+import sys
+import time
+import traceback
+import uuid
+
+from bitboard import BISHOP, CODE_INDEX, KNIGHT, PAWN, PAWN_PROMOTION_ROW, PIECE_TYPES, QUEEN, ROOK
+from online_chess_board import PIECE_VALUES, OnlineChessBoard
+
+ENGINE_PROCESSES = int(os.environ.get('ENGINE_PROCESSES', 1))
+
+# Depth cap, longest think in ms, and random centipawns added to each root move's score
+DIFFICULTIES = {
+    'easy': {'depth': 1, 'max_ms': 300, 'noise': 150},
+    'medium': {'depth': 3, 'max_ms': 1500, 'noise': 20},
+    'hard': {'depth': 32, 'max_ms': 5000, 'noise': 0},
+}
+DEFAULT_DIFFICULTY = 'medium'
+# The computer's player id for each difficulty, fixed so a game restored
+# from the journal, which only records player ids, still knows its bot
+BOT_PLAYER_IDS = {difficulty: str(uuid.uuid5(uuid.NAMESPACE_URL, f'chess-engine/{difficulty}'))
+                  for difficulty in DIFFICULTIES}
+BOT_DIFFICULTIES = {player_id: difficulty for difficulty, player_id in BOT_PLAYER_IDS.items()}
+
+MIN_BUDGET_MS = 50
+TABLE_SIZE = 200000
+# Seconds past its deadline a worker may take to answer, and the depth and
+# milliseconds of the search done in-process when it doesn't
+RESULT_GRACE = 0.5
+FALLBACK_DEPTH = 1
+FALLBACK_MS = 20
+MAX_PLY = 64
+MATE = 100000
+INFINITY = MATE + 1
+EXACT, LOWER, UPPER = range(3)
+
+# Centipawns by piece type index; the king is never captured
+MATERIAL = [PIECE_VALUES.get(name, 0) * 100 for name in PIECE_TYPES]
+
+# Piece-square bonuses from white's side, row 0 (rank 8) first like the squares
+PAWN_TABLE = (
+    0, 0, 0, 0, 0, 0, 0, 0,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    10, 10, 20, 30, 30, 20, 10, 10,
+    5, 5, 10, 25, 25, 10, 5, 5,
+    0, 0, 0, 20, 20, 0, 0, 0,
+    5, -5, -10, 0, 0, -10, -5, 5,
+    5, 10, 10, -20, -20, 10, 10, 5,
+    0, 0, 0, 0, 0, 0, 0, 0,
+)
+KNIGHT_TABLE = (
+    -50, -40, -30, -30, -30, -30, -40, -50,
+    -40, -20, 0, 0, 0, 0, -20, -40,
+    -30, 0, 10, 15, 15, 10, 0, -30,
+    -30, 5, 15, 20, 20, 15, 5, -30,
+    -30, 0, 15, 20, 20, 15, 0, -30,
+    -30, 5, 10, 15, 15, 10, 5, -30,
+    -40, -20, 0, 5, 5, 0, -20, -40,
+    -50, -40, -30, -30, -30, -30, -40, -50,
+)
+BISHOP_TABLE = (
+    -20, -10, -10, -10, -10, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 10, 10, 5, 0, -10,
+    -10, 5, 5, 10, 10, 5, 5, -10,
+    -10, 0, 10, 10, 10, 10, 0, -10,
+    -10, 10, 10, 10, 10, 10, 10, -10,
+    -10, 5, 0, 0, 0, 0, 5, -10,
+    -20, -10, -10, -10, -10, -10, -10, -20,
+)
+ROOK_TABLE = (
+    0, 0, 0, 0, 0, 0, 0, 0,
+    5, 10, 10, 10, 10, 10, 10, 5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    0, 0, 0, 5, 5, 0, 0, 0,
+)
+QUEEN_TABLE = (
+    -20, -10, -10, -5, -5, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 5, 5, 5, 0, -10,
+    -5, 0, 5, 5, 5, 5, 0, -5,
+    0, 0, 5, 5, 5, 5, 0, -5,
+    -10, 5, 5, 5, 5, 5, 0, -10,
+    -10, 0, 5, 0, 0, 0, 0, -10,
+    -20, -10, -10, -5, -5, -10, -10, -20,
+)
+KING_MIDDLEGAME_TABLE = (
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -20, -30, -30, -40, -40, -30, -30, -20,
+    -10, -20, -20, -20, -20, -20, -20, -10,
+    20, 20, 0, 0, 0, 0, 20, 20,
+    20, 30, 10, 0, 0, 10, 30, 20,
+)
+KING_ENDGAME_TABLE = (
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10, 0, 0, -10, -20, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -30, 0, 0, 0, 0, -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50,
+)
+
+
+def _score_tables(king_table):
+    """Material plus position by piece code and square, positive for white"""
+    tables = [[0] * 64 for _ in range(16)]
+    piece_tables = (PAWN_TABLE, KNIGHT_TABLE, BISHOP_TABLE, ROOK_TABLE, QUEEN_TABLE, king_table)
+    for code, index in enumerate(CODE_INDEX):
+        if index < 0:
+            continue
+        piece, color = index % 6, index // 6
+        for sq in range(64):
+            if color == 0:
+                tables[code][sq] = MATERIAL[piece] + piece_tables[piece][sq]
+            else:
+                # Black's view of the board is white's, mirrored top to bottom
+                tables[code][sq] = -(MATERIAL[piece] + piece_tables[piece][sq ^ 56])
+    return tables
+
+
+MIDDLEGAME = _score_tables(KING_MIDDLEGAME_TABLE)
+ENDGAME = _score_tables(KING_ENDGAME_TABLE)
+# Victim value and attacker rank by piece code, for capture ordering
+VICTIM_VALUES = [MATERIAL[index % 6] if index >= 0 else 0 for index in CODE_INDEX]
+ATTACKER_RANKS = [(1, 3, 3, 5, 9, 10)[index % 6] if index >= 0 else 0 for index in CODE_INDEX]
+# Moves as ((from_row, from_col), (to_row, to_col)) by from_sq << 6 | to_sq
+MOVES = [(divmod(move >> 6, 8), divmod(move & 63, 8)) for move in range(64 * 64)]
+
+# Ordering scores; captures and promotions are the only moves quiescence tries
+_TABLE_MOVE = 1 << 30
+_CAPTURE = 1 << 24
+_PROMOTION = 1 << 23
+_KILLER = 1 << 22
+
+
+def _endgame(pieces):
+    """No queens left, or at most two rooks and minor pieces between both sides"""
+    if not (pieces[QUEEN] | pieces[6 + QUEEN]):
+        return True
+    others = 0
+    for piece in (KNIGHT, BISHOP, ROOK):
+        others |= pieces[piece] | pieces[6 + piece]
+    return bin(others).count('1') <= 2
+
+
+def evaluate(board):
+    """Material and piece placement in centipawns, from the side to move's point of view"""
+    tables = ENDGAME if _endgame(board.pieces) else MIDDLEGAME
+    score = sum([tables[code][sq] for sq, code in enumerate(board.squares) if code])
+    return score if board.turn == 'white' else -score
+
+
+def _to_table(score, ply):
+    # Mate scores are stored relative to the position, not the root
+    if score > MATE - MAX_PLY:
+        return score + ply
+    if score < MAX_PLY - MATE:
+        return score - ply
+    return score
+
+
+def _from_table(score, ply):
+    if score > MATE - MAX_PLY:
+        return score - ply
+    if score < MAX_PLY - MATE:
+        return score + ply
+    return score
+
+
+class SearchTimeout(Exception):
+    """The search ran past its deadline"""
+
+
+class Search:
+    """One search of a board's position, sharing a transposition table with earlier searches"""
+
+    def __init__(self, board, table, deadline=None):
+        self.board = board
+        self.table = table
+        self.deadline = deadline
+        self.nodes = 0
+        self.killers = [[0, 0] for _ in range(MAX_PLY)]
+        self.history = {}
+        # (score, move) of the best root move searched so far in the current depth
+        self.root_best = None
+
+    def _count_node(self):
+        self.nodes += 1
+        if not self.nodes & 1023 and self.deadline is not None and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+    def ordered(self, moves, ply, table_move):
+        """(ordering score, move) for the packed legal moves, most promising first"""
+        squares = self.board.squares
+        killers = self.killers[ply]
+        history = self.history
+        scored = []
+        for i in range(0, len(moves), 2):
+            from_sq = moves[i]
+            to_sq = moves[i + 1]
+            move = from_sq << 6 | to_sq
+            code = squares[from_sq]
+            if move == table_move:
+                score = _TABLE_MOVE
+            elif squares[to_sq]:
+                score = _CAPTURE + VICTIM_VALUES[squares[to_sq]] * 16 - ATTACKER_RANKS[code]
+            elif (code & 7) == PAWN + 1 and to_sq >> 3 == PAWN_PROMOTION_ROW[code >> 3]:
+                score = _PROMOTION
+            elif move == killers[0] or move == killers[1]:
+                score = _KILLER + (move == killers[0])
+            else:
+                score = history.get(move, 0)
+            scored.append((score, move))
+        scored.sort(reverse=True)
+        return scored
+
+    def negamax(self, depth, alpha, beta, ply):
+        if depth <= 0 or ply >= MAX_PLY - 1:
+            return self.quiesce(alpha, beta, ply)
+        self._count_node()
+        board = self.board
+        key = board.zobrist_key
+        table_move = 0
+        entry = self.table.get(key)
+        if entry is not None:
+            entry_depth, flag, score, table_move = entry
+            if entry_depth >= depth:
+                score = _from_table(score, ply)
+                if flag == EXACT or (flag == LOWER and score >= beta) or (flag == UPPER and score <= alpha):
+                    return score
+
+        moves = board.legal_move_squares(board.turn)
+        if not moves:
+            return -MATE + ply if board.is_in_check(board.turn) else 0
+        original_alpha = alpha
+        best_score = -INFINITY
+        best_move = 0
+        for _, move in self.ordered(moves, ply, table_move):
+            board.push(MOVES[move])
+            try:
+                score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                board.pop()
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        if not board.squares[move & 63]:
+                            # A quiet move that refuted this line; try it early in sibling positions
+                            killers = self.killers[ply]
+                            if killers[0] != move:
+                                killers[1] = killers[0]
+                                killers[0] = move
+                            self.history[move] = min(self.history.get(move, 0) + depth * depth, _KILLER - 1)
+                        break
+
+        flag = UPPER if best_score <= original_alpha else LOWER if best_score >= beta else EXACT
+        self.table[key] = (depth, flag, _to_table(best_score, ply), best_move)
+        return best_score
+
+    def quiesce(self, alpha, beta, ply):
+        """Search captures and promotions only, or every evasion when in check"""
+        self._count_node()
+        board = self.board
+        in_check = board.is_in_check(board.turn)
+        if not in_check:
+            stand_pat = evaluate(board)
+            if stand_pat >= beta or ply >= MAX_PLY - 1:
+                return stand_pat
+            alpha = max(alpha, stand_pat)
+        moves = board.legal_move_squares(board.turn)
+        if not moves:
+            return -MATE + ply if in_check else 0
+        best_score = alpha
+        for order, move in self.ordered(moves, ply, 0):
+            if not in_check and order < _PROMOTION:
+                break
+            board.push(MOVES[move])
+            try:
+                score = -self.quiesce(-beta, -alpha, ply + 1)
+            finally:
+                board.pop()
+            if score > best_score:
+                best_score = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+        return best_score
+
+    def root(self, moves, depth, best_move, noise=0, rng=None):
+        """Best (score, move) at depth; with noise every move is scored exactly and then jittered"""
+        board = self.board
+        alpha = -INFINITY
+        best_score = -INFINITY
+        self.root_best = None
+        for _, move in self.ordered(moves, 0, best_move):
+            board.push(MOVES[move])
+            try:
+                score = -self.negamax(depth - 1, -INFINITY, INFINITY if noise else -alpha, 1)
+            finally:
+                board.pop()
+            if noise and abs(score) < MATE - MAX_PLY:
+                score += rng.randint(-noise, noise)
+            if score > best_score:
+                best_score = score
+                best_move = move
+                alpha = max(alpha, score)
+                self.root_best = (best_score, best_move)
+        return best_score, best_move
+
+
+def search(board, max_depth=4, budget_ms=None, noise=0, table=None, rng=None, deadline=None):
+    """Search the side to move's best move, deepening until max_depth or the time budget.
+
+    The search stops at deadline, a time.monotonic() value, or else
+    budget_ms from now. Returns {'move': ((from_row, from_col), (to_row,
+    to_col)) or None when there is no legal move, 'score': centipawns for
+    the side to move, 'depth': last completed depth, 'nodes', 'ms'}. If
+    not even depth 1 completes in time, the move is the best of the root
+    moves searched so far. The board is left as it was.
+    """
+    start = time.monotonic()
+    if deadline is None and budget_ms is not None:
+        deadline = start + budget_ms / 1000
+    table = {} if table is None else table
+    rng = rng or random.Random()
+    searcher = Search(board, table, deadline)
+    result = {'move': None, 'score': 0, 'depth': 0}
+    moves = board.legal_move_squares(board.turn)
+    if moves:
+        best_move = moves[0] << 6 | moves[1]
+        for depth in range(1, max_depth + 1):
+            try:
+                score, best_move = searcher.root(moves, depth, best_move, noise, rng)
+            except SearchTimeout:
+                if depth == 1 and searcher.root_best is not None:
+                    result['score'], best_move = searcher.root_best
+                break
+            result.update(score=score, depth=depth)
+            if len(moves) == 2 or abs(score) > MATE - MAX_PLY:
+                break
+            if deadline is not None:
+                now = time.monotonic()
+                # The next depth takes several times as long as all before it; do not start what cannot finish
+                if now - start > deadline - now:
+                    break
+        result['move'] = MOVES[best_move]
+    result['nodes'] = searcher.nodes
+    result['ms'] = (time.monotonic() - start) * 1000
+    return result
+
+
+def move_budget_ms(difficulty, remaining_ms, increment_ms=0, delay_ms=0):
+    """Thinking time for one move: a thirtieth of the clock plus most of the increment, capped by the level"""
+    budget = remaining_ms / 30 + increment_ms * 3 / 4 + delay_ms
+    return max(MIN_BUDGET_MS, min(budget, DIFFICULTIES[difficulty]['max_ms']))
+
+
+# Each worker process keeps its transposition table from one search to the next
+_table = {}
+
+
+def _search_worker(board_bytes, difficulty, deadline, seed):
+    if len(_table) > TABLE_SIZE:
+        _table.clear()
+    level = DIFFICULTIES[difficulty]
+    board = OnlineChessBoard.from_bytes(board_bytes)
+    return search(board, level['depth'], noise=level['noise'], table=_table, rng=random.Random(seed),
+                  deadline=deadline)
+
+
+def move_deadline(difficulty, remaining_ms, increment_ms=0, delay_ms=0):
+    """time.monotonic() by which a move asked for now must be found"""
+    return time.monotonic() + move_budget_ms(difficulty, remaining_ms, increment_ms, delay_ms) / 1000
+
+
+# Messages between the server and a worker: a 4-byte length, then a pickle
+_FRAME = struct.Struct('<I')
+
+
+def _write_frame(fd, value):
+    data = pickle.dumps(value)
+    data = memoryview(_FRAME.pack(len(data)) + data)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _read_exactly(fd, size, deadline):
+    chunks = []
+    while size:
+        # select() and os.read() are green once app.py has monkey patched, so only this task waits
+        if deadline is not None and not select.select([fd], [], [], max(0.0, deadline - time.monotonic()))[0]:
+            raise TimeoutError('engine worker did not answer in time')
+        chunk = os.read(fd, size)
+        if not chunk:
+            raise EOFError('engine worker exited')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _read_frame(fd, deadline=None):
+    size, = _FRAME.unpack(_read_exactly(fd, _FRAME.size, deadline))
+    return pickle.loads(_read_exactly(fd, size, deadline))
+
+
+def serve_worker():
+    """Worker process: answer (board bytes, difficulty, deadline, seed) jobs on stdin with search() results"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stdin, stdout = sys.stdin.fileno(), sys.stdout.fileno()
+    while True:
+        try:
+            job = _read_frame(stdin)
+        except EOFError:
+            return
+        try:
+            reply = (True, _search_worker(*job))
+        except Exception as error:
+            reply = (False, repr(error))
+        _write_frame(stdout, reply)
+
+
+class _Worker:
+    """One worker process and the ends of its pipes"""
+
+    def __init__(self):
+        # A fresh interpreter rather than a fork: it imports neither the server
+        # nor the monkey patched modules, and shares no event hub with it
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def search(self, job, deadline):
+        _write_frame(self.process.stdin.fileno(), job)
+        ok, value = _read_frame(self.process.stdout.fileno(), deadline)
+        if not ok:
+            raise RuntimeError(f'engine worker failed: {value}')
+        return value
+
+    def close(self):
+        self.process.kill()
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process.wait()
+
+
+class EnginePool:
+    """Worker processes that search positions for computer players.
+
+    search() blocks only the calling thread (or green thread) while a
+    worker thinks. A search that cannot get a worker or an answer in time
+    is done in-process to FALLBACK_DEPTH instead, and the worker replaced.
+    """
+
+    def __init__(self, processes=ENGINE_PROCESSES):
+        self.processes = processes
+        self.searches = 0
+        self.fallbacks = 0
+        self._workers = None
+        self._idle = None
+
+    def start(self):
+        """Start the workers"""
+        if self._workers is None:
+            self._workers = [_Worker() for _ in range(self.processes)]
+            self._idle = queue.Queue()
+            for worker in self._workers:
+                self._idle.put(worker)
+
+    def search(self, board_bytes, difficulty, deadline):
+        """search()'s result for a board saved with to_bytes(), found by deadline (a time.monotonic() value).
+
+        The deadline is usually set with move_deadline() when the move is
+        asked for, so time spent waiting for a free worker counts against it.
+        """
+        self.start()
+        self.searches += 1
+        seed = random.getrandbits(32)
+        try:
+            worker = self._idle.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            return self._fallback(board_bytes, difficulty, seed)
+        try:
+            # monotonic() is system-wide, so the deadline means the same in the worker
+            result = worker.search((board_bytes, difficulty, deadline, seed), deadline + RESULT_GRACE)
+        except Exception:
+            traceback.print_exc()
+            # It may still be thinking, or be gone; either way it can't take the next job
+            self._replace(worker)
+            return self._fallback(board_bytes, difficulty, seed)
+        self._idle.put(worker)
+        return result
+
+    def _replace(self, worker):
+        worker.close()
+        replacement = _Worker()
+        self._workers[self._workers.index(worker)] = replacement
+        self._idle.put(replacement)
+
+    def _fallback(self, board_bytes, difficulty, seed):
+        self.fallbacks += 1
+        board = OnlineChessBoard.from_bytes(board_bytes)
+        # This one runs on the server's own thread, so it gets only a few milliseconds
+        return search(board, FALLBACK_DEPTH, FALLBACK_MS, DIFFICULTIES[difficulty]['noise'], rng=random.Random(seed))
+
+    def close(self):
+        if self._workers is not None:
+            for worker in self._workers:
+                worker.close()
+            self._workers = None
+
+    def stats(self):
+        return {'processes': self.processes, 'searches': self.searches, 'fallbacks': self.fallbacks}
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--worker']:
+        serve_worker()
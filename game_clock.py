@@ -0,0 +1,145 @@
+"""Chess clock for a game, read lazily from time.monotonic().
+
+Only the side to move's clock runs, and its remaining time is worked out
+from the turn's start time whenever it is read, so nothing has to tick
+games down in the background. Times are whole milliseconds.
+"""
+import time
+
+COLORS = ('white', 'black')
+
+
+def monotonic_ms():
+    return int(time.monotonic() * 1000)
+
+
+class GameClock:
+    """Two-sided clock with optional Fischer increment and Bronstein delay.
+
+    increment_ms is added to the mover's clock after every move. With
+    delay_ms, the mover gets back the time used on the move, up to
+    delay_ms, so moves played within the delay cost nothing.
+    """
+
+    def __init__(self, initial_ms, increment_ms=0, delay_ms=0):
+        self.initial_ms = initial_ms
+        self.increment_ms = increment_ms
+        self.delay_ms = delay_ms
+        self.reset()
+
+    def reset(self):
+        self._remaining = {color: self.initial_ms for color in COLORS}
+        self.running = None
+        self._turn_start = None
+
+    def start(self, color, now=None):
+        """Start the given side's clock"""
+        self.stop(now)
+        self.running = color
+        self._turn_start = monotonic_ms() if now is None else now
+
+    def stop(self, now=None):
+        """Stop the running clock, charging it for the current turn"""
+        if self.running is not None:
+            self._remaining[self.running] = self.remaining(self.running, now)
+            self.running = None
+            self._turn_start = None
+
+    def press(self, now=None):
+        """End the running side's turn and start the opponent's.
+
+        Returns False, with the clock stopped at zero, if the mover's time had
+        already run out.
+        """
+        now = monotonic_ms() if now is None else now
+        color = self.running
+        used = self.elapsed(now)
+        remaining = self._remaining[color] - used
+        self.running = None
+        self._turn_start = None
+        if remaining <= 0:
+            self._remaining[color] = 0
+            return False
+        self._remaining[color] = remaining + min(used, self.delay_ms) + self.increment_ms
+        self.start('black' if color == 'white' else 'white', now)
+        return True
+
+    def resume(self, remaining_ms, running, now=None):
+        """Set both sides' remaining time and start running's clock, if any, from now"""
+        self._remaining = dict(remaining_ms)
+        self.running = None
+        self._turn_start = None
+        if running is not None:
+            self.start(running, now)
+
+    def elapsed(self, now=None):
+        """Milliseconds used so far on the current turn"""
+        if self.running is None:
+            return 0
+        now = monotonic_ms() if now is None else now
+        return max(0, now - self._turn_start)
+
+    def remaining(self, color, now=None):
+        """Milliseconds left for color, counting the turn in progress"""
+        if color != self.running:
+            return self._remaining[color]
+        return max(0, self._remaining[color] - self.elapsed(now))
+
+    def expired(self, color, now=None):
+        return self.remaining(color, now) <= 0
+
+    def flag(self):
+        """Stop the running side at zero after its time ran out"""
+        if self.running is not None:
+            self._remaining[self.running] = 0
+            self.running = None
+            self._turn_start = None
+
+    def deadline(self):
+        """time.monotonic() value at which the running side's flag falls, or None"""
+        if self.running is None:
+            return None
+        return (self._turn_start + self._remaining[self.running]) / 1000
+
+    def remaining_ms(self, now=None):
+        now = monotonic_ms() if now is None else now
+        return {color: self.remaining(color, now) for color in COLORS}
+
+    def remaining_seconds(self, now=None):
+        """Remaining time in whole seconds, rounded up, for clients that count down per second"""
+        return {color: -(-ms // 1000) for color, ms in self.remaining_ms(now).items()}
+
+    def to_dict(self):
+        """JSON-ready state that another process can load with from_dict().
+
+        time.monotonic() values mean nothing outside this process, so the
+        turn in progress is stored as time used so far plus the wall-clock
+        time of saving.
+        """
+        return {
+            'initial_ms': self.initial_ms,
+            'increment_ms': self.increment_ms,
+            'delay_ms': self.delay_ms,
+            'remaining_ms': dict(self._remaining),
+            'running': self.running,
+            'elapsed_ms': self.elapsed(),
+            'saved_at': time.time(),
+        }
+
+    @classmethod
+    def from_dict(cls, state, charge_since_saved=True):
+        """Rebuild a clock from to_dict() output.
+
+        By default the running side is also charged for the time since the
+        state was saved. Pass charge_since_saved=False to resume from the
+        moment of saving instead, e.g. after a server restart.
+        """
+        clock = cls(state['initial_ms'], state['increment_ms'], state['delay_ms'])
+        clock._remaining = dict(state['remaining_ms'])
+        if state['running'] is not None:
+            since_saved = 0
+            if charge_since_saved:
+                since_saved = max(0, int((time.time() - state['saved_at']) * 1000))
+            clock.running = state['running']
+            clock._turn_start = monotonic_ms() - state['elapsed_ms'] - since_saved
+        return clock
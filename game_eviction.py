@@ -0,0 +1,166 @@
+"""Evict idle games so a long-running server stays bounded.
+
+Every game is tracked in an expiry index: a DeadlineScheduler keyed by game
+code, with the deadline at last activity + the TTL for the game's phase.
+Handlers re-track a game whenever they touch it, so the index stays
+ordered by when each game will next be due for eviction.
+
+    GAME_TTL_WAITING    seconds idle before a game nobody started is dropped (1800)
+    GAME_TTL_PLAYING    seconds idle for a game in progress (7200)
+    GAME_TTL_FINISHED   seconds a finished game is kept for rematches (600)
+    GAME_TTL_ABANDONED  seconds once no player is connected (300)
+    MAX_GAMES           hard cap on tracked games; beyond it the games
+                        closest to expiry are evicted first (10000)
+    GAME_ARCHIVE_DIR    if set, evicted games are written there first
+"""
+import os
+import sys
+import threading
+import time
+
+from deadline_scheduler import DeadlineScheduler
+from game_store import encode_game
+
+PHASES = ('waiting', 'playing', 'finished', 'abandoned')
+
+DEFAULT_TTLS = {
+    'waiting': float(os.environ.get('GAME_TTL_WAITING', 1800)),
+    'playing': float(os.environ.get('GAME_TTL_PLAYING', 7200)),
+    'finished': float(os.environ.get('GAME_TTL_FINISHED', 600)),
+    'abandoned': float(os.environ.get('GAME_TTL_ABANDONED', 300)),
+}
+MAX_GAMES = int(os.environ.get('MAX_GAMES', 10000))
+ARCHIVE_DIR = os.environ.get('GAME_ARCHIVE_DIR')
+
+
+def game_phase(game):
+    """Which TTL applies to a game"""
+    if game['players'] and all(p['sid'] is None for p in game['players'].values()):
+        return 'abandoned'
+    if game['game_over']:
+        return 'finished'
+    if game['game_started']:
+        return 'playing'
+    return 'waiting'
+
+
+def process_memory():
+    """Current and peak resident set size of this process in bytes, where available"""
+    memory = {}
+    try:
+        with open('/proc/self/statm') as statm:
+            memory['rss_bytes'] = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        memory['peak_rss_bytes'] = peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    return memory
+
+
+class DirectoryArchive:
+    """Writes each evicted game to <directory>/<code>-<unix time>.game"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, game_code, game):
+        path = os.path.join(self.directory, f'{game_code}-{int(time.time())}.game')
+        with open(path + '.tmp', 'wb') as archive_file:
+            archive_file.write(encode_game(game))
+        os.replace(path + '.tmp', path)
+
+
+class GameEvictor:
+    """Removes games from a store once they outlive the TTL for their phase"""
+
+    def __init__(self, socketio, games, ttls=None, max_games=MAX_GAMES, archive=None, on_evict=None):
+        self.games = games
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_games = max_games
+        self.archive = archive
+        self.on_evict = on_evict
+        self.evicted = {f'ttl_{phase}': 0 for phase in PHASES}
+        self.evicted['cap'] = 0
+        self.archived = 0
+        self.archive_errors = 0
+        self._stats_lock = threading.Lock()
+        self._index = DeadlineScheduler(socketio, self._expire)
+
+    def start(self):
+        self._index.start()
+
+    def track(self, game_code, game):
+        """(Re)index a game after it was created or touched. Call with the game's lock held"""
+        ttl = self.ttls[game_phase(game)]
+        idle = time.time() - game['last_activity']
+        self._index.schedule_in(game_code, ttl - idle)
+
+    def forget(self, game_code):
+        self._index.cancel(game_code)
+
+    def __len__(self):
+        return len(self._index)
+
+    def enforce_cap(self):
+        """Evict the games closest to expiry until at most max_games are tracked.
+
+        Takes other games' locks, so call it without holding any game's lock.
+        """
+        while len(self._index) > self.max_games:
+            game_code = self._index.pop_next()
+            if game_code is None:
+                return
+            game = self.games.remove(game_code)
+            if game is not None:
+                self._evicted(game_code, game, 'cap')
+
+    def _expire(self, game_code):
+        reason = []
+
+        def expired(game):
+            phase = game_phase(game)
+            idle = time.time() - game['last_activity']
+            if idle >= self.ttls[phase]:
+                reason.append(phase)
+                return True
+            # Touched without being re-tracked, or its phase changed; look again later
+            self._index.schedule_in(game_code, self.ttls[phase] - idle)
+            return False
+
+        game = self.games.remove_if(game_code, expired)
+        if game is not None:
+            self._evicted(game_code, game, f'ttl_{reason[0]}')
+
+    def _evicted(self, game_code, game, reason):
+        with self._stats_lock:
+            self.evicted[reason] += 1
+        if self.on_evict is not None:
+            self.on_evict(game_code)
+        if self.archive is not None:
+            try:
+                self.archive(game_code, game)
+            except Exception:
+                with self._stats_lock:
+                    self.archive_errors += 1
+            else:
+                with self._stats_lock:
+                    self.archived += 1
+
+    def stats(self):
+        """Eviction counters, index size and process memory"""
+        with self._stats_lock:
+            return {
+                'tracked_games': len(self._index),
+                'max_games': self.max_games,
+                'ttls': dict(self.ttls),
+                'evicted': dict(self.evicted),
+                'archived': self.archived,
+                'archive_errors': self.archive_errors,
+                'memory': process_memory(),
+            }
@@ -0,0 +1,191 @@
+"""Thread-safe storage for games and player sessions.
+
+Keys are spread over shards by a stable hash, and each shard has its own
+lock, which is only held for the dict operation itself. Every game also has
+its own lock, taken with GameRegistry.locked(), so a move, a timeout and a
+cleanup on the same game run one after another while handlers for
+different games never wait on each other.
+
+These are threading locks: under eventlet they only exclude green threads
+from each other once the standard library is monkey patched, which app.py
+does before its other imports.
+"""
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+
+DEFAULT_SHARDS = int(os.environ.get('GAME_REGISTRY_SHARDS', 64))
+
+
+def shard_of(key, shard_count):
+    """Shard index for a key, the same in every process"""
+    return zlib.crc32(str(key).encode()) % shard_count
+
+
+class ShardedDict:
+    """A dict split over independently locked shards"""
+
+    def __init__(self, shard_count=DEFAULT_SHARDS):
+        self.shard_count = shard_count
+        self._shards = [{} for _ in range(shard_count)]
+        self._locks = [threading.Lock() for _ in range(shard_count)]
+
+    def _shard(self, key):
+        index = shard_of(key, self.shard_count)
+        return self._shards[index], self._locks[index]
+
+    def get(self, key, default=None):
+        shard, lock = self._shard(key)
+        with lock:
+            return shard.get(key, default)
+
+    def __getitem__(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            return shard[key]
+
+    def __setitem__(self, key, value):
+        shard, lock = self._shard(key)
+        with lock:
+            shard[key] = value
+
+    def __delitem__(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            del shard[key]
+
+    def __contains__(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            return key in shard
+
+    def pop(self, key, default=None):
+        shard, lock = self._shard(key)
+        with lock:
+            return shard.pop(key, default)
+
+    def setdefault(self, key, value):
+        """Store value unless key is present; return whichever value is stored"""
+        shard, lock = self._shard(key)
+        with lock:
+            return shard.setdefault(key, value)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def items(self):
+        """A snapshot of (key, value) pairs, one shard at a time"""
+        items = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                items.extend(shard.items())
+        return items
+
+
+class _Entry:
+    __slots__ = ('game', 'lock')
+
+    def __init__(self, game):
+        self.game = game
+        self.lock = threading.RLock()
+
+
+class GameRegistry:
+    """Games by code, each with a lock that serializes everything done to it.
+
+    fallback, if set, holds games not loaded yet, such as those in a
+    snapshot from before a restart. It needs `code in fallback` and
+    fallback.take(code), which returns the game once and then forgets it.
+    A game is moved into memory the first time its code is used, and
+    on_load(code, game), if set, is then called holding the game's lock,
+    e.g. to re-arm its timers before anyone else can use it.
+    """
+
+    def __init__(self, shard_count=DEFAULT_SHARDS, fallback=None, on_load=None):
+        self._entries = ShardedDict(shard_count)
+        self.fallback = fallback
+        self.on_load = on_load
+        self._load_lock = threading.Lock()
+
+    def _entry(self, code):
+        entry = self._entries.get(code)
+        if entry is None and self.fallback is not None:
+            loaded = None
+            # One loader at a time, so a game is never taken twice
+            with self._load_lock:
+                entry = self._entries.get(code)
+                if entry is None:
+                    game = self.fallback.take(code)
+                    if game is not None:
+                        loaded = _Entry(game)
+                        loaded.lock.acquire()
+                        entry = self._entries.setdefault(code, loaded)
+                        if entry is not loaded:
+                            loaded.lock.release()
+                            loaded = None
+            if loaded is not None:
+                try:
+                    if self.on_load is not None:
+                        self.on_load(code, loaded.game)
+                finally:
+                    loaded.lock.release()
+        return entry
+
+    def add(self, code, game):
+        """Store a new game; returns False if the code is already taken"""
+        if self.fallback is not None and code in self.fallback:
+            return False
+        entry = _Entry(game)
+        return self._entries.setdefault(code, entry) is entry
+
+    def create(self, make_code, game):
+        """Store a game under the first unused code from make_code() and return the code"""
+        code = make_code()
+        while not self.add(code, game):
+            code = make_code()
+        return code
+
+    def get(self, code):
+        """The game for a code, or None. Mutate it only inside locked()"""
+        entry = self._entry(code)
+        return entry.game if entry else None
+
+    def __contains__(self, code):
+        return code in self._entries or (self.fallback is not None and code in self.fallback)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        """Games in memory; games still in the fallback are not included"""
+        return [(code, entry.game) for code, entry in self._entries.items()]
+
+    @contextmanager
+    def locked(self, code):
+        """Hold the game's lock and yield the game, or None if there is no such game"""
+        entry = self._entry(code)
+        if entry is None:
+            yield None
+            return
+        with entry.lock:
+            # The game may have been removed while this caller waited
+            yield entry.game if self._entries.get(code) is entry else None
+
+    def remove(self, code):
+        """Remove a game, waiting for whoever holds its lock; returns the game or None"""
+        with self.locked(code) as game:
+            if game is not None:
+                self._entries.pop(code)
+            return game
+
+    def remove_if(self, code, predicate):
+        """Remove a game if predicate(game) holds, checked under the game's lock"""
+        with self.locked(code) as game:
+            if game is not None and predicate(game):
+                self._entries.pop(code)
+                return game
+        return None
@@ -0,0 +1,55 @@
+"""Game codes that name the worker owning the game.
+
+In a multi-worker deployment every app.py process is started with:
+
+    WORKER_ID     this worker's index, 0 .. WORKER_COUNT - 1
+    WORKER_COUNT  number of workers (at most 36)
+    WORKER_URLS   optional comma-separated base URLs, one per worker in
+                  order, used to redirect clients that reach the wrong one
+
+The first character of a code is the owning worker's index in
+CODE_ALPHABET. So any process, and the router in router.py, can map a
+code to its worker without asking a shared store.
+"""
+import os
+import random
+import string
+import zlib
+
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+CODE_LENGTH = 6
+
+WORKER_ID = int(os.environ.get('WORKER_ID', 0))
+WORKER_COUNT = int(os.environ.get('WORKER_COUNT', 1))
+WORKER_URLS = [url.rstrip('/') for url in os.environ.get('WORKER_URLS', '').split(',') if url]
+
+if not 0 < WORKER_COUNT <= len(CODE_ALPHABET) or not 0 <= WORKER_ID < WORKER_COUNT:
+    raise ValueError(f'WORKER_ID={WORKER_ID} and WORKER_COUNT={WORKER_COUNT} must satisfy '
+                     f'0 <= WORKER_ID < WORKER_COUNT <= {len(CODE_ALPHABET)}')
+
+
+def generate_game_code(worker_id=WORKER_ID):
+    """A random code whose first character names the owning worker"""
+    return CODE_ALPHABET[worker_id] + ''.join(random.choices(CODE_ALPHABET, k=CODE_LENGTH - 1))
+
+
+def worker_for_code(game_code, worker_count=WORKER_COUNT):
+    """Index of the worker that owns a game code"""
+    index = CODE_ALPHABET.find(game_code[:1].upper())
+    if index < 0:
+        # Not a code we issued; still route it somewhere stable
+        return zlib.crc32(game_code.encode()) % worker_count
+    return index % worker_count
+
+
+def worker_for_client(address, worker_count=WORKER_COUNT):
+    """Sticky worker for requests that carry no game code, by client address"""
+    return zlib.crc32(address.encode()) % worker_count
+
+
+def owner_url(game_code):
+    """Base URL of the worker owning game_code, or None if it is this worker or unknown"""
+    worker = worker_for_code(game_code)
+    if worker == WORKER_ID or worker >= len(WORKER_URLS):
+        return None
+    return WORKER_URLS[worker]
@@ -0,0 +1,369 @@
+"""Pluggable storage for game state.
+
+GAME_STORE_URL picks the backend:
+
+    (unset)                     GameRegistry, games live in this process
+    redis://[:password@]host[:port][/db]
+                                RedisGameStore, shared by every worker
+
+Both backends have the same interface, so handlers always write
+
+    with games.locked(game_code) as game:
+        ...
+
+For Redis, locked() takes a lock key, loads that one game, and saves it
+back when the block exits normally. So a move reads and writes only its
+own game's state.
+"""
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import unquote, urlparse
+
+from bitboard import COLOR_INDEX, PIECE_INDEX, piece_code
+from game_clock import GameClock
+from game_registry import GameRegistry
+from online_chess_board import CELLS, OnlineChessBoard
+
+# Version byte, then the lengths of the metadata JSON, the board, and the
+# last broadcast's packed board and legal move pairs
+_GAME_HEADER = struct.Struct('<BIIII')
+_GAME_VERSION = 1
+
+
+def _cell_code(cell):
+    if cell['piece_type'] is None:
+        return 0
+    return piece_code(COLOR_INDEX[cell['color']], PIECE_INDEX[cell['piece_type']])
+
+
+def encode_game(game):
+    """Serialize a game dict to bytes.
+
+    The board is stored with OnlineChessBoard.to_bytes() and the clock with
+    GameClock.to_dict(). The last broadcast state, which deltas are
+    computed against, keeps its board as 32 packed bytes and its legal
+    moves as square pairs. Everything else is JSON.
+    """
+    meta = {key: value for key, value in game.items() if key not in ('board', 'clock', 'last_state')}
+    meta['clock'] = game['clock'].to_dict()
+    last_board = last_moves = b''
+    last_state = game['last_state']
+    if last_state is None:
+        meta['last_state'] = None
+    else:
+        meta['last_state'] = {key: value for key, value in last_state.items()
+                              if key not in ('board_state', 'legal_moves')}
+        codes = [_cell_code(cell) for row in last_state['board_state'] for cell in row]
+        last_board = bytes(codes[sq] | (codes[sq + 1] << 4) for sq in range(0, 64, 2))
+        moves = last_state['legal_moves']
+        meta['last_state_has_moves'] = moves is not None
+        if moves is not None:
+            last_moves = bytes(value for from_row, from_col, to_row, to_col in moves
+                               for value in (from_row * 8 + from_col, to_row * 8 + to_col))
+    meta_json = json.dumps(meta, separators=(',', ':')).encode()
+    board = game['board'].to_bytes()
+    header = _GAME_HEADER.pack(_GAME_VERSION, len(meta_json), len(board), len(last_board), len(last_moves))
+    return b''.join((header, meta_json, board, last_board, last_moves))
+
+
+def decode_game(data, charge_since_saved=True):
+    """Rebuild a game dict written by encode_game(); see GameClock.from_dict()"""
+    version, meta_size, board_size, last_board_size, last_moves_size = _GAME_HEADER.unpack_from(data)
+    if version != _GAME_VERSION:
+        raise ValueError(f'unsupported game encoding version {version}')
+    offset = _GAME_HEADER.size
+    meta = json.loads(data[offset:offset + meta_size])
+    offset += meta_size
+    board = OnlineChessBoard.from_bytes(data[offset:offset + board_size])
+    offset += board_size
+    last_board = data[offset:offset + last_board_size]
+    offset += last_board_size
+    last_moves = data[offset:offset + last_moves_size]
+
+    game = meta
+    game['board'] = board
+    game['clock'] = GameClock.from_dict(meta['clock'], charge_since_saved)
+    has_moves = game.pop('last_state_has_moves', False)
+    last_state = game['last_state']
+    if last_state is not None:
+        codes = [code for byte in last_board for code in (byte & 15, byte >> 4)]
+        last_state['board_state'] = [[CELLS[code] for code in codes[row:row + 8]] for row in range(0, 64, 8)]
+        last_state['legal_moves'] = [
+            [last_moves[i] >> 3, last_moves[i] & 7, last_moves[i + 1] >> 3, last_moves[i + 1] & 7]
+            for i in range(0, len(last_moves), 2)
+        ] if has_moves else None
+    return game
+
+
+class RespError(Exception):
+    """An error reply from the server"""
+
+
+class LockLost(Exception):
+    """A game's lock expired before its block finished, so the changes were not saved"""
+
+
+class RespClient:
+    """Minimal client for the Redis serialization protocol (RESP2).
+
+    Each thread (or green thread, once monkey patched) gets its own
+    connection, so calls never interleave on a socket.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @classmethod
+    def from_url(cls, url):
+        parsed = urlparse(url)
+        db = int(parsed.path.lstrip('/') or 0)
+        password = unquote(parsed.password) if parsed.password else None
+        return cls(parsed.hostname or 'localhost', parsed.port or 6379, db, password)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = self._local.connection = (sock, sock.makefile('rb'))
+            if self.password:
+                self.execute('AUTH', self.password)
+            if self.db:
+                self.execute('SELECT', self.db)
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self._local.connection = None
+            connection[1].close()
+            connection[0].close()
+
+    def execute(self, *args):
+        """Send one command and return its reply"""
+        sock, reader = self._connection()
+        try:
+            sock.sendall(encode_command(args))
+            return read_reply(reader)
+        except (OSError, EOFError):
+            # Drop a broken connection so the next call reconnects
+            self.close()
+            raise
+
+    def get(self, key):
+        return self.execute('GET', key)
+
+    def set(self, key, value, nx=False, xx=False, px=None):
+        """SET with optional NX/XX and expiry; True if the value was written"""
+        args = ['SET', key, value]
+        if nx:
+            args.append('NX')
+        if xx:
+            args.append('XX')
+        if px is not None:
+            args.extend(('PX', px))
+        return self.execute(*args) is not None
+
+    def delete(self, *keys):
+        return self.execute('DEL', *keys)
+
+    def exists(self, key):
+        return self.execute('EXISTS', key) > 0
+
+    def eval(self, script, keys=(), args=()):
+        return self.execute('EVAL', script, len(keys), *keys, *args)
+
+    def scan_iter(self, match=None, count=500):
+        cursor = b'0'
+        while True:
+            args = ['SCAN', cursor]
+            if match:
+                args.extend(('MATCH', match))
+            args.extend(('COUNT', count))
+            cursor, keys = self.execute(*args)
+            yield from keys
+            if cursor == b'0':
+                return
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    return str(value).encode()
+
+
+def encode_command(args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        arg = _to_bytes(arg)
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def read_reply(reader):
+    line = reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise EOFError('connection closed')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    if kind == b'-':
+        raise RespError(rest.decode(errors='replace'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        size = int(rest)
+        if size < 0:
+            return None
+        data = reader.read(size + 2)
+        if len(data) != size + 2:
+            raise EOFError('connection closed')
+        return data[:-2]
+    if kind == b'*':
+        count = int(rest)
+        if count < 0:
+            return None
+        return [read_reply(reader) for _ in range(count)]
+    raise RespError(f'unexpected reply {line!r}')
+
+
+# Scripts run atomically on the server. Each one only acts while the lock
+# key (KEYS[1]) still holds our token (ARGV[1]), so a holder whose lock has
+# expired cannot release or overwrite the work of the next one.
+RELEASE_SCRIPT = "if redis.call('get',KEYS[1])==ARGV[1] then return redis.call('del',KEYS[1]) end return 0"
+SAVE_SCRIPT = ("if redis.call('get',KEYS[1])==ARGV[1] then "
+               "redis.call('set',KEYS[2],ARGV[2],'XX') return 1 end return 0")
+DELETE_SCRIPT = "if redis.call('get',KEYS[1])==ARGV[1] then return redis.call('del',KEYS[2]) end return -1"
+
+
+class RedisGameStore:
+    """Games kept in a Redis-compatible server, one key per game.
+
+    locked() holds a per-game lock key (SET NX PX) for the duration of the
+    block, so a move handled by one worker and a timeout fired by another
+    still run one after the other. The lock expires after lock_ttl_ms in
+    case its holder dies; a block that outlives it raises LockLost instead
+    of saving over whoever took the lock next.
+    """
+
+    def __init__(self, client, prefix='chess:', lock_ttl_ms=5000, lock_wait=5.0):
+        self.client = client
+        self.prefix = prefix
+        self.lock_ttl_ms = lock_ttl_ms
+        self.lock_wait = lock_wait
+
+    def _game_key(self, code):
+        return f'{self.prefix}game:{code}'
+
+    def _lock_key(self, code):
+        return f'{self.prefix}lock:{code}'
+
+    def add(self, code, game):
+        """Store a new game; returns False if the code is already taken"""
+        return self.client.set(self._game_key(code), encode_game(game), nx=True)
+
+    def create(self, make_code, game):
+        """Store a game under the first unused code from make_code() and return the code"""
+        code = make_code()
+        while not self.add(code, game):
+            code = make_code()
+        return code
+
+    def get(self, code):
+        """A detached copy of the game, or None. Changes to it are not saved"""
+        data = self.client.get(self._game_key(code))
+        return decode_game(data) if data is not None else None
+
+    def __contains__(self, code):
+        return self.client.exists(self._game_key(code))
+
+    def codes(self):
+        start = len(self._game_key(''))
+        return [key[start:].decode() for key in self.client.scan_iter(self._game_key('*'))]
+
+    def __len__(self):
+        return len(self.codes())
+
+    def items(self):
+        items = []
+        for code in self.codes():
+            game = self.get(code)
+            if game is not None:
+                items.append((code, game))
+        return items
+
+    def _acquire(self, code):
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_wait
+        pause = 0.001
+        while not self.client.set(self._lock_key(code), token, nx=True, px=self.lock_ttl_ms):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'game {code} is locked')
+            # A green sleep once app.py has monkey patched, so waiting doesn't stall the hub
+            time.sleep(pause)
+            pause = min(pause * 2, 0.05)
+        return token
+
+    def _release(self, code, token):
+        self.client.eval(RELEASE_SCRIPT, (self._lock_key(code),), (token,))
+
+    @contextmanager
+    def locked(self, code):
+        """Hold the game's lock and yield the loaded game, saving it if the block succeeds"""
+        token = self._acquire(code)
+        try:
+            data = self.client.get(self._game_key(code))
+            if data is None:
+                yield None
+                return
+            game = decode_game(data)
+            yield game
+            keys = (self._lock_key(code), self._game_key(code))
+            if not self.client.eval(SAVE_SCRIPT, keys, (token, encode_game(game))):
+                raise LockLost(f'lock on game {code} expired after {self.lock_ttl_ms} ms')
+        finally:
+            self._release(code, token)
+
+    def remove(self, code):
+        return self.remove_if(code, lambda game: True)
+
+    def remove_if(self, code, predicate):
+        """Remove a game if predicate(game) holds, checked under the game's lock"""
+        token = self._acquire(code)
+        try:
+            data = self.client.get(self._game_key(code))
+            if data is None:
+                return None
+            game = decode_game(data)
+            if not predicate(game):
+                return None
+            keys = (self._lock_key(code), self._game_key(code))
+            if self.client.eval(DELETE_SCRIPT, keys, (token,)) < 0:
+                raise LockLost(f'lock on game {code} expired after {self.lock_ttl_ms} ms')
+            return game
+        finally:
+            self._release(code, token)
+
+
+def open_game_store(url=None):
+    """The store named by url (default: GAME_STORE_URL), in-process if unset"""
+    url = url if url is not None else os.environ.get('GAME_STORE_URL', '')
+    if not url or url == 'memory://':
+        return GameRegistry()
+    scheme = urlparse(url).scheme
+    if scheme == 'redis':
+        return RedisGameStore(RespClient.from_url(url))
+    raise ValueError(f'unsupported GAME_STORE_URL scheme {scheme!r}')
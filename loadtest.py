@@ -0,0 +1,353 @@
+"""Load generator that drives app.py's Socket.IO handlers in-process.
+
+Each simulated game is two Flask-SocketIO test clients that go through
+create_game, join_game and player_ready, then play a random legal game
+(picked from the legal moves in the state broadcasts, as the browser
+does) or the games of a PGN file. Before each move the mover clicks the
+piece with get_valid_moves. --concurrency games are live at once and are
+stepped round robin, one move each, by --threads threads.
+
+Reported: moves per second, p50/p99 latency per handler, the time spent
+in each state broadcast and messages delivered per move, and with
+--memory the server-side bytes held per live game.
+
+    python loadtest.py --games 2000 --concurrency 500
+    python loadtest.py --pgn games.pgn --concurrency 100 --json results.json
+    python loadtest.py --computer 5      # games against the bot, exit 1 if it stalls
+
+Server settings come from the usual environment variables, e.g. MAX_GAMES
+must be at least --concurrency.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+# In the --memory phase an allocation is server memory when the innermost
+# frame of its stack that is either a module of this repository or part of
+# the simulated clients is a repository module. Library code called from
+# the server, such as json or the Socket.IO room bookkeeping, counts too.
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+CLIENT_FILES = ('loadtest.py', 'test_client.py')
+MEMORY_FRAMES = 25
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Recorder:
+    """Latency samples by name, safe to share between threads"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def timed(self, name, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def summary(self):
+        """p50, p99, max and mean in milliseconds, and call counts, per name"""
+        summary = {}
+        for name, values in sorted(self.samples.items()):
+            summary[name] = {
+                'calls': len(values),
+                'p50_ms': percentile(values, 0.50) * 1000,
+                'p99_ms': percentile(values, 0.99) * 1000,
+                'max_ms': max(values) * 1000,
+                'mean_ms': sum(values) / len(values) * 1000,
+            }
+        return summary
+
+
+class SimulatedGame:
+    """Two test clients playing one game through the real handlers"""
+
+    def __init__(self, socketio, app, recorder, rng, script=None, max_plies=200):
+        self.recorder = recorder
+        self.rng = rng
+        self.script = script
+        self.max_plies = max_plies
+        self.clients = {'white': socketio.test_client(app), 'black': socketio.test_client(app)}
+        self.legal_moves = []
+        self.turn = 'white'
+        self.plies = 0
+        self.over = False
+        self.board = None
+
+    def _emit(self, color, event, *args):
+        self.recorder.timed(event, self.clients[color].emit, event, *args)
+
+    def _drain(self):
+        """Read what both clients received, tracking the side to move and its legal moves"""
+        for client in self.clients.values():
+            for message in client.get_received():
+                self.recorder.count('messages_delivered')
+                name = message['name']
+                if name == 'invalid_move':
+                    self.recorder.count('invalid_moves')
+                elif name in ('game_started', 'move_made') and message['args']:
+                    state = message['args'][0]
+                    self.turn = state.get('current_player', self.turn)
+                    if state.get('legal_moves') is not None:
+                        self.legal_moves = state['legal_moves']
+                    if state.get('game_over'):
+                        self.over = True
+                elif name == 'game_created':
+                    self.code = message['args'][0]['game_code']
+
+    def start(self):
+        self.code = None
+        self._emit('white', 'create_game', {'timer': 600})
+        self._drain()
+        self._emit('black', 'join_game', {'game_code': self.code})
+        self._emit('white', 'player_ready', {})
+        self._emit('black', 'player_ready', {})
+        self._drain()
+        if self.script is not None:
+            from online_chess_board import OnlineChessBoard
+            self.board = OnlineChessBoard()
+
+    def _next_move(self):
+        if self.script is not None:
+            from pgn import parse_san
+            if self.plies >= len(self.script):
+                return None
+            move = parse_san(self.board, self.script[self.plies])
+            if move is None:
+                return None
+            self.board.push(move)
+            (from_row, from_col), (to_row, to_col) = move
+            return [from_row, from_col], [to_row, to_col]
+        if not self.legal_moves:
+            return None
+        from_row, from_col, to_row, to_col = self.rng.choice(self.legal_moves)
+        return [from_row, from_col], [to_row, to_col]
+
+    def step(self):
+        """Play one move; returns False once the game is finished"""
+        move = None if self.over or self.plies >= self.max_plies else self._next_move()
+        if move is None:
+            return False
+        from_pos, to_pos = move
+        self._emit(self.turn, 'get_valid_moves', {'position': from_pos})
+        self._emit(self.turn, 'make_move', {'from': from_pos, 'to': to_pos})
+        self.plies += 1
+        self.recorder.count('moves')
+        self._drain()
+        return True
+
+    def close(self):
+        for client in self.clients.values():
+            self.recorder.timed('disconnect', client.disconnect)
+
+
+def run_games(socketio, app, recorder, total, concurrency, seed, scripts, max_plies):
+    """Play total games with up to concurrency live at once, stepping them round robin"""
+    rng = random.Random(seed)
+    started = 0
+    live = []
+    while live or started < total:
+        while len(live) < concurrency and started < total:
+            script = scripts[started % len(scripts)] if scripts else None
+            game = SimulatedGame(socketio, app, recorder, rng, script, max_plies)
+            game.start()
+            live.append(game)
+            started += 1
+        still_live = []
+        for game in live:
+            if game.step():
+                still_live.append(game)
+            else:
+                game.close()
+                recorder.count('games_finished')
+        live = still_live
+
+
+def is_server_allocation(traceback):
+    """Whether a tracemalloc traceback belongs to the server rather than the clients"""
+    for frame in reversed(traceback):
+        if os.path.basename(frame.filename) in CLIENT_FILES:
+            return False
+        if os.path.dirname(os.path.abspath(frame.filename)) == SERVER_DIR:
+            return True
+    return False
+
+
+def play_computer(socketio, app, recorder, rng, difficulty, max_plies, timeout):
+    """Play random moves as white against the computer; returns an error message, or None.
+
+    Waits with socketio.sleep(), so under eventlet the searches run while
+    this waits, as they would between a browser's moves.
+    """
+    client = socketio.test_client(app)
+    client.emit('create_game', {'timer': 600, 'opponent': 'computer', 'difficulty': difficulty})
+    client.emit('player_ready', {})
+    state = {}
+    waiting_since = time.perf_counter()
+    plies = 0
+    try:
+        while plies < max_plies:
+            for message in client.get_received():
+                if message['name'] in ('game_started', 'move_made') and message['args']:
+                    state.update(message['args'][0])
+            if state.get('game_over'):
+                return None
+            if state.get('current_player') != 'white' or not state.get('legal_moves'):
+                if time.perf_counter() - waiting_since > timeout:
+                    return f'the computer did not answer within {timeout} s at ply {plies}'
+                socketio.sleep(0.005)
+                continue
+            if plies:
+                recorder.add('computer_move', time.perf_counter() - waiting_since)
+            from_row, from_col, to_row, to_col = rng.choice(state['legal_moves'])
+            state['current_player'] = None
+            waiting_since = time.perf_counter()
+            client.emit('make_move', {'from': [from_row, from_col], 'to': [to_row, to_col]})
+            plies += 2
+            recorder.count('moves')
+        return None
+    finally:
+        client.disconnect()
+
+
+def measure_memory(socketio, app, games, plies, seed):
+    """Server-side bytes allocated and still held per live game after some moves"""
+    recorder = Recorder()
+    rng = random.Random(seed)
+    tracemalloc.start(MEMORY_FRAMES)
+    before = tracemalloc.take_snapshot()
+    live = []
+    for _ in range(games):
+        game = SimulatedGame(socketio, app, recorder, rng)
+        game.start()
+        live.append(game)
+    for _ in range(plies):
+        for game in live:
+            game.step()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    held = 0
+    for stat in after.compare_to(before, 'traceback'):
+        if is_server_allocation(stat.traceback):
+            held += stat.size_diff
+    for game in live:
+        game.close()
+    return held / games
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=1000, help='games to play in total')
+    parser.add_argument('--concurrency', type=int, default=200, help='games live at the same time')
+    parser.add_argument('--threads', type=int, default=1, help='threads, each running its share of games')
+    parser.add_argument('--max-plies', type=int, default=200)
+    parser.add_argument('--pgn', help='replay the games in this PGN file instead of random ones')
+    parser.add_argument('--memory', type=int, metavar='GAMES', default=0,
+                        help='also measure server memory per game with this many live games')
+    parser.add_argument('--computer', type=int, metavar='GAMES', default=0,
+                        help='instead play this many games one after another against the computer, '
+                             'failing if it stops answering')
+    parser.add_argument('--difficulty', default='easy', help='computer level for --computer')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    import app as server
+    recorder = Recorder()
+    if args.computer:
+        rng = random.Random(args.seed)
+        for _ in range(args.computer):
+            error = play_computer(server.socketio, server.app, recorder, rng, args.difficulty, args.max_plies, 10.0)
+            if error:
+                print(error)
+                return 1
+        stats = recorder.summary().get('computer_move')
+        print(f"{args.computer} games, {recorder.counters['moves']} moves against the computer "
+              f"({server.socketio.async_mode} mode)")
+        if stats:
+            print(f"  computer_move {stats['calls']:>8} calls  p50 {stats['p50_ms']:7.3f} ms  "
+                  f"p99 {stats['p99_ms']:7.3f} ms  max {stats['max_ms']:8.3f} ms")
+        return 0
+    # Time every state broadcast; handlers look broadcast_state up at call time
+    broadcast_state = server.broadcast_state
+
+    def timed_broadcast(*broadcast_args):
+        recorder.timed('broadcast', broadcast_state, *broadcast_args)
+
+    server.broadcast_state = timed_broadcast
+
+    scripts = None
+    if args.pgn:
+        from pgn import read_pgn
+        with open(args.pgn) as pgn_file:
+            scripts = [moves for tags, moves, result in read_pgn(pgn_file) if 'FEN' not in tags]
+
+    start = time.perf_counter()
+    threads = []
+    for index in range(args.threads):
+        share = args.games // args.threads + (index < args.games % args.threads)
+        thread = threading.Thread(target=run_games, args=(
+            server.socketio, server.app, recorder, share, max(1, args.concurrency // args.threads),
+            args.seed + index, scripts, args.max_plies))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    server.broadcast_state = broadcast_state
+
+    latency = recorder.summary()
+    moves = recorder.counters['moves']
+    results = {
+        'games': recorder.counters['games_finished'],
+        'concurrency': args.concurrency,
+        'threads': args.threads,
+        'moves': moves,
+        'seconds': seconds,
+        'moves_per_second': moves / seconds,
+        'invalid_moves': recorder.counters['invalid_moves'],
+        'messages_per_move': recorder.counters['messages_delivered'] / moves if moves else None,
+        'latency': latency,
+    }
+    if args.memory:
+        results['server_bytes_per_game'] = measure_memory(server.socketio, server.app, args.memory, 20, args.seed)
+
+    print(f"{results['games']} games, {moves} moves in {seconds:.1f} s: {results['moves_per_second']:,.0f} moves/s "
+          f"({args.concurrency} live games, {args.threads} thread(s))")
+    print(f"invalid moves: {results['invalid_moves']}, messages delivered per move: "
+          f"{results['messages_per_move'] or 0:.2f}")
+    for name, stats in latency.items():
+        print(f"  {name:<16} {stats['calls']:>8} calls  p50 {stats['p50_ms']:7.3f} ms  "
+              f"p99 {stats['p99_ms']:7.3f} ms  max {stats['max_ms']:8.3f} ms")
+    if args.memory:
+        print(f"server memory per live game: {results['server_bytes_per_game']:,.0f} bytes")
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
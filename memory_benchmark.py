@@ -0,0 +1,75 @@
+"""Measure the memory held by each OnlineChessBoard.
+
+Boards are measured fresh and after a random game prefix with their
+broadcast state cached, which is what an idle game in the games dict holds.
+
+    python memory_benchmark.py --boards 2000 --plies 40
+"""
+import argparse
+import gc
+import random
+import sys
+import tracemalloc
+
+from online_chess_board import OnlineChessBoard
+
+
+def play_random(board, plies, rng):
+    color = 'white'
+    for _ in range(plies):
+        moves = board.get_all_valid_moves(color)
+        if not moves:
+            break
+        (from_row, from_col), (to_row, to_col) = rng.choice(moves)
+        board.make_move(from_row, from_col, to_row, to_col)
+        color = 'black' if color == 'white' else 'white'
+    return color
+
+
+def bytes_per_board(count, plies, seed):
+    """Average bytes allocated and still held per board"""
+    rng = random.Random(seed)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    boards = []
+    for _ in range(count):
+        board = OnlineChessBoard()
+        if plies:
+            color = play_random(board, plies, rng)
+            # An idle game keeps the state and move list of its last broadcast
+            board.get_board_state()
+            board.get_all_valid_moves(color)
+        boards.append(board)
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return held / count
+
+
+def copy_bytes(count):
+    board = OnlineChessBoard()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    copies = [board.copy() for _ in range(count)]
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del copies
+    return held / count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--boards', type=int, default=2000)
+    parser.add_argument('--plies', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    print(f'fresh board:          {bytes_per_board(args.boards, 0, args.seed):8.0f} bytes')
+    print(f'after {args.plies:>3} plies:      {bytes_per_board(args.boards, args.plies, args.seed):8.0f} bytes')
+    print(f'copy():               {copy_bytes(args.boards):8.0f} bytes')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""Per-process LRU cache of legal move lists.
+
+Entries are keyed by (zobrist key, square), so the same position reached in
+different games, or queried by both players, shares one entry.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAXSIZE = int(os.environ.get('VALID_MOVES_CACHE_SIZE', 50000))
+
+
+class LRUCache:
+    """A bounded mapping that evicts the least recently used entry"""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value, or None on a miss"""
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store a value, evicting the oldest entry when full"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Size and hit/miss counters"""
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+# Shared by every OnlineChessBoard in this process
+valid_moves_cache = LRUCache()
@@ -0,0 +1,366 @@
+"""Append-only journal of game events, group committed to disk.
+
+Handlers append a record for every game start, accepted move, game end,
+reset and eviction while they hold the game's lock. append() only queues
+the encoded record; a background task writes everything queued in one
+write() and one fsync() per commit window, so the move path never waits
+on the disk and a burst of moves costs a single fsync. Under eventlet the
+write and fsync run on a native thread (see offload.py); gathering the
+batch and advancing committed_lsn stay on the green side.
+
+Each record carries a journal sequence number (LSN), which is also stored
+on the game as game['journal_lsn']. A registry snapshot therefore knows
+which records it already contains: replay skips records at or below a
+game's LSN and applies the rest onto its OnlineChessBoard and clock.
+
+The journal is a directory of segments named by their first LSN. A new
+segment is started on every run and before every snapshot, and segments
+older than the last snapshot are deleted once it is safely written.
+Snapshots are what keep the directory from growing, so app.py always
+takes them when the journal is on; SNAPSHOT_INTERVAL sets how often.
+
+    JOURNAL_DIR        directory for journal segments (unset: no journal)
+    JOURNAL_COMMIT_MS  how long a commit waits to gather more records (2)
+"""
+import atexit
+import os
+import struct
+import threading
+import time
+import traceback
+import uuid
+import zlib
+from collections import namedtuple
+
+from game_clock import COLORS
+from offload import offload
+from online_chess_board import OnlineChessBoard
+
+JOURNAL_DIR = os.environ.get('JOURNAL_DIR')
+JOURNAL_COMMIT_MS = float(os.environ.get('JOURNAL_COMMIT_MS', 2))
+
+# Record kinds
+START, MOVE, END, RESET, DROP = range(1, 6)
+KIND_NAMES = {START: 'start', MOVE: 'move', END: 'end', RESET: 'reset', DROP: 'drop'}
+
+# CRC32 of everything after it, payload size, LSN, kind, game code
+_RECORD_HEADER = struct.Struct('<IHQB8s')
+_PAYLOADS = {
+    # Initial, increment and delay ms, timer seconds, white and black player ids
+    START: struct.Struct('<IIII16s16s'),
+    # Ply after the move, from and to squares, remaining ms for white and black
+    MOVE: struct.Struct('<HBBii'),
+    # Winner (0 white, 1 black, 2 none), remaining ms for white and black
+    END: struct.Struct('<Bii'),
+    RESET: struct.Struct(''),
+    DROP: struct.Struct(''),
+}
+_WINNERS = ('white', 'black', None)
+_SEGMENT_SUFFIX = '.journal'
+
+JournalRecord = namedtuple('JournalRecord', 'lsn kind code fields')
+
+
+def encode_record(lsn, kind, code, *fields):
+    payload = _PAYLOADS[kind].pack(*fields)
+    body = _RECORD_HEADER.pack(0, len(payload), lsn, kind, code.encode())[4:] + payload
+    return struct.pack('<I', zlib.crc32(body)) + body
+
+
+def read_segment(path):
+    """Records in one segment, stopping at the first torn or corrupt record"""
+    with open(path, 'rb') as segment:
+        data = segment.read()
+    offset = 0
+    while offset + _RECORD_HEADER.size <= len(data):
+        crc, size, lsn, kind, code = _RECORD_HEADER.unpack_from(data, offset)
+        end = offset + _RECORD_HEADER.size + size
+        if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc or kind not in _PAYLOADS:
+            return
+        fields = _PAYLOADS[kind].unpack_from(data, offset + _RECORD_HEADER.size)
+        yield JournalRecord(lsn, kind, code.rstrip(b'\0').decode(), fields)
+        offset = end
+
+
+def _clock_fields(game):
+    remaining = game['clock'].remaining_ms()
+    return remaining['white'], remaining['black']
+
+
+def _player_id_bytes(game, color):
+    for player_id, player in game['players'].items():
+        if player['color'] == color:
+            return uuid.UUID(player_id).bytes
+    return bytes(16)
+
+
+def replay(game, record):
+    """Apply one record to a game dict. Returns False if a move does not fit the board"""
+    clock = game['clock']
+    if record.kind == START:
+        initial_ms, increment_ms, delay_ms, timer = record.fields[:4]
+        clock.initial_ms, clock.increment_ms, clock.delay_ms = initial_ms, increment_ms, delay_ms
+        clock.reset()
+        clock.start('white')
+        game['timer'] = timer
+        game['game_started'] = True
+        for player in game['players'].values():
+            player['ready'] = True
+    elif record.kind == MOVE:
+        ply, from_sq, to_sq, white_ms, black_ms = record.fields
+        board = game['board']
+        if board.ply + 1 != ply or not board.make_move(from_sq >> 3, from_sq & 7, to_sq >> 3, to_sq & 7):
+            return False
+        game['current_player'] = board.turn
+        clock.resume({'white': white_ms, 'black': black_ms}, board.turn)
+    elif record.kind == END:
+        winner, white_ms, black_ms = record.fields
+        game['game_over'] = True
+        game['winner'] = _WINNERS[winner]
+        clock.resume({'white': white_ms, 'black': black_ms}, None)
+    elif record.kind == RESET:
+        game['board'] = OnlineChessBoard()
+        game['current_player'] = 'white'
+        game['game_over'] = False
+        game['winner'] = None
+        clock.reset()
+        for player in game['players'].values():
+            player['ready'] = False
+    game['journal_lsn'] = record.lsn
+    return True
+
+
+def start_players(record):
+    """Player entries for a game rebuilt from its START record, waiting to reconnect"""
+    players = {}
+    for color, id_bytes in zip(COLORS, record.fields[4:]):
+        if any(id_bytes):
+            players[str(uuid.UUID(bytes=id_bytes))] = {
+                'sid': None, 'color': color, 'ready': True, 'last_seen': time.time()}
+    return players
+
+
+class MoveJournal:
+    """Group-committed, segmented append-only journal in a directory"""
+
+    def __init__(self, socketio, directory, commit_ms=JOURNAL_COMMIT_MS):
+        self.socketio = socketio
+        self.directory = directory
+        self.commit_interval = commit_ms / 1000
+        os.makedirs(directory, exist_ok=True)
+        self._pending = []
+        self._lock = threading.Lock()     # guards _pending and _next_lsn
+        self._io_lock = threading.Lock()  # one writer of the segment file at a time
+        self._file = None
+        self._segment_lsn = None
+        self._next_lsn = self._last_lsn() + 1
+        # Every record up to this LSN is on disk
+        self.committed_lsn = self._next_lsn - 1
+        self._wakeup = None
+        self._task = None
+        self.records = 0
+        self.commits = 0
+        self.bytes_written = 0
+        self.fsync_ms = 0.0
+        self.max_batch = 0
+        self.recovered = {'records': 0, 'skipped': 0, 'games': 0, 'errors': 0}
+
+    def segments(self):
+        """(first LSN, path) of every segment, oldest first"""
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(_SEGMENT_SUFFIX):
+                try:
+                    first_lsn = int(name[:-len(_SEGMENT_SUFFIX)])
+                except ValueError:
+                    continue
+                segments.append((first_lsn, os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def records_since(self, lsn=0):
+        """Every readable record with an LSN above lsn, in order"""
+        for _, path in self.segments():
+            for record in read_segment(path):
+                if record.lsn > lsn:
+                    yield record
+
+    def _last_lsn(self):
+        last = 0
+        for first_lsn, path in self.segments():
+            last = max(last, first_lsn - 1)
+            for record in read_segment(path):
+                last = max(last, record.lsn)
+        return last
+
+    def _open_segment(self):
+        """Start a new segment at the next LSN. Call with both locks held"""
+        if self._file is not None:
+            self._file.close()
+        self._segment_lsn = self._next_lsn
+        path = os.path.join(self.directory, f'{self._segment_lsn:020d}{_SEGMENT_SUFFIX}')
+        self._file = open(path, 'ab')
+
+    def start(self):
+        """Open this run's segment and start the commit task"""
+        with self._io_lock, self._lock:
+            if self._file is None:
+                self._open_segment()
+        if self._task is None:
+            self._wakeup = self.socketio.server.eio.create_event()
+            self._task = self.socketio.start_background_task(self._run)
+            atexit.register(self.close)
+
+    def append(self, kind, code, *fields):
+        """Queue a record for the next commit and return its LSN"""
+        with self._lock:
+            lsn = self._next_lsn
+            self._next_lsn += 1
+            self._pending.append(encode_record(lsn, kind, code, *fields))
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return lsn
+
+    # Helpers for handlers; call them with the game's lock held
+
+    def log_start(self, game_code, game):
+        clock = game['clock']
+        game['journal_lsn'] = self.append(
+            START, game_code, clock.initial_ms, clock.increment_ms, clock.delay_ms, game['timer'],
+            _player_id_bytes(game, 'white'), _player_id_bytes(game, 'black'))
+
+    def log_move(self, game_code, game, from_pos, to_pos):
+        game['journal_lsn'] = self.append(
+            MOVE, game_code, game['board'].ply, from_pos[0] * 8 + from_pos[1], to_pos[0] * 8 + to_pos[1],
+            *_clock_fields(game))
+
+    def log_end(self, game_code, game):
+        game['journal_lsn'] = self.append(END, game_code, _WINNERS.index(game['winner']), *_clock_fields(game))
+
+    def log_reset(self, game_code, game):
+        game['journal_lsn'] = self.append(RESET, game_code)
+
+    def log_drop(self, game_code):
+        self.append(DROP, game_code)
+
+    @staticmethod
+    def _write_file(segment, data):
+        """Append data and fsync; returns the seconds the fsync took"""
+        segment.write(data)
+        segment.flush()
+        start = time.perf_counter()
+        os.fsync(segment.fileno())
+        return time.perf_counter() - start
+
+    def _write(self, batch, last_lsn):
+        """Write and fsync a batch ending at last_lsn to the current segment. Call with _io_lock held"""
+        data = b''.join(batch)
+        self.fsync_ms += offload(self._write_file, self._file, data) * 1000
+        self.committed_lsn = last_lsn
+        self.records += len(batch)
+        self.commits += 1
+        self.bytes_written += len(data)
+        self.max_batch = max(self.max_batch, len(batch))
+
+    def flush(self):
+        """Commit everything queued so far"""
+        with self._io_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                last_lsn = self._next_lsn - 1
+            if batch and self._file is not None:
+                self._write(batch, last_lsn)
+
+    def rotate(self):
+        """Commit what is queued, start a new segment and return its first LSN.
+
+        Every record in older segments was appended before this call.
+        """
+        with self._io_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                last_lsn = self._next_lsn - 1
+            # Records appended meanwhile go to the new segment
+            if batch and self._file is not None:
+                self._write(batch, last_lsn)
+            with self._lock:
+                self._open_segment()
+                return self._segment_lsn
+
+    def discard_before(self, lsn):
+        """Delete segments that end before lsn, once a snapshot covers them"""
+        for first_lsn, path in self.segments():
+            if first_lsn < lsn and first_lsn != self._segment_lsn:
+                os.remove(path)
+
+    def close(self):
+        self.flush()
+        with self._io_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self.commit_interval > 0:
+                # Let more records arrive so one fsync commits them all
+                self.socketio.sleep(self.commit_interval)
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def recover(self, games, new_game, on_replayed=None):
+        """Replay the journal onto games; call before start().
+
+        Games already in games (or its snapshot fallback) get the records
+        after their journal_lsn. Games started after the last snapshot are
+        rebuilt from their START record with new_game(game_code, players),
+        and dropped games are removed again. on_replayed(game_code, game)
+        is called once, with the game's lock held, for every game recovery
+        loaded or changed, after all records are replayed.
+        """
+        replayed = {}
+        for record in self.records_since():
+            code = record.code
+            if record.kind == DROP:
+                games.remove(code)
+                replayed.pop(code, None)
+                continue
+            with games.locked(code) as game:
+                if game is None and record.kind == START:
+                    game = new_game(code, start_players(record))
+                    if not games.add(code, game):
+                        continue
+                    self.recovered['games'] += 1
+                if game is not None:
+                    replayed[code] = True
+                if game is None or record.lsn <= game.get('journal_lsn', 0):
+                    self.recovered['skipped'] += 1
+                    continue
+                if replay(game, record):
+                    self.recovered['records'] += 1
+                else:
+                    self.recovered['errors'] += 1
+        if on_replayed is not None:
+            for code in replayed:
+                with games.locked(code) as game:
+                    if game is not None:
+                        on_replayed(code, game)
+        return len(replayed)
+
+    def stats(self):
+        return {
+            'directory': self.directory,
+            'next_lsn': self._next_lsn,
+            'committed_lsn': self.committed_lsn,
+            'segments': len(self.segments()),
+            'records': self.records,
+            'commits': self.commits,
+            'records_per_commit': self.records / self.commits if self.commits else None,
+            'max_records_per_commit': self.max_batch,
+            'bytes': self.bytes_written,
+            'avg_fsync_ms': self.fsync_ms / self.commits if self.commits else None,
+            'recovered': dict(self.recovered),
+        }
@@ -0,0 +1,27 @@
+"""Blocking system calls kept off the eventlet hub.
+
+Under eventlet every green thread shares one OS thread, so a write() or
+fsync() that waits on the disk stalls all handlers and timers until it
+returns. offload() runs such a call on eventlet's pool of native threads
+while only the calling green thread waits. Without monkey patching (the
+threading async mode, or tools that don't import app.py) it simply calls
+the function.
+"""
+import sys
+
+
+def patched():
+    """Whether eventlet has monkey patched threads in this process"""
+    eventlet = sys.modules.get('eventlet')
+    if eventlet is None:
+        return False
+    from eventlet import patcher
+    return patcher.is_monkey_patched('thread')
+
+
+def offload(function, *args):
+    """function(*args), run on a native thread when eventlet is in use"""
+    if patched():
+        from eventlet import tpool
+        return tpool.execute(function, *args)
+    return function(*args)
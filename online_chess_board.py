@@ -1,203 +1,432 @@
+import json
+import struct
+from array import array
+from functools import lru_cache
+
 from chess_pieces import *
+from bitboard import (BISHOP, CODE_INDEX, COLOR_INDEX, COLORS, KING, KNIGHT, PAWN, PAWN_PROMOTION_ROW,
+                      PIECE_INDEX, PIECE_TYPES, QUEEN, QUEEN_MINUS_PAWN, ROOK,
+                      LegalityContext, bishop_attacks, bit_squares, piece_attacks,
+                      piece_code, rook_attacks, square)
+from move_cache import valid_moves_cache
+from zobrist import BLACK_TO_MOVE_KEY, CASTLING_KEYS, CASTLING_SQUARES, PIECE_KEYS, castling_rights
+
+# Piece classes by piece type index, for building ChessPiece objects on demand
+PIECE_CLASSES = (Pawn, Knight, Bishop, Rook, Queen, King)
+
+# Back rank piece types from column 0 to 7
+BACK_RANK = (ROOK, KNIGHT, BISHOP, QUEEN, KING, BISHOP, KNIGHT, ROOK)
+
+# Shared get_board_state() cells, one per piece code
+EMPTY_CELL = {'piece_type': None, 'color': None}
+CELLS = [EMPTY_CELL] * 16
+for _code, _index in enumerate(CODE_INDEX):
+    if _index >= 0:
+        CELLS[_code] = {'piece_type': PIECE_TYPES[_index % 6], 'color': COLORS[_index // 6]}
+
+# FEN piece letters by piece code, and the reverse
+FEN_LETTERS = [''] * 16
+for _code, _index in enumerate(CODE_INDEX):
+    if _index >= 0:
+        _letter = 'pnbrqk'[_index % 6]
+        FEN_LETTERS[_code] = _letter.upper() if _index < 6 else _letter
+FEN_CODES = {letter: code for code, letter in enumerate(FEN_LETTERS) if letter}
+# FEN castling letters in CASTLING_SQUARES bit order
+CASTLING_LETTERS = 'KQkq'
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+# Material in pawns, for the captured material difference and the engine's evaluation
+PIECE_VALUES = {'pawn': 1, 'knight': 3, 'bishop': 3, 'rook': 5, 'queen': 9}
+
+# to_bytes() header: packed squares, moved bitboard, side to move, captured count, undo record count
+_BYTES_HEADER = struct.Struct('<32sQBBH')
+
+# Undo record layout: from | to << 6 | captured code << 12 | flags
+_HAD_MOVED = 1 << 16
+_PROMOTED = 1 << 17
+_CAPTURED_HAD_MOVED = 1 << 18
+
 
 class OnlineChessBoard:
+    __slots__ = ('squares', 'moved', 'pieces', 'occupancy', 'attacks_from', 'turn',
+                 '_attack_maps', '_piece_key', '_captured', '_stack', '_ply_moves',
+                 '_state_cache', '_board_json')
+
     def __init__(self):
-        self.board = [[None for _ in range(8)] for _ in range(8)]
-        self.white_king = None
-        self.black_king = None
-        self.captured = {'white': [], 'black': []}  # Track captured pieces
+        # One piece code per square and a bitboard of squares whose piece has moved
+        self.squares = bytearray(64)
+        self.moved = 0
+        self.turn = 'white'
+        # Codes of captured pieces in capture order
+        self._captured = bytearray()
+        # Undo records for push/pop, one packed int per move played
+        self._stack = array('I')
         self.setup_board()
-    
+
     def setup_board(self):
         """Initialize the chess board with pieces in starting positions"""
-        # Place pawns
+        squares = self.squares
         for col in range(8):
-            self.board[1][col] = Pawn('black', 1, col)
-            self.board[6][col] = Pawn('white', 6, col)
-        
-        # Place rooks
-        self.board[0][0] = Rook('black', 0, 0)
-        self.board[0][7] = Rook('black', 0, 7)
-        self.board[7][0] = Rook('white', 7, 0)
-        self.board[7][7] = Rook('white', 7, 7)
-        
-        # Place knights
-        self.board[0][1] = Knight('black', 0, 1)
-        self.board[0][6] = Knight('black', 0, 6)
-        self.board[7][1] = Knight('white', 7, 1)
-        self.board[7][6] = Knight('white', 7, 6)
-        
-        # Place bishops
-        self.board[0][2] = Bishop('black', 0, 2)
-        self.board[0][5] = Bishop('black', 0, 5)
-        self.board[7][2] = Bishop('white', 7, 2)
-        self.board[7][5] = Bishop('white', 7, 5)
-        
-        # Place queens
-        self.board[0][3] = Queen('black', 0, 3)
-        self.board[7][3] = Queen('white', 7, 3)
-        
-        # Place kings
-        self.black_king = King('black', 0, 4)
-        self.white_king = King('white', 7, 4)
-        self.board[0][4] = self.black_king
-        self.board[7][4] = self.white_king
-    
+            squares[col] = piece_code(1, BACK_RANK[col])
+            squares[8 + col] = piece_code(1, PAWN)
+            squares[48 + col] = piece_code(0, PAWN)
+            squares[56 + col] = piece_code(0, BACK_RANK[col])
+        self._rebuild()
+
+    def _rebuild(self):
+        """Recompute bitboards, hash and attack sets from the square buffer"""
+        pieces = self.pieces = array('Q', bytes(96))
+        occupancy = self.occupancy = array('Q', bytes(16))
+        key = 0
+        for sq, code in enumerate(self.squares):
+            if code:
+                index = CODE_INDEX[code]
+                pieces[index] |= 1 << sq
+                occupancy[code >> 3] |= 1 << sq
+                key ^= PIECE_KEYS[index][sq]
+        self._piece_key = key
+        occupied = occupancy[0] | occupancy[1]
+        self.attacks_from = array('Q', [
+            piece_attacks((code & 7) - 1, code >> 3, sq, occupied) if code else 0
+            for sq, code in enumerate(self.squares)
+        ])
+        self._attack_maps = None
+        self._ply_moves = None
+        self._invalidate_state()
+
+    def _piece_at(self, sq):
+        """Build a ChessPiece for whatever stands on sq"""
+        code = self.squares[sq]
+        if not code:
+            return None
+        piece = PIECE_CLASSES[(code & 7) - 1](COLORS[code >> 3], sq >> 3, sq & 7)
+        piece.has_moved = bool((self.moved >> sq) & 1)
+        return piece
+
     def get_piece(self, row, col):
         """Get the piece at the given position"""
         if 0 <= row < 8 and 0 <= col < 8:
-            return self.board[row][col]
+            return self._piece_at(square(row, col))
         return None
-    
+
     def set_piece(self, row, col, piece):
         """Set a piece at the given position"""
         if 0 <= row < 8 and 0 <= col < 8:
-            self.board[row][col] = piece
+            sq = square(row, col)
             if piece:
                 piece.row = row
                 piece.col = col
-    
+                self._put(sq, piece_code(COLOR_INDEX[piece.color], PIECE_INDEX[piece.piece_type]))
+                if piece.has_moved:
+                    self.moved |= 1 << sq
+                else:
+                    self.moved &= ~(1 << sq)
+            else:
+                self._put(sq, 0)
+                self.moved &= ~(1 << sq)
+
     def remove_piece(self, row, col):
         """Remove a piece from the given position"""
         if 0 <= row < 8 and 0 <= col < 8:
-            self.board[row][col] = None
-    
+            self.set_piece(row, col, None)
+
+    @property
+    def board(self):
+        """The position as an 8x8 list of ChessPiece objects, built on demand"""
+        return [[self._piece_at(row * 8 + col) for col in range(8)] for row in range(8)]
+
+    @property
+    def white_king(self):
+        return self._king(0)
+
+    @property
+    def black_king(self):
+        return self._king(1)
+
+    def _king(self, color):
+        king = self.pieces[color * 6 + KING]
+        return self._piece_at(king.bit_length() - 1) if king else None
+
+    @property
+    def ply(self):
+        """Number of moves played on this board"""
+        return len(self._stack)
+
+    def history(self):
+        """Moves played so far as ((from_row, from_col), (to_row, to_col)), oldest first.
+
+        They are read from the undo stack, which already keeps every move in
+        four bytes, so the history costs nothing extra to record.
+        """
+        return [(divmod(record & 63, 8), divmod((record >> 6) & 63, 8)) for record in self._stack]
+
+    @property
+    def captured(self):
+        """Captured piece types, keyed by the color of the side that lost them"""
+        captured = {'white': [], 'black': []}
+        for code in self._captured:
+            captured[COLORS[code >> 3]].append(PIECE_TYPES[(code & 7) - 1])
+        return captured
+
+    def _put(self, sq, code):
+        """Put a piece code (0 for empty) on sq, keeping bitboards, hash and attacks in step"""
+        bit = 1 << sq
+        old = self.squares[sq]
+        if old:
+            index = CODE_INDEX[old]
+            self.pieces[index] ^= bit
+            self.occupancy[old >> 3] ^= bit
+            self._piece_key ^= PIECE_KEYS[index][sq]
+        self.squares[sq] = code
+        if code:
+            index = CODE_INDEX[code]
+            self.pieces[index] |= bit
+            self.occupancy[code >> 3] |= bit
+            self._piece_key ^= PIECE_KEYS[index][sq]
+        self._refresh_attacks(sq)
+        self._invalidate_state()
+
+    def _invalidate_state(self):
+        """Forget the cached get_board_state() result after the board changes"""
+        self._state_cache = None
+        self._board_json = None
+
+    @property
+    def zobrist_key(self):
+        """64-bit hash of the pieces, side to move and castling rights.
+
+        The piece part is kept up to date as pieces are put and removed.
+        There is no en passant in these rules, so no en-passant file is
+        mixed in.
+        """
+        key = self._piece_key ^ CASTLING_KEYS[castling_rights(self.squares, self.moved)]
+        if self.turn == 'black':
+            key ^= BLACK_TO_MOVE_KEY
+        return key
+
+    def _refresh_attacks(self, changed_sq):
+        """Recompute the attack sets a change on changed_sq can affect.
+
+        Only the piece on the square itself and the sliders whose rays reach
+        it are touched; every other piece keeps its cached attack set.
+        """
+        pieces = self.pieces
+        occupied = self.occupancy[0] | self.occupancy[1]
+        queens = pieces[QUEEN] | pieces[6 + QUEEN]
+        diagonal = pieces[BISHOP] | pieces[6 + BISHOP] | queens
+        orthogonal = pieces[ROOK] | pieces[6 + ROOK] | queens
+        touched = ((bishop_attacks(changed_sq, occupied) & diagonal) |
+                   (rook_attacks(changed_sq, occupied) & orthogonal) |
+                   (1 << changed_sq))
+        squares = self.squares
+        for sq in bit_squares(touched):
+            code = squares[sq]
+            self.attacks_from[sq] = piece_attacks((code & 7) - 1, code >> 3, sq, occupied) if code else 0
+        self._attack_maps = None
+
+    def attack_map(self, color):
+        """Bitboard of every square attacked or defended by the given color"""
+        maps = self._attack_maps
+        if maps is None:
+            maps = [0, 0]
+            for index in (0, 1):
+                for sq in bit_squares(self.occupancy[index]):
+                    maps[index] |= self.attacks_from[sq]
+            self._attack_maps = maps
+        return maps[COLOR_INDEX[color]]
+
+    def _legality(self, color):
+        """Check and pin masks for one side, seeded with the opponent's attack map"""
+        opponent_color = 'black' if color == 'white' else 'white'
+        return LegalityContext(self.pieces, self.occupancy, COLOR_INDEX[color],
+                               self.attack_map(opponent_color))
+
     def get_valid_moves(self, row, col):
         """Get all valid moves for a piece at the given position"""
-        piece = self.get_piece(row, col)
-        if not piece:
+        if not (0 <= row < 8 and 0 <= col < 8):
             return []
-        
-        valid_moves = []
-        for to_row in range(8):
-            for to_col in range(8):
-                if piece.is_valid_move(to_row, to_col, self):
-                    # Check if move would put own king in check
-                    if not self.would_move_cause_check(row, col, to_row, to_col, piece.color):
-                        valid_moves.append((to_row, to_col))
-        
-        return valid_moves
-    
+        sq = square(row, col)
+        code = self.squares[sq]
+        if not code:
+            return []
+        color = COLORS[code >> 3]
+
+        zobrist_key = self.zobrist_key
+        ply_moves = self._ply_moves
+        if ply_moves is not None and ply_moves[0] == (zobrist_key, color):
+            # The full move list for this position is already known
+            packed = ply_moves[1]
+            return [divmod(packed[i + 1], 8) for i in range(0, len(packed), 2) if packed[i] == sq]
+
+        # Repeated clicks and both players share entries keyed by position
+        key = (zobrist_key, sq)
+        moves = valid_moves_cache.get(key)
+        if moves is None:
+            targets = self._legality(color).targets((code & 7) - 1, sq)
+            moves = tuple(divmod(to_sq, 8) for to_sq in bit_squares(targets))
+            valid_moves_cache.put(key, moves)
+        return list(moves)
+
     def make_move(self, from_row, from_col, to_row, to_col):
         """Make a move on the board"""
-        piece = self.get_piece(from_row, from_col)
-        if not piece:
-            return False
-        
-        # Check if the move is valid
-        if not piece.is_valid_move(to_row, to_col, self):
+        # Check if the move is legal, including not leaving the own king in check
+        if (to_row, to_col) not in self.get_valid_moves(from_row, from_col):
             return False
-        
-        # Check if move would put own king in check
-        if self.would_move_cause_check(from_row, from_col, to_row, to_col, piece.color):
-            return False
-        
-        # Make the move
-        captured_piece = self.get_piece(to_row, to_col)
-        if captured_piece:
-            # Record captured piece for the opponent
-            self.captured[captured_piece.color].append(captured_piece.piece_type)
-        self.set_piece(to_row, to_col, piece)
-        self.remove_piece(from_row, from_col)
-        piece.move_to(to_row, to_col)
-        
-        # Handle pawn promotion
-        if isinstance(piece, Pawn):
-            if (piece.color == 'white' and to_row == 0) or (piece.color == 'black' and to_row == 7):
-                # Promote to queen for simplicity
-                new_queen = Queen(piece.color, to_row, to_col)
-                new_queen.has_moved = True
-                self.set_piece(to_row, to_col, new_queen)
-        
+
+        self.push(((from_row, from_col), (to_row, to_col)))
         return True
-    
+
+    def push(self, move):
+        """Play a move given as ((from_row, from_col), (to_row, to_col)) without validating it.
+
+        Everything needed to take the move back is recorded on the undo stack,
+        so legality checks and searches can push and pop on one board.
+        """
+        (from_row, from_col), (to_row, to_col) = move
+        from_sq = square(from_row, from_col)
+        to_sq = square(to_row, to_col)
+        code = self.squares[from_sq]
+        captured_code = self.squares[to_sq]
+        record = from_sq | (to_sq << 6) | (captured_code << 12)
+        if (self.moved >> from_sq) & 1:
+            record |= _HAD_MOVED
+        if captured_code:
+            # Record captured piece for the opponent
+            self._captured.append(captured_code)
+            if (self.moved >> to_sq) & 1:
+                record |= _CAPTURED_HAD_MOVED
+
+        # Pawns reaching the last row promote to a queen for simplicity
+        if (code & 7) == PAWN + 1 and to_row == PAWN_PROMOTION_ROW[code >> 3]:
+            record |= _PROMOTED
+            code += QUEEN_MINUS_PAWN
+        self._put(from_sq, 0)
+        self._put(to_sq, code)
+        self.moved = (self.moved & ~(1 << from_sq)) | (1 << to_sq)
+
+        self.turn = 'black' if self.turn == 'white' else 'white'
+        self._stack.append(record)
+
+    def pop(self):
+        """Take back the last pushed move and return it"""
+        record = self._stack.pop()
+        from_sq = record & 63
+        to_sq = (record >> 6) & 63
+        captured_code = (record >> 12) & 15
+        code = self.squares[to_sq]
+        if record & _PROMOTED:
+            code -= QUEEN_MINUS_PAWN
+        self._put(to_sq, captured_code)
+        self._put(from_sq, code)
+        moved = self.moved & ~(1 << to_sq)
+        if record & _HAD_MOVED:
+            moved |= 1 << from_sq
+        if record & _CAPTURED_HAD_MOVED:
+            moved |= 1 << to_sq
+        self.moved = moved
+        if captured_code:
+            self._captured.pop()
+        self.turn = 'black' if self.turn == 'white' else 'white'
+        return divmod(from_sq, 8), divmod(to_sq, 8)
+
     def is_square_attacked(self, row, col, by_color):
         """Check if a square is attacked by pieces of the given color"""
-        for check_row in range(8):
-            for check_col in range(8):
-                piece = self.get_piece(check_row, check_col)
-                if piece and piece.color == by_color:
-                    if piece.is_valid_move(row, col, self):
-                        return True
-        return False
-    
+        return (self.attack_map(by_color) >> square(row, col)) & 1 == 1
+
     def is_in_check(self, color):
         """Check if the king of the given color is in check"""
-        king = self.white_king if color == 'white' else self.black_king
+        king = self.pieces[COLOR_INDEX[color] * 6 + KING]
         opponent_color = 'black' if color == 'white' else 'white'
-        return self.is_square_attacked(king.row, king.col, opponent_color)
-    
+        return (self.attack_map(opponent_color) & king) != 0
+
     def would_move_cause_check(self, from_row, from_col, to_row, to_col, color):
         """Check if a move would put the player's own king in check"""
-        # Make a temporary move
-        piece = self.get_piece(from_row, from_col)
-        captured_piece = self.get_piece(to_row, to_col)
-        
-        # Simulate the move
-        self.set_piece(to_row, to_col, piece)
-        self.remove_piece(from_row, from_col)
-        piece.row = to_row
-        piece.col = to_col
-        
-        # Check if king is in check after the move
+        from_sq = square(from_row, from_col)
+        code = self.squares[from_sq]
+        opponent_color = 'black' if color == 'white' else 'white'
+        if code and COLORS[code >> 3] == color:
+            # A piece the opponent does not attack cannot be pinned
+            if ((code & 7) != KING + 1 and not self.is_in_check(color) and
+                    not (self.attack_map(opponent_color) >> from_sq) & 1):
+                return False
+            return not self._legality(color).allows(from_sq, square(to_row, to_col))
+
+        # Not one of this side's pieces, so play the move out and take it back
+        self.push(((from_row, from_col), (to_row, to_col)))
         in_check = self.is_in_check(color)
-        
-        # Undo the move
-        self.set_piece(from_row, from_col, piece)
-        self.set_piece(to_row, to_col, captured_piece)
-        piece.row = from_row
-        piece.col = from_col
-        
+        self.pop()
         return in_check
-    
+
     def get_all_valid_moves(self, color):
-        """Get all valid moves for all pieces of the given color"""
-        moves = []
-        for row in range(8):
-            for col in range(8):
-                piece = self.get_piece(row, col)
-                if piece and piece.color == color:
-                    valid_moves = self.get_valid_moves(row, col)
-                    for move in valid_moves:
-                        moves.append(((row, col), move))
-        return moves
-    
+        """Get all valid moves for all pieces of the given color.
+
+        The result is kept as (from, to) square byte pairs until the position
+        changes, so the checkmate and stalemate tests after a move and the
+        clicks that follow share it.
+        """
+        packed = self.legal_move_squares(color)
+        return [(divmod(packed[i], 8), divmod(packed[i + 1], 8)) for i in range(0, len(packed), 2)]
+
+    def legal_move_squares(self, color):
+        """The legal moves of get_all_valid_moves() as bytes: from and to square of each move in turn"""
+        key = (self.zobrist_key, color)
+        ply_moves = self._ply_moves
+        if ply_moves is None or ply_moves[0] != key:
+            context = self._legality(color)
+            squares = self.squares
+            packed = bytearray()
+            for from_sq in bit_squares(context.own):
+                for to_sq in bit_squares(context.targets((squares[from_sq] & 7) - 1, from_sq)):
+                    packed.append(from_sq)
+                    packed.append(to_sq)
+            ply_moves = self._ply_moves = (key, bytes(packed))
+        return ply_moves[1]
+
     def is_checkmate(self, color):
         """Check if the given color is in checkmate"""
         if not self.is_in_check(color):
             return False
-        
+
         # If in check, see if there are any valid moves
         return len(self.get_all_valid_moves(color)) == 0
-    
+
     def is_stalemate(self, color):
         """Check if the given color is in stalemate"""
         if self.is_in_check(color):
             return False
-        
+
         # If not in check, see if there are any valid moves
         return len(self.get_all_valid_moves(color)) == 0
-    
+
     def get_board_state(self):
-        """Return the current state of the board for broadcasting, including check status, king positions, captured pieces, and material diff"""
-        board_state = []
-        for row in self.board:
-            board_state.append([{'piece_type': piece.__class__.__name__.lower() if piece else None,
-                                 'color': piece.color if piece else None} for piece in row])
+        """Return the current state of the board for broadcasting, including check status, king positions, captured pieces, and material diff
+
+        The state is built once per position and shared by every caller until
+        the board changes, so it must be treated as read-only. Its cells are
+        shared between boards as well.
+        """
+        if self._state_cache is not None:
+            return self._state_cache
+        squares = self.squares
+        board_state = [[CELLS[code] for code in squares[row:row + 8]] for row in range(0, 64, 8)]
         # Calculate material difference
-        piece_values = {'pawn': 1, 'knight': 3, 'bishop': 3, 'rook': 5, 'queen': 9}
         def total_value(captured):
-            return sum(piece_values.get(pt, 0) for pt in captured)
-        white_captured = self.captured['black']  # white captured black's pieces
-        black_captured = self.captured['white']  # black captured white's pieces
+            return sum(PIECE_VALUES.get(pt, 0) for pt in captured)
+        captured = self.captured
+        white_captured = captured['black']  # white captured black's pieces
+        black_captured = captured['white']  # black captured white's pieces
         white_material = total_value(white_captured)
         black_material = total_value(black_captured)
         material_diff = white_material - black_material
+        kings = []
+        for color in (0, 1):
+            king = self.pieces[color * 6 + KING]
+            kings.append({'row': (king.bit_length() - 1) >> 3, 'col': (king.bit_length() - 1) & 7} if king else None)
         # Add check status, king positions, captured pieces, and material diff
         state = {
             'board': board_state,
-            'white_king': {'row': self.white_king.row, 'col': self.white_king.col} if self.white_king else None,
-            'black_king': {'row': self.black_king.row, 'col': self.black_king.col} if self.black_king else None,
+            'white_king': kings[0],
+            'black_king': kings[1],
             'white_in_check': self.is_in_check('white'),
             'black_in_check': self.is_in_check('black'),
             'captured': {
@@ -206,29 +435,152 @@ class OnlineChessBoard:
             },
             'material_diff': material_diff
         }
+        self._state_cache = state
         return state
-    
+
+    def get_board_json(self):
+        """The 8x8 board of get_board_state() as compact JSON text, cached with it"""
+        if self._board_json is None:
+            self._board_json = json.dumps(self.get_board_state()['board'], separators=(',', ':'))
+        return self._board_json
+
+    def to_packed(self):
+        """The board as 32 bytes holding a 4-bit code per square, low nibble first.
+
+        Codes are piece type index + 1 (pawn=1 ... king=6), plus 8 for black.
+        """
+        squares = self.squares
+        return bytes(squares[sq] | (squares[sq + 1] << 4) for sq in range(0, 64, 2))
+
+    def to_bytes(self):
+        """Serialize the position, captured pieces and undo stack for storage.
+
+        The result is 46 bytes plus one per captured piece and four per move
+        played, and is the same on every platform.
+        """
+        header = _BYTES_HEADER.pack(self.to_packed(), self.moved, COLOR_INDEX[self.turn],
+                                    len(self._captured), len(self._stack))
+        return header + bytes(self._captured) + struct.pack(f'<{len(self._stack)}I', *self._stack)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Rebuild a board written by to_bytes()"""
+        packed, moved, turn, captured_count, stack_count = _BYTES_HEADER.unpack_from(data)
+        offset = _BYTES_HEADER.size
+        board = cls.__new__(cls)
+        board.squares = bytearray(code for byte in packed for code in (byte & 15, byte >> 4))
+        board.moved = moved
+        board.turn = COLORS[turn]
+        board._captured = bytearray(data[offset:offset + captured_count])
+        offset += captured_count
+        board._stack = array('I', struct.unpack_from(f'<{stack_count}I', data, offset))
+        board._rebuild()
+        return board
+
     def copy(self):
-        """Create a copy of the board"""
-        new_board = OnlineChessBoard()
-        new_board.board = [[None for _ in range(8)] for _ in range(8)]
-        
-        for row in range(8):
-            for col in range(8):
-                piece = self.get_piece(row, col)
-                if piece:
-                    # Create a new piece of the same type
-                    piece_type = piece.__class__
-                    new_piece = piece_type(piece.color, row, col)
-                    new_piece.has_moved = piece.has_moved
-                    new_board.set_piece(row, col, new_piece)
-                    
-                    # Update king references
-                    if isinstance(new_piece, King):
-                        if new_piece.color == 'white':
-                            new_board.white_king = new_piece
-                        else:
-                            new_board.black_king = new_piece
-        
+        """Create a copy of the board by copying its buffers"""
+        new_board = OnlineChessBoard.__new__(OnlineChessBoard)
+        new_board.squares = bytearray(self.squares)
+        new_board.moved = self.moved
+        new_board.pieces = array('Q', self.pieces)
+        new_board.occupancy = array('Q', self.occupancy)
+        new_board.attacks_from = array('Q', self.attacks_from)
+        new_board.turn = self.turn
+        new_board._attack_maps = self._attack_maps
+        new_board._piece_key = self._piece_key
+        new_board._captured = bytearray(self._captured)
+        new_board._stack = array('I', self._stack)
+        # Cached results are never mutated in place, so the copy can share them
+        new_board._ply_moves = self._ply_moves
+        new_board._state_cache = self._state_cache
+        new_board._board_json = self._board_json
         return new_board
 
+    def set_fen(self, fen):
+        """Load a FEN position in place, replacing the position and forgetting the history.
+
+        Reusing one board this way skips the setup of a new board per
+        position. Pieces off their starting squares count as moved, as do
+        rooks whose castling right is missing. The en passant field and the
+        move counters are ignored, since these rules have no en passant.
+        Raises ValueError for malformed FEN, a side without exactly one king
+        or a side not to move that is in check, whose king could be taken;
+        the board then holds no usable position until the next load.
+        """
+        fields = fen.split()
+        if len(fields) < 2:
+            raise ValueError(f'FEN needs at least a placement and a side to move: {fen!r}')
+        rows = fields[0].split('/')
+        if len(rows) != 8:
+            raise ValueError(f'FEN placement needs 8 rows: {fen!r}')
+        squares = bytearray().join(_fen_row(text) for text in rows)
+        if fields[1] not in ('w', 'b'):
+            raise ValueError(f'bad FEN side to move {fields[1]!r}')
+        for color in (0, 1):
+            if squares.count(piece_code(color, KING)) != 1:
+                raise ValueError(f'FEN needs exactly one {COLORS[color]} king: {fen!r}')
+
+        rights = fields[2] if len(fields) > 2 else '-'
+        moved = 0
+        for sq, code in enumerate(squares):
+            if code and code != _START_SQUARES[sq]:
+                moved |= 1 << sq
+        for letter, (king_sq, rook_sq, color) in zip(CASTLING_LETTERS, CASTLING_SQUARES):
+            if letter not in rights:
+                moved |= 1 << rook_sq
+
+        self.squares = squares
+        self.moved = moved
+        self.turn = 'white' if fields[1] == 'w' else 'black'
+        self._captured = bytearray()
+        self._stack = array('I')
+        self._rebuild()
+        waiting = 'black' if self.turn == 'white' else 'white'
+        if self.is_in_check(waiting):
+            raise ValueError(f'FEN leaves the {waiting} king in check with {self.turn} to move: {fen!r}')
+
+    @classmethod
+    def from_fen(cls, fen):
+        """A new board holding a FEN position"""
+        board = cls.__new__(cls)
+        board.set_fen(fen)
+        return board
+
+    def to_fen(self):
+        """The position as FEN; the move number counts the moves on this board"""
+        rows = []
+        for row in range(8):
+            text = ''
+            empty = 0
+            for code in self.squares[row * 8:row * 8 + 8]:
+                if code:
+                    if empty:
+                        text += str(empty)
+                        empty = 0
+                    text += FEN_LETTERS[code]
+                else:
+                    empty += 1
+            rows.append(text + (str(empty) if empty else ''))
+        rights = castling_rights(self.squares, self.moved)
+        castling = ''.join(letter for bit, letter in enumerate(CASTLING_LETTERS) if rights >> bit & 1) or '-'
+        return f"{'/'.join(rows)} {self.turn[0]} {castling} - 0 {1 + self.ply // 2}"
+
+
+@lru_cache(maxsize=4096)
+def _fen_row(text):
+    """Piece codes for one FEN row; the same rows recur across many positions"""
+    codes = bytearray()
+    for char in text:
+        if char in '12345678':
+            codes.extend(bytes(int(char)))
+        elif char in FEN_CODES:
+            codes.append(FEN_CODES[char])
+        else:
+            raise ValueError(f'bad FEN row {text!r}')
+    if len(codes) != 8:
+        raise ValueError(f'FEN row {text!r} does not cover 8 squares')
+    return bytes(codes)
+
+
+# Piece codes of the starting position, by square
+_START_SQUARES = bytes(OnlineChessBoard().squares)
@@ -0,0 +1,192 @@
+"""Perft equivalence check between OnlineChessBoard and the chess_pieces rules.
+
+ReferenceBoard keeps the original square-by-square legality test built on
+ChessPiece.is_valid_move. Every node visited by perft, and every ply of a
+batch of random games, must produce identical move lists from both boards,
+and popping a whole game must give back the start position.
+
+    python perft.py --depth 3 --games 200
+"""
+import argparse
+import random
+import sys
+
+from chess_pieces import Bishop, King, Knight, Pawn, Queen, Rook
+from online_chess_board import OnlineChessBoard
+
+PIECE_CLASSES = {'p': Pawn, 'n': Knight, 'b': Bishop, 'r': Rook, 'q': Queen, 'k': King}
+
+# (name, FEN piece placement, side to move)
+POSITIONS = [
+    ('start', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR', 'white'),
+    ('pins', '4k3/8/8/1b2r3/8/3PN3/4K3/8', 'white'),
+    ('promotion', '8/1P4k1/8/8/8/8/5p2/3K4', 'white'),
+    ('double_check', '4k3/8/8/8/1b6/8/4r3/R3K2R', 'white'),
+    ('middlegame', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R', 'white'),
+]
+
+
+class ReferenceBoard:
+    """The original OnlineChessBoard rules, scanning every square per piece"""
+
+    def __init__(self, source):
+        self.board = [[None for _ in range(8)] for _ in range(8)]
+        self.white_king = None
+        self.black_king = None
+        for row in range(8):
+            for col in range(8):
+                piece = source.get_piece(row, col)
+                if piece:
+                    clone = piece.__class__(piece.color, row, col)
+                    clone.has_moved = piece.has_moved
+                    self.board[row][col] = clone
+                    if isinstance(clone, King):
+                        if clone.color == 'white':
+                            self.white_king = clone
+                        else:
+                            self.black_king = clone
+
+    def get_piece(self, row, col):
+        if 0 <= row < 8 and 0 <= col < 8:
+            return self.board[row][col]
+        return None
+
+    def set_piece(self, row, col, piece):
+        self.board[row][col] = piece
+        if piece:
+            piece.row = row
+            piece.col = col
+
+    def is_in_check(self, color):
+        king = self.white_king if color == 'white' else self.black_king
+        opponent = 'black' if color == 'white' else 'white'
+        for row in range(8):
+            for col in range(8):
+                piece = self.board[row][col]
+                if piece and piece.color == opponent and piece.is_valid_move(king.row, king.col, self):
+                    return True
+        return False
+
+    def would_move_cause_check(self, from_row, from_col, to_row, to_col, color):
+        piece = self.board[from_row][from_col]
+        captured_piece = self.board[to_row][to_col]
+        self.set_piece(to_row, to_col, piece)
+        self.board[from_row][from_col] = None
+        in_check = self.is_in_check(color)
+        self.set_piece(from_row, from_col, piece)
+        self.set_piece(to_row, to_col, captured_piece)
+        return in_check
+
+    def get_all_valid_moves(self, color):
+        moves = []
+        for row in range(8):
+            for col in range(8):
+                piece = self.board[row][col]
+                if not piece or piece.color != color:
+                    continue
+                for to_row in range(8):
+                    for to_col in range(8):
+                        if (piece.is_valid_move(to_row, to_col, self) and
+                                not self.would_move_cause_check(row, col, to_row, to_col, color)):
+                            moves.append(((row, col), (to_row, to_col)))
+        return moves
+
+
+def board_from_placement(placement):
+    """Build an OnlineChessBoard from the piece placement field of a FEN"""
+    board = OnlineChessBoard()
+    for row in range(8):
+        for col in range(8):
+            board.remove_piece(row, col)
+    for row, rank in enumerate(placement.split('/')):
+        col = 0
+        for char in rank:
+            if char.isdigit():
+                col += int(char)
+                continue
+            color = 'white' if char.isupper() else 'black'
+            piece = PIECE_CLASSES[char.lower()](color, row, col)
+            # Pawns off their start row and all other pieces count as moved
+            start_row = 6 if color == 'white' else 1
+            piece.has_moved = not (isinstance(piece, Pawn) and row == start_row)
+            board.set_piece(row, col, piece)
+            col += 1
+    return board
+
+
+def opponent(color):
+    return 'black' if color == 'white' else 'white'
+
+
+def check_position(board, color):
+    """Compare both move generators on one position and return the move list"""
+    moves = board.get_all_valid_moves(color)
+    expected = ReferenceBoard(board).get_all_valid_moves(color)
+    if sorted(moves) != sorted(expected):
+        missing = sorted(set(expected) - set(moves))
+        extra = sorted(set(moves) - set(expected))
+        raise AssertionError(f'{color} move lists differ: missing {missing}, extra {extra}')
+    return moves
+
+
+def perft(board, color, depth, verify=True):
+    """Count leaf nodes of the legal move tree, optionally verifying every node"""
+    moves = check_position(board, color) if verify else board.get_all_valid_moves(color)
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        board.push(move)
+        nodes += perft(board, opponent(color), depth - 1, verify)
+        board.pop()
+    return nodes
+
+
+def random_games(count, max_plies, seed):
+    """Play random games, comparing move lists and check status at every ply"""
+    rng = random.Random(seed)
+    start_state = OnlineChessBoard().get_board_state()
+    plies = 0
+    for _ in range(count):
+        board = OnlineChessBoard()
+        color = 'white'
+        played = 0
+        for _ in range(max_plies):
+            moves = check_position(board, color)
+            reference = ReferenceBoard(board)
+            for side in ('white', 'black'):
+                if board.is_in_check(side) != reference.is_in_check(side):
+                    raise AssertionError(f'is_in_check({side}) differs')
+            if not moves:
+                break
+            (from_row, from_col), (to_row, to_col) = rng.choice(moves)
+            board.make_move(from_row, from_col, to_row, to_col)
+            color = opponent(color)
+            played += 1
+        # Taking every move back must restore the start position exactly
+        for _ in range(played):
+            board.pop()
+        if board.get_board_state() != start_state:
+            raise AssertionError('pop() did not restore the start position')
+        plies += played
+    return plies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--max-plies', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for name, placement, color in POSITIONS:
+        nodes = perft(board_from_placement(placement), color, args.depth)
+        print(f'{name:<14} depth {args.depth}: {nodes} nodes match')
+    plies = random_games(args.games, args.max_plies, args.seed)
+    print(f'random games: {args.games} games, {plies} plies match')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
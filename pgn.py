@@ -0,0 +1,293 @@
+"""SAN move text, PGN import and export, and a rotating PGN archive of finished games.
+
+SAN follows this game's rules: no castling or en passant, and pawns always
+promote to a queen. Disambiguation uses the mover's legal move list, which
+the board caches per position anyway.
+
+    PGN_ARCHIVE_DIR        if set, finished games are appended there as PGN
+    PGN_ARCHIVE_MAX_BYTES  size at which a new archive file is started (64 MB)
+"""
+import os
+import re
+import threading
+import time
+
+from bitboard import PAWN, PAWN_PROMOTION_ROW
+from online_chess_board import START_FEN
+
+PGN_ARCHIVE_DIR = os.environ.get('PGN_ARCHIVE_DIR')
+PGN_ARCHIVE_MAX_BYTES = int(os.environ.get('PGN_ARCHIVE_MAX_BYTES', 64 * 1024 * 1024))
+
+FILES = 'abcdefgh'
+# SAN letter by piece type index; pawns have none
+PIECE_LETTERS = ('', 'N', 'B', 'R', 'Q', 'K')
+STREAM_CHUNK = 64 * 1024
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+
+_SAN = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h])([1-8])(?:=?([NBRQ]))?$')
+_TAG = re.compile(r'\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+_COMMENT = re.compile(r'\{[^}]*\}')
+_VARIATION = re.compile(r'\([^()]*\)')
+_MOVE_NUMBER = re.compile(r'\d+\.(?:\.\.)?')
+
+
+def square_name(row, col):
+    """Algebraic name of a square; row 0 is black's back rank, rank 8"""
+    return f'{FILES[col]}{8 - row}'
+
+
+def move_san(board, move, legal_moves=None):
+    """SAN for a legal move in the board's current position.
+
+    legal_moves, the mover's moves from get_all_valid_moves(), is looked up
+    if not given. The board is left as it was.
+    """
+    (from_row, from_col), (to_row, to_col) = move
+    code = board.squares[from_row * 8 + from_col]
+    piece = (code & 7) - 1
+    capture = 'x' if board.squares[to_row * 8 + to_col] else ''
+    if piece == PAWN:
+        san = (FILES[from_col] + capture if capture else '') + square_name(to_row, to_col)
+        if to_row == PAWN_PROMOTION_ROW[code >> 3]:
+            san += '=Q'
+    else:
+        if legal_moves is None:
+            legal_moves = board.get_all_valid_moves(board.turn)
+        # Other pieces of the same kind that could also reach the target
+        rivals = [origin for origin, target in legal_moves
+                  if target == (to_row, to_col) and origin != (from_row, from_col)
+                  and board.squares[origin[0] * 8 + origin[1]] == code]
+        disambiguation = ''
+        if rivals:
+            if all(col != from_col for _, col in rivals):
+                disambiguation = FILES[from_col]
+            elif all(row != from_row for row, _ in rivals):
+                disambiguation = str(8 - from_row)
+            else:
+                disambiguation = square_name(from_row, from_col)
+        san = PIECE_LETTERS[piece] + disambiguation + capture + square_name(to_row, to_col)
+
+    opponent = 'black' if code >> 3 == 0 else 'white'
+    board.push(move)
+    if board.is_in_check(opponent):
+        san += '#' if not board.get_all_valid_moves(opponent) else '+'
+    board.pop()
+    return san
+
+
+def parse_san(board, san, legal_moves=None):
+    """The legal move a SAN string names in the board's position, or None.
+
+    Check marks and annotations are ignored. Castling and promotion to
+    anything but a queen do not exist in these rules and give None.
+    """
+    match = _SAN.match(san.rstrip('+#!?'))
+    if match is None:
+        return None
+    letter, from_file, from_rank, to_file, to_rank, promotion = match.groups()
+    if promotion not in (None, 'Q'):
+        return None
+    piece = PIECE_LETTERS.index(letter) if letter else PAWN
+    target = (8 - int(to_rank), FILES.index(to_file))
+    from_col = FILES.index(from_file) if from_file else None
+    from_row = 8 - int(from_rank) if from_rank else None
+    if legal_moves is None:
+        legal_moves = board.get_all_valid_moves(board.turn)
+    squares = board.squares
+    found = None
+    for origin, destination in legal_moves:
+        if (destination == target and (squares[origin[0] * 8 + origin[1]] & 7) - 1 == piece
+                and (from_col is None or origin[1] == from_col)
+                and (from_row is None or origin[0] == from_row)):
+            if found is not None:
+                return None  # Ambiguous
+            found = (origin, destination)
+    return found
+
+
+def read_pgn(lines):
+    """(tags, SAN moves, result) for each game in an iterable of PGN lines, one game at a time"""
+    tags = {}
+    movetext = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith('['):
+            if movetext:
+                yield _parsed_game(tags, movetext)
+                tags, movetext = {}, []
+            match = _TAG.match(line)
+            if match:
+                tags[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+        elif line and not line.startswith('%'):
+            movetext.append(line.split(';', 1)[0])
+    if tags or movetext:
+        yield _parsed_game(tags, movetext)
+
+
+def _parsed_game(tags, movetext):
+    text = _COMMENT.sub(' ', ' '.join(movetext))
+    while True:
+        text, nested = _VARIATION.subn(' ', text)
+        if not nested:
+            break
+    moves = []
+    result = tags.get('Result', '*')
+    for token in _MOVE_NUMBER.sub(' ', text).split():
+        if token in RESULTS:
+            result = token
+        elif not token.startswith('$'):
+            moves.append(token)
+    return tags, moves, result
+
+
+def starting_position(board):
+    """A copy of the board with every move taken back, and the moves that were played"""
+    start = board.copy()
+    moves = start.history()
+    for _ in moves:
+        start.pop()
+    return start, moves
+
+
+def san_history(board):
+    """SAN for every move played on the board, replayed from its starting position"""
+    replay, moves = starting_position(board)
+    sans = []
+    for move in moves:
+        sans.append(move_san(replay, move))
+        replay.push(move)
+    return sans
+
+
+def game_result(game):
+    if not game['game_over']:
+        return '*'
+    return {'white': '1-0', 'black': '0-1'}.get(game['winner'], '1/2-1/2')
+
+
+def _termination(game):
+    if not game['game_over']:
+        return 'unterminated'
+    if game['winner'] is not None and game['clock'].remaining_ms()[
+            'black' if game['winner'] == 'white' else 'white'] == 0:
+        return 'time forfeit'
+    return 'normal'
+
+
+def _movetext(board, result, width=79):
+    """Numbered SAN moves and the result, wrapped at width columns"""
+    tokens = []
+    number = 1
+    black_first = board.turn == ('white' if board.ply % 2 else 'black')
+    for index, san in enumerate(san_history(board)):
+        if index == 0 and black_first:
+            tokens.append(f'{number}...')
+        white_to_move = (index % 2 == 0) != black_first
+        if white_to_move:
+            tokens.append(f'{number}.')
+        tokens.append(san)
+        if not white_to_move:
+            number += 1
+    tokens.append(result)
+    lines = []
+    line = ''
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > width:
+            lines.append(line)
+            line = token
+        else:
+            line = f'{line} {token}' if line else token
+    lines.append(line)
+    return '\n'.join(lines)
+
+
+def game_pgn(game_code, game, site='?'):
+    """The game as PGN text: the seven tag roster, a few extra tags and the moves"""
+    result = game_result(game)
+    clock = game['clock']
+    time_control = f"{clock.initial_ms // 1000}+{clock.increment_ms // 1000}"
+    if clock.delay_ms:
+        time_control += f' delay {clock.delay_ms // 1000}'
+    tags = [
+        ('Event', 'Online chess game'),
+        ('Site', site),
+        ('Date', time.strftime('%Y.%m.%d', time.gmtime(game['last_activity']))),
+        ('Round', '-'),
+        ('White', '?'),
+        ('Black', '?'),
+        ('Result', result),
+        ('GameCode', game_code),
+        ('TimeControl', time_control),
+        ('Termination', _termination(game)),
+    ]
+    start_fen = starting_position(game['board'])[0].to_fen()
+    if start_fen.split()[:3] != START_FEN.split()[:3]:
+        tags += [('SetUp', '1'), ('FEN', start_fen)]
+    header = '\n'.join(f'[{name} "{value}"]' for name, value in tags)
+    return f'{header}\n\n{_movetext(game["board"], result)}\n\n'
+
+
+def export_pgn(games):
+    """PGN text for each (game_code, game) pair, one game at a time"""
+    for game_code, game in games:
+        yield game_pgn(game_code, game)
+
+
+def rotating_writer(directory, max_bytes):
+    """Generator that appends each PGN text sent to it to the current archive file.
+
+    A new file is started once the current one would grow past max_bytes.
+    Close the generator to close the file.
+    """
+    archive_file = None
+    try:
+        while True:
+            data = (yield).encode()
+            if archive_file is None or (archive_file.tell() and archive_file.tell() + len(data) > max_bytes):
+                if archive_file is not None:
+                    archive_file.close()
+                path = os.path.join(directory, f'games-{time.time_ns()}.pgn')
+                archive_file = open(path, 'ab')
+            archive_file.write(data)
+            archive_file.flush()
+    finally:
+        if archive_file is not None:
+            archive_file.close()
+
+
+class PgnArchive:
+    """Finished games appended to rotating PGN files in a directory"""
+
+    def __init__(self, directory, max_bytes=PGN_ARCHIVE_MAX_BYTES):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._writer = rotating_writer(directory, max_bytes)
+        next(self._writer)
+        self._lock = threading.Lock()
+        self.archived = 0
+
+    def append(self, game_code, game):
+        pgn = game_pgn(game_code, game)
+        with self._lock:
+            self._writer.send(pgn)
+            self.archived += 1
+
+    def close(self):
+        with self._lock:
+            self._writer.close()
+
+    def files(self):
+        """Archive files, oldest first"""
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith('games-') and name.endswith('.pgn'))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def stream(self, chunk_size=STREAM_CHUNK):
+        """The whole archive as a sequence of byte chunks, without loading any file whole"""
+        for path in self.files():
+            with open(path, 'rb') as archive_file:
+                while True:
+                    chunk = archive_file.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
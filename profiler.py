@@ -0,0 +1,161 @@
+"""Opt-in profiling of a sample of handler calls, written as folded stacks.
+
+A sampled call runs under a sys.setprofile hook that adds the time spent
+in each function to its whole call stack. Dumps are in the folded format
+flamegraph.pl and speedscope read, one stack per line with microseconds:
+
+    make_move;handle_make_move (app.py:571);make_move (online_chess_board.py:240) 1234
+
+Tracing slows a sampled call several times over, small functions most, so
+the output shows where time goes rather than how long calls take. One
+call is traced at a time; calls arriving meanwhile run untraced. With the
+percentage at 0 a wrapped call costs one attribute check.
+
+Under eventlet all green threads share the OS thread the hook is set on.
+Only events from the sampled call's own greenlet are counted, and the
+time it spends switched out, waiting on I/O or a sleep, is left out.
+
+    PROFILE_PERCENT  percentage of wrapped calls to profile from startup (0)
+    PROFILE_DIR      directory dumps are written to (profiles); a dump is
+                     also written at exit if anything was collected
+"""
+import atexit
+import functools
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+try:
+    from greenlet import getcurrent
+except ImportError:
+    getcurrent = None
+
+PROFILE_PERCENT = float(os.environ.get('PROFILE_PERCENT', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+
+class SamplingProfiler:
+    """Traces percent% of the calls to functions wrapped with sampled()"""
+
+    def __init__(self, percent=PROFILE_PERCENT, directory=PROFILE_DIR):
+        self.percent = 0.0
+        self.directory = directory
+        self.sampled_calls = 0
+        self.dumps = 0
+        self._folded = defaultdict(float)  # ';'-joined stack -> seconds
+        self._names = {}  # code object -> frame name
+        self._tracing = threading.Lock()
+        self._lock = threading.Lock()
+        self._exit_dump = False
+        self.set_percent(percent)
+
+    def set_percent(self, percent):
+        """Profile this percentage of calls from now on; 0 turns profiling off"""
+        percent = min(100.0, max(0.0, float(percent)))
+        if percent and not self._exit_dump:
+            atexit.register(self.dump)
+            self._exit_dump = True
+        self.percent = percent
+
+    def sampled(self, label):
+        """Decorator tracing the sampled share of calls under a root frame named label"""
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if self.percent and random.random() * 100 < self.percent and self._tracing.acquire(False):
+                    try:
+                        return self._trace(label, function, args, kwargs)
+                    finally:
+                        self._tracing.release()
+                return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def _name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            name = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            self._names[code] = name
+        return name
+
+    def _trace(self, label, function, args, kwargs):
+        folded = defaultdict(float)
+        stack = [label]
+        starts = [time.perf_counter()]
+        children = [0.0]  # seconds spent in callees, per frame on the stack
+        current = getcurrent() if getcurrent is not None else None
+        away = [None]  # when another greenlet started running, while it does
+
+        def hook(frame, event, arg):
+            now = time.perf_counter()
+            if current is not None and getcurrent() is not current:
+                if away[0] is None:
+                    away[0] = now
+                return
+            if away[0] is not None:
+                # Back from another greenlet: leave the time away out of every frame
+                paused = now - away[0]
+                starts[:] = [start + paused for start in starts]
+                away[0] = None
+            if event == 'call' or event == 'c_call':
+                stack.append(self._name(frame.f_code) if event == 'call'
+                             else getattr(arg, '__qualname__', None) or repr(arg))
+                starts.append(now)
+                children.append(0.0)
+            elif len(stack) > 1:
+                # return, c_return or c_exception
+                elapsed = now - starts.pop()
+                folded[';'.join(stack)] += elapsed - children.pop()
+                stack.pop()
+                children[-1] += elapsed
+
+        sys.setprofile(hook)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            sys.setprofile(None)
+            folded[label] += time.perf_counter() - starts[0] - children[0]
+            with self._lock:
+                for key, seconds in folded.items():
+                    self._folded[key] += seconds
+                self.sampled_calls += 1
+
+    def folded_lines(self):
+        """Collected stacks as 'frame;frame;... microseconds' lines, heaviest first"""
+        with self._lock:
+            items = sorted(self._folded.items(), key=lambda item: -item[1])
+        return [f'{stack} {round(seconds * 1e6)}' for stack, seconds in items if seconds >= 5e-7]
+
+    def dump(self, path=None):
+        """Write the collected stacks to path (default: a new file in the directory) and start over.
+
+        Returns the path, or None if nothing was collected.
+        """
+        lines = self.folded_lines()
+        if not lines:
+            return None
+        if path is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'profile-{time.time_ns()}.folded')
+        with open(path, 'w') as output:
+            output.write('\n'.join(lines) + '\n')
+        self.reset()
+        self.dumps += 1
+        return path
+
+    def reset(self):
+        with self._lock:
+            self._folded.clear()
+            self.sampled_calls = 0
+
+    def stats(self):
+        return {
+            'percent': self.percent,
+            'sampled_calls': self.sampled_calls,
+            'stacks': len(self._folded),
+            'dumps': self.dumps,
+            'directory': self.directory,
+        }
@@ -0,0 +1,265 @@
+"""Snapshots of every game in a GameRegistry, for restarts that keep games.
+
+A snapshot file is a header, each game in the game_store encoding (board
+buffer and move list, clock, players, last broadcast), and then an index
+of fixed-size entries sorted by code:
+
+    header   magic(8) count(u32) index_offset(u64)
+    entry    code(8) offset(u64) length(u32) last_activity(f64) phase(u8) pad(3)
+
+On startup the file is memory-mapped and the index is binary-searched in
+place. Nothing is decoded until a game's code is first used, so a restart
+serves traffic right away however many games were saved.
+
+    SNAPSHOT_PATH      file to restore from and write to (unset: no snapshots)
+    SNAPSHOT_INTERVAL  seconds between snapshots (60); one is also written at exit
+"""
+import atexit
+import mmap
+import os
+import struct
+import threading
+import time
+import traceback
+
+from game_eviction import PHASES, game_phase
+from game_store import decode_game, encode_game
+from offload import offload
+
+MAGIC = b'CHSNAP01'
+_HEADER = struct.Struct('<8sIQ')
+_INDEX_ENTRY = struct.Struct('<8sQIdB3x')
+CODE_SIZE = 8
+
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH')
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', 60))
+
+
+def _code_key(code):
+    key = code.encode()
+    if len(key) > CODE_SIZE:
+        return None
+    return key.ljust(CODE_SIZE, b'\0')
+
+
+class SnapshotReader:
+    """A memory-mapped snapshot whose games are decoded one at a time as they are taken.
+
+    Serves as a GameRegistry fallback.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self._index_offset = _HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a game snapshot')
+        self._taken = set()
+        self._lock = threading.Lock()
+
+    def _find(self, code):
+        """Binary search the index for a code; returns its entry fields or None"""
+        key = _code_key(code)
+        if key is None:
+            return None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry = _INDEX_ENTRY.unpack_from(self._map, self._index_offset + middle * _INDEX_ENTRY.size)
+            if entry[0] < key:
+                low = middle + 1
+            elif entry[0] > key:
+                high = middle
+            else:
+                return entry[1:]
+        return None
+
+    def __contains__(self, code):
+        with self._lock:
+            return code not in self._taken and self._find(code) is not None
+
+    def __len__(self):
+        return self.count - len(self._taken)
+
+    def take(self, code):
+        """Decode and return a saved game once; later calls for the same code return None"""
+        with self._lock:
+            if code in self._taken:
+                return None
+            entry = self._find(code)
+            if entry is None:
+                return None
+            self._taken.add(code)
+            offset, length = entry[0], entry[1]
+            data = self._map[offset:offset + length]
+        # Server downtime is not charged to the side to move
+        game = decode_game(data, charge_since_saved=False)
+        # Connections do not survive a restart; players rejoin with get_game_state
+        for player in game['players'].values():
+            player['sid'] = None
+        return game
+
+    def pending(self, pause=None):
+        """(code, encoded game, last_activity, phase name) for every game not taken yet.
+
+        pause(), if given, is called every 1000 games with the lock released.
+        A game taken meanwhile may then be listed too, and is also in memory.
+        """
+        pending = []
+        for first in range(0, self.count, 1000):
+            with self._lock:
+                for index in range(first, min(first + 1000, self.count)):
+                    key, offset, length, last_activity, phase = _INDEX_ENTRY.unpack_from(
+                        self._map, self._index_offset + index * _INDEX_ENTRY.size)
+                    code = key.rstrip(b'\0').decode()
+                    if code not in self._taken:
+                        pending.append((code, self._map[offset:offset + length], last_activity, PHASES[phase]))
+            if pause is not None:
+                pause()
+        return pending
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def open_snapshot(path):
+    """SnapshotReader for path, or None if no snapshot has been written there yet"""
+    if not os.path.exists(path):
+        return None
+    return SnapshotReader(path)
+
+
+def write_snapshot(path, games, previous=None, ttls=None, pause=None):
+    """Write every game in the registry to path, atomically; returns the number written.
+
+    Games in previous (a SnapshotReader) that were never loaded are copied
+    over without decoding, except those already past their phase TTL when
+    ttls is given. pause(), if given, is called every 100 games in memory
+    and every 1000 carried over, so a background writer lets handlers run.
+    The file itself is written through offload().
+    """
+    # Read the old snapshot's leftovers first: a game taken after this
+    # point is then in memory and is written from there instead
+    carried = previous.pending(pause) if previous is not None else []
+    records = []
+    written = set()
+    for code, _ in games.items():
+        with games.locked(code) as game:
+            if game is None:
+                continue
+            records.append((code, encode_game(game), game['last_activity'], game_phase(game)))
+        written.add(code)
+        if pause is not None and len(written) % 100 == 0:
+            pause()
+    now = time.time()
+    for code, data, last_activity, phase in carried:
+        if code in written or (ttls and now - last_activity > ttls[phase]):
+            continue
+        records.append((code, data, last_activity, phase))
+    # Megabytes of writes and an fsync: off the event loop under eventlet
+    return offload(_write_file, path, records)
+
+
+def _write_file(path, records):
+    """Write (code, encoded game, last_activity, phase) records and their index to path; returns the count"""
+    entries = []
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(_HEADER.pack(MAGIC, 0, 0))
+        offset = _HEADER.size
+        for code, data, last_activity, phase in records:
+            key = _code_key(code)
+            if key is None:
+                continue
+            out.write(data)
+            entries.append((key, offset, len(data), last_activity, PHASES.index(phase)))
+            offset += len(data)
+
+        entries.sort()
+        for entry in entries:
+            out.write(_INDEX_ENTRY.pack(*entry))
+        out.seek(0)
+        out.write(_HEADER.pack(MAGIC, len(entries), offset))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
+    return len(entries)
+
+
+class Snapshotter:
+    """Restores a GameRegistry from its snapshot and keeps the snapshot current"""
+
+    def __init__(self, socketio, games, path, interval=SNAPSHOT_INTERVAL, ttls=None, on_load=None,
+                 journal=None):
+        self.socketio = socketio
+        # A MoveJournal whose older segments each snapshot makes redundant
+        self.journal = journal
+        self.games = games
+        self.path = path
+        self.interval = interval
+        self.ttls = ttls
+        self.on_load = on_load
+        self.restored = 0
+        self.restore_ms = None
+        self.last_count = None
+        self.last_write_ms = None
+        self.last_written_at = None
+        self._write_lock = threading.Lock()
+
+    def restore(self):
+        """Map the existing snapshot, if any, behind the registry.
+
+        on_load isn't installed until start(), so games loaded while the
+        journal is replayed aren't re-armed on their pre-replay position.
+        """
+        start = time.perf_counter()
+        reader = open_snapshot(self.path)
+        if reader is not None:
+            self.games.fallback = reader
+            self.restored = reader.count
+        self.restore_ms = (time.perf_counter() - start) * 1000
+
+    def start(self):
+        """Run on_load for games loaded from now on and write snapshots.
+
+        Call restore() first to keep the games in the last snapshot, and
+        recover the journal before calling this.
+        """
+        if self.games.fallback is not None:
+            self.games.on_load = self.on_load
+        atexit.register(self.write)
+        if self.interval > 0:
+            self.socketio.start_background_task(self._run)
+
+    def write(self, pause=None):
+        with self._write_lock:
+            start = time.perf_counter()
+            # Records from before the rotation are all in games written below
+            segment = self.journal.rotate() if self.journal is not None else None
+            self.last_count = write_snapshot(self.path, self.games, self.games.fallback, self.ttls, pause)
+            if segment is not None:
+                self.journal.discard_before(segment)
+            self.last_write_ms = (time.perf_counter() - start) * 1000
+            self.last_written_at = time.time()
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            try:
+                self.write(pause=lambda: self.socketio.sleep(0))
+            except Exception:
+                traceback.print_exc()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'restored_games': self.restored,
+            'restore_ms': self.restore_ms,
+            'not_yet_loaded': len(self.games.fallback) if self.games.fallback is not None else 0,
+            'last_snapshot_games': self.last_count,
+            'last_snapshot_ms': self.last_write_ms,
+            'last_snapshot_at': self.last_written_at,
+        }
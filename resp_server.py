@@ -0,0 +1,319 @@
+"""Local stand-in for a Redis server, covering the commands RedisGameStore uses.
+
+Speaks RESP2 over TCP and keeps everything in memory. It is meant for
+development and for checking the Redis game store without a real server:
+
+    python resp_server.py --port 6379
+    GAME_STORE_URL=redis://localhost:6379 python app.py
+
+    python resp_server.py --check
+
+--check starts a server on a free port. It plays games through a
+RedisGameStore from several threads and compares them with the same games
+in memory.
+"""
+import argparse
+import fnmatch
+import random
+import socketserver
+import sys
+import threading
+import time
+
+from game_clock import GameClock
+from game_store import DELETE_SCRIPT, RELEASE_SCRIPT, SAVE_SCRIPT, LockLost, RedisGameStore, RespClient
+from online_chess_board import OnlineChessBoard
+
+
+class _Reply:
+    """Pre-encoded reply bytes"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+OK = _Reply(b'+OK\r\n')
+PONG = _Reply(b'+PONG\r\n')
+
+
+def encode_reply(value):
+    if isinstance(value, _Reply):
+        return value.data
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, Exception):
+        return b'-ERR %s\r\n' % str(value).encode()
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(encode_reply(item) for item in value)
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class MemoryKeyspace:
+    """Keys with optional millisecond expiry, guarded by one lock"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def _live(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            del self.expires[key]
+            self.data.pop(key, None)
+        return key in self.data
+
+    def execute(self, args):
+        name = args[0].upper().decode()
+        handler = getattr(self, 'cmd_' + name.lower(), None)
+        if handler is None:
+            return ValueError(f"unknown command '{name}'")
+        with self.lock:
+            try:
+                return handler(*args[1:])
+            except (TypeError, ValueError, IndexError) as exc:
+                return ValueError(f'bad arguments for {name}: {exc}')
+
+    def cmd_ping(self, *args):
+        return PONG
+
+    def cmd_select(self, db):
+        return OK
+
+    def cmd_auth(self, *args):
+        return OK
+
+    def cmd_get(self, key):
+        return self.data[key] if self._live(key) else None
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        exists = self._live(key)
+        if b'NX' in options and exists or b'XX' in options and not exists:
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        for unit, scale in ((b'PX', 0.001), (b'EX', 1.0)):
+            if unit in options:
+                self.expires[key] = time.monotonic() + int(options[options.index(unit) + 1]) * scale
+        return OK
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._live(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._live(key))
+
+    def cmd_scan(self, cursor, *options):
+        options = list(options)
+        pattern = None
+        for index, option in enumerate(options):
+            if option.upper() == b'MATCH':
+                pattern = options[index + 1].decode()
+        keys = [key for key in list(self.data) if self._live(key)
+                and (pattern is None or fnmatch.fnmatchcase(key.decode(), pattern))]
+        # Everything in one pass; the cursor is always finished
+        return [b'0', keys]
+
+    def cmd_eval(self, script, numkeys, *rest):
+        """Only the RedisGameStore lock scripts, recognised by their text"""
+        numkeys = int(numkeys)
+        keys, args = rest[:numkeys], rest[numkeys:]
+        held = self.cmd_get(keys[0]) == args[0]
+        if script == RELEASE_SCRIPT.encode():
+            return self.cmd_del(keys[0]) if held else 0
+        if script == SAVE_SCRIPT.encode():
+            return int(held and self.cmd_set(keys[1], args[1], b'XX') is not None)
+        if script == DELETE_SCRIPT.encode():
+            return self.cmd_del(keys[1]) if held else -1
+        raise ValueError('only the RedisGameStore scripts are supported')
+
+    def cmd_flushdb(self, *args):
+        self.data.clear()
+        self.expires.clear()
+        return OK
+
+
+def read_command(reader):
+    line = reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        # Inline command, as typed into telnet
+        return line.split()
+    args = []
+    for _ in range(int(line[1:])):
+        size = int(reader.readline()[1:])
+        args.append(reader.read(size + 2)[:-2])
+    return args
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        keyspace = self.server.keyspace
+        while True:
+            args = read_command(self.rfile)
+            if args is None:
+                return
+            if not args:
+                continue
+            self.wfile.write(encode_reply(keyspace.execute(args)))
+
+
+class RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, RespHandler)
+        self.keyspace = MemoryKeyspace()
+
+
+def _new_game(timer):
+    return {
+        'board': OnlineChessBoard(),
+        'players': {},
+        'current_player': 'white',
+        'game_started': True,
+        'game_over': False,
+        'winner': None,
+        'last_activity': time.time(),
+        'timer': timer,
+        'clock': GameClock(timer * 1000, increment_ms=2000),
+        'seq': 0,
+        'last_state': None
+    }
+
+
+def _play(game, code, seed):
+    """One move chosen from the game's code and ply, so any thread picks the same one"""
+    board = game['board']
+    color = game['current_player']
+    moves = board.get_all_valid_moves(color)
+    if not moves:
+        game['game_over'] = True
+        game['clock'].stop()
+        return
+    (from_row, from_col), (to_row, to_col) = random.Random(f'{seed}:{code}:{game["seq"]}').choice(moves)
+    board.make_move(from_row, from_col, to_row, to_col)
+    game['current_player'] = 'black' if color == 'white' else 'white'
+    if game['clock'].running is None:
+        game['clock'].start(color)
+    game['clock'].press()
+    game['seq'] += 1
+    game['last_state'] = {
+        'board_state': board.get_board_state()['board'],
+        'current_player': game['current_player'],
+        'captured': board.get_board_state()['captured'],
+        'legal_moves': [[fr, fc, tr, tc] for (fr, fc), (tr, tc)
+                        in board.get_all_valid_moves(game['current_player'])],
+    }
+
+
+def check(games, threads, plies, seed):
+    """Play games through a RedisGameStore on a stand-in server; return a list of errors"""
+    server = RespServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    store = RedisGameStore(RespClient('127.0.0.1', server.server_address[1]))
+    codes = [store.create(lambda: f'{random.getrandbits(32):08X}', _new_game(300)) for _ in range(games)]
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        for _ in range(games * plies // threads):
+            code = rng.choice(codes)
+            with store.locked(code) as game:
+                if game['seq'] < plies and not game['game_over']:
+                    _play(game, code, seed)
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    errors = []
+    played = 0
+    for code in codes:
+        stored = store.get(code)
+        reference = _new_game(300)
+        while reference['seq'] < stored['seq']:
+            _play(reference, code, seed)
+        if stored['game_over']:
+            # Mated or stalemated: the last visit found no moves and stopped the clock
+            _play(reference, code, seed)
+        played += stored['seq']
+        board, expected = stored['board'], reference['board']
+        if board.squares != expected.squares or list(board._stack) != list(expected._stack):
+            errors.append(f'{code}: board differs from a replay of its moves')
+        if board.captured != expected.captured or board.zobrist_key != expected.zobrist_key:
+            errors.append(f'{code}: captured pieces or hash differ')
+        if stored['last_state'] != reference['last_state']:
+            errors.append(f'{code}: last broadcast state did not round-trip')
+        if stored['clock'].running != reference['clock'].running:
+            errors.append(f'{code}: clock is running for the wrong side')
+    if len(store) != games:
+        errors.append(f'store holds {len(store)} games, expected {games}')
+
+    # A block that outlives its lock must fail rather than save over the next holder
+    short = RedisGameStore(store.client, lock_ttl_ms=20)
+    try:
+        with short.locked(codes[1]) as stale:
+            time.sleep(0.05)
+            with store.locked(codes[1]) as game:
+                game['winner'] = 'next holder'
+            stale['winner'] = 'expired holder'
+        errors.append('a block that outlived its lock was saved')
+    except LockLost:
+        pass
+    if store.get(codes[1])['winner'] != 'next holder':
+        errors.append("an expired lock's release or save clobbered the next holder")
+    store.remove(codes[0])
+    if codes[0] in store or len(store) != games - 1:
+        errors.append('remove() did not delete the game')
+    server.shutdown()
+    print(f'{games} games, {played} moves through the store on {threads} threads in {elapsed:.1f}s '
+          f'({played / elapsed:.0f} moves/s)')
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--check', action='store_true', help='run the RedisGameStore check and exit')
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--plies', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.check:
+        errors = check(args.games, args.threads, args.plies, args.seed)
+        for error in errors[:20]:
+            print(error)
+        if errors:
+            print(f'{len(errors)} errors')
+            return 1
+        print('store round trip ok')
+        return 0
+    server = RespServer((args.host, args.port))
+    print(f'listening on {args.host}:{server.server_address[1]}')
+    server.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Reference sticky router for running several app.py workers behind one address.
+
+Each connection is sent to one worker:
+- by the game code in a /game/<code> path or a game_code= query parameter
+  (game pages pass it when opening their Socket.IO connection), using
+  game_routing.worker_for_code();
+- otherwise by a hash of the client address, so a page's polling requests
+  keep reaching the same worker.
+
+Plain HTTP requests are forwarded with "Connection: close", so a browser
+cannot reuse one connection for requests meant for different workers.
+WebSocket upgrades are piped as-is for as long as they stay open.
+
+    WORKER_COUNT=2 WORKER_ID=0 python app.py          # on port 5000
+    WORKER_COUNT=2 WORKER_ID=1 python app.py          # on port 5001
+    python router.py --port 8000 127.0.0.1:5000 127.0.0.1:5001
+
+The workers need the same WORKER_COUNT, and backends are listed in
+WORKER_ID order. This is a development and reference tool; production
+setups can apply the same rule in nginx or HAProxy (route on the first
+character of the game code).
+"""
+import argparse
+import re
+import socket
+import socketserver
+import sys
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+from game_routing import worker_for_client, worker_for_code
+
+MAX_HEAD = 65536
+_GAME_PATH = re.compile(r'^/game/([A-Za-z0-9]+)')
+_CONNECTION_HEADER = re.compile(rb'^connection:.*\r\n', re.IGNORECASE | re.MULTILINE)
+
+
+def route(target, client_address, backend_count):
+    """Index of the backend for a request target such as /game/AB12CD or /socket.io/?game_code=..."""
+    parts = urlsplit(target)
+    match = _GAME_PATH.match(parts.path)
+    if match:
+        return worker_for_code(match.group(1), backend_count)
+    codes = parse_qs(parts.query).get('game_code')
+    if codes and codes[0]:
+        return worker_for_code(codes[0], backend_count)
+    return worker_for_client(client_address, backend_count)
+
+
+def read_head(sock):
+    """Read up to the end of the request headers; returns (head, any body bytes already read)"""
+    data = b''
+    while b'\r\n\r\n' not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return None, b''
+        data += chunk
+        if len(data) > MAX_HEAD:
+            return None, b''
+    head, rest = data.split(b'\r\n\r\n', 1)
+    return head + b'\r\n\r\n', rest
+
+
+def close_after_response(head):
+    """Rewrite a non-upgrade request so the connection ends with its response"""
+    if re.search(rb'^upgrade:', head, re.IGNORECASE | re.MULTILINE):
+        return head
+    head = _CONNECTION_HEADER.sub(b'', head)
+    return head[:-2] + b'Connection: close\r\n\r\n'
+
+
+def pipe(source, destination):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            destination.sendall(data)
+    except OSError:
+        pass
+    finally:
+        try:
+            destination.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class RouterHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        client = self.request
+        head, rest = read_head(client)
+        if head is None:
+            return
+        try:
+            target = head.split(b'\r\n', 1)[0].split(b' ')[1].decode('latin-1')
+        except IndexError:
+            return
+        backends = self.server.backends
+        host, port = backends[route(target, self.client_address[0], len(backends))]
+        try:
+            upstream = socket.create_connection((host, port))
+        except OSError:
+            client.sendall(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            return
+        with upstream:
+            upstream.sendall(close_after_response(head) + rest)
+            reply = threading.Thread(target=pipe, args=(upstream, client), daemon=True)
+            reply.start()
+            pipe(client, upstream)
+            reply.join()
+
+
+class Router(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, backends):
+        super().__init__(address, RouterHandler)
+        self.backends = backends
+
+
+def parse_backend(value):
+    host, _, port = value.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('backends', nargs='+', type=parse_backend,
+                        help='worker host:port addresses in WORKER_ID order')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    router = Router((args.host, args.port), args.backends)
+    print(f'routing {args.host}:{args.port} to {len(args.backends)} workers')
+    router.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""Measure how long a restart from a registry snapshot takes to serve a game.
+
+Fills a GameRegistry with games in progress, writes a snapshot, then times
+opening it behind a fresh registry and loading games by code, as the
+first move or rejoin after a restart would.
+
+    python snapshot_benchmark.py --games 100000 --path /tmp/games.snapshot
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+
+from game_clock import GameClock
+from game_registry import GameRegistry
+from memory_benchmark import play_random
+from online_chess_board import OnlineChessBoard
+from registry_snapshot import SnapshotReader, write_snapshot
+
+
+def make_game(board, color, started):
+    players = {}
+    for player_color in ('white', 'black'):
+        players[str(uuid.uuid4())] = {'sid': uuid.uuid4().hex, 'color': player_color,
+                                      'ready': True, 'last_seen': time.time()}
+    clock = GameClock(300000, increment_ms=2000)
+    clock.start(color)
+    board_state = board.get_board_state()
+    moves = board.get_all_valid_moves(color)
+    return {
+        'board': board.copy(),
+        'players': players,
+        'current_player': color,
+        'game_started': started,
+        'game_over': False,
+        'winner': None,
+        'last_activity': time.time(),
+        'timer': 300,
+        'clock': clock,
+        'seq': 7,
+        # The shape of app.game_snapshot(), which deltas are computed against
+        'last_state': {
+            'board_state': board_state['board'],
+            'white_king': board_state['white_king'],
+            'black_king': board_state['black_king'],
+            'white_in_check': board_state['white_in_check'],
+            'black_in_check': board_state['black_in_check'],
+            'current_player': color,
+            'game_over': False,
+            'winner': None,
+            'timer': 300,
+            'increment': 2.0,
+            'delay': 0.0,
+            'remaining_time': 300,
+            'remaining_ms': 300000,
+            'captured': {'white': list(board_state['captured']['white']),
+                         'black': list(board_state['captured']['black'])},
+            'material_diff': board_state['material_diff'],
+            'legal_moves': [[fr, fc, tr, tc] for (fr, fc), (tr, tc) in moves],
+        },
+    }
+
+
+def fill_registry(count, seed):
+    """A registry of count games built from a few hundred random positions"""
+    rng = random.Random(seed)
+    templates = []
+    for _ in range(min(count, 200)):
+        board = OnlineChessBoard()
+        color = play_random(board, rng.randrange(0, 60), rng)
+        templates.append(make_game(board, color, True))
+    registry = GameRegistry()
+    for index in range(count):
+        template = templates[index % len(templates)]
+        game = dict(template, board=template['board'].copy(), players={
+            player_id: dict(player) for player_id, player in template['players'].items()})
+        registry.add(f'G{index:05X}', game)
+    return registry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--path', default='games.snapshot')
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    registry = fill_registry(args.games, args.seed)
+    start = time.perf_counter()
+    written = write_snapshot(args.path, registry)
+    write_seconds = time.perf_counter() - start
+    size = os.path.getsize(args.path)
+    del registry
+    print(f'snapshot of {written} games: {size / 1e6:.1f} MB, {size / written:.0f} bytes/game, '
+          f'written in {write_seconds:.2f} s')
+
+    # Restart: map the file behind an empty registry and serve one game
+    codes = [f'G{index:05X}' for index in range(args.games)]
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    registry = GameRegistry(fallback=SnapshotReader(args.path))
+    with registry.locked(rng.choice(codes)) as game:
+        game['board'].get_all_valid_moves(game['current_player'])
+    first_ms = (time.perf_counter() - start) * 1000
+    print(f'restart to first game served: {first_ms:.2f} ms')
+
+    start = time.perf_counter()
+    for code in rng.sample(codes, args.lookups):
+        with registry.locked(code) as game:
+            assert game is not None
+    per_load = (time.perf_counter() - start) / args.lookups * 1e6
+    print(f'first use of a restored game: {per_load:.0f} us each ({args.lookups} games)')
+
+    # Rewrite with most games still unloaded, as the periodic snapshot does
+    start = time.perf_counter()
+    written = write_snapshot(args.path, registry, previous=registry.fallback)
+    print(f'next snapshot ({len(registry)} loaded, {len(registry.fallback)} carried over): '
+          f'{time.perf_counter() - start:.2f} s')
+    registry.fallback.close()
+    os.remove(args.path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""Concurrency stress test for GameRegistry.
+
+Many threads play thousands of games at once through registry.locked(),
+the way the Socket.IO handlers do. Other threads race them by ending games
+on time and by removing finished games. At the end every game must have
+ended exactly once, been removed exactly once, and hold a board identical
+to a single-threaded replay of its recorded moves.
+
+    python stress_registry.py --games 2000 --threads 16
+"""
+import argparse
+import random
+import sys
+import threading
+import time
+
+from game_registry import GameRegistry
+from online_chess_board import OnlineChessBoard
+
+
+def new_game(seed):
+    return {
+        'board': OnlineChessBoard(),
+        'current_player': 'white',
+        'game_over': False,
+        'winner': None,
+        'moves': [],
+        'endings': [],
+        'illegal_moves': 0,
+        'rng': random.Random(seed),
+    }
+
+
+def end_game(game, reason, winner):
+    game['game_over'] = True
+    game['winner'] = winner
+    game['endings'].append(reason)
+
+
+def play_one(registry, code, max_plies):
+    """One move, chosen by the game's own generator, under the game's lock"""
+    with registry.locked(code) as game:
+        if game is None or game['game_over']:
+            return False
+        board = game['board']
+        color = game['current_player']
+        moves = board.get_all_valid_moves(color)
+        if not moves or len(game['moves']) >= max_plies:
+            end_game(game, 'no moves' if moves == [] else 'ply limit', None)
+            return False
+        (from_row, from_col), (to_row, to_col) = game['rng'].choice(moves)
+        if not board.make_move(from_row, from_col, to_row, to_col):
+            # Only possible if another thread changed the board under us
+            game['illegal_moves'] += 1
+            return False
+        game['moves'].append(((from_row, from_col), (to_row, to_col)))
+        game['current_player'] = 'black' if color == 'white' else 'white'
+        if board.is_checkmate(game['current_player']):
+            end_game(game, 'checkmate', color)
+        elif board.is_stalemate(game['current_player']):
+            end_game(game, 'stalemate', None)
+        return True
+
+
+def flag_one(registry, code):
+    """End a game on time, racing the movers"""
+    with registry.locked(code) as game:
+        if game is None or game['game_over']:
+            return False
+        turn = game['current_player']
+        end_game(game, 'time', 'black' if turn == 'white' else 'white')
+        return True
+
+
+def run(games, threads, flaggers, max_plies, flag_rate, seed):
+    registry = GameRegistry()
+    codes = []
+    for index in range(games):
+        code = f'G{index:05d}'
+        assert registry.add(code, new_game(seed * 1000003 + index))
+        codes.append(code)
+    # Finished games are removed; keep references for the checks
+    all_games = dict(registry.items())
+    removed = {}
+    removed_lock = threading.Lock()
+    moves_played = [0] * threads
+    stop = threading.Event()
+
+    def mover(worker):
+        rng = random.Random(seed + worker)
+        while not stop.is_set():
+            if play_one(registry, rng.choice(codes), max_plies):
+                moves_played[worker] += 1
+
+    def flagger(worker):
+        rng = random.Random(-seed - worker - 1)
+        while not stop.is_set():
+            if rng.random() < flag_rate:
+                flag_one(registry, rng.choice(codes))
+            else:
+                time.sleep(0)
+
+    def cleaner():
+        while not stop.is_set():
+            for code, _ in registry.items():
+                game = registry.remove_if(code, lambda game: game['game_over'])
+                if game is not None:
+                    with removed_lock:
+                        removed[code] = removed.get(code, 0) + 1
+            time.sleep(0.001)
+
+    workers = [threading.Thread(target=mover, args=(worker,)) for worker in range(threads)]
+    workers += [threading.Thread(target=flagger, args=(worker,)) for worker in range(flaggers)]
+    workers.append(threading.Thread(target=cleaner))
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    while len(removed) < games and time.perf_counter() - start < 600:
+        time.sleep(0.01)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    errors = []
+    for code, game in all_games.items():
+        if len(game['endings']) != 1:
+            errors.append(f'{code}: ended {len(game["endings"])} times {game["endings"]}')
+        if game['illegal_moves']:
+            errors.append(f'{code}: {game["illegal_moves"]} generated moves were illegal when played')
+        if removed.get(code) != 1:
+            errors.append(f'{code}: removed {removed.get(code, 0)} times')
+        replay = OnlineChessBoard()
+        for (from_row, from_col), (to_row, to_col) in game['moves']:
+            if not replay.make_move(from_row, from_col, to_row, to_col):
+                errors.append(f'{code}: recorded move is illegal on replay')
+                break
+        if replay.squares != game['board'].squares or replay.zobrist_key != game['board'].zobrist_key:
+            errors.append(f'{code}: board differs from the replay of its moves')
+    endings = {}
+    for game in all_games.values():
+        for reason in game['endings']:
+            endings[reason] = endings.get(reason, 0) + 1
+    return errors, sum(moves_played), elapsed, endings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--flaggers', type=int, default=2)
+    parser.add_argument('--max-plies', type=int, default=60)
+    parser.add_argument('--flag-rate', type=float, default=0.01,
+                        help='chance per flagger step of ending a random game on time')
+    parser.add_argument('--switch-interval', type=float, default=1e-5,
+                        help='sys.setswitchinterval value; small values force more interleaving')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    sys.setswitchinterval(args.switch_interval)
+    errors, moves, elapsed, endings = run(args.games, args.threads, args.flaggers,
+                                          args.max_plies, args.flag_rate, args.seed)
+    print(f'{args.games} games, {moves} moves on {args.threads} threads in {elapsed:.1f}s '
+          f'({moves / elapsed:.0f} moves/s)')
+    print('endings: ' + ', '.join(f'{reason} {count}' for reason, count in sorted(endings.items())))
+    for error in errors[:20]:
+        print(error)
+    if errors:
+        print(f'{len(errors)} errors')
+        return 1
+    print('no races detected')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
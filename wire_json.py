@@ -0,0 +1,62 @@
+"""JSON module for Socket.IO packets that can splice in pre-encoded JSON.
+
+Passed to SocketIO(json=...). Values wrapped in RawJSON, at the top level of
+an event payload, are written out verbatim instead of being encoded again,
+so a board whose JSON is cached costs only a string copy per emit.
+"""
+import json
+
+loads = json.loads
+
+_PLACEHOLDER = '\x00raw:'
+
+
+class RawJSON:
+    """Already-encoded JSON text to insert as-is"""
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+def _swap_raw(value, raw, depth):
+    if isinstance(value, RawJSON):
+        raw.append(value.text)
+        return f'{_PLACEHOLDER}{len(raw) - 1}'
+    if depth == 0:
+        return value
+    if isinstance(value, dict):
+        return {key: _swap_raw(item, raw, depth - 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_swap_raw(item, raw, depth - 1) for item in value]
+    return value
+
+
+def dumps(obj, **kwargs):
+    # A Socket.IO packet is [event, payload], so look two levels deep
+    raw = []
+    obj = _swap_raw(obj, raw, 2)
+    text = json.dumps(obj, **kwargs)
+    for index, value in enumerate(raw):
+        text = text.replace(json.dumps(f'{_PLACEHOLDER}{index}'), value, 1)
+    return text
+
+
+def _swap_binary(value, attachments, depth):
+    if isinstance(value, (bytes, bytearray)):
+        attachments.append(len(value))
+        return {'_placeholder': True, 'num': len(attachments) - 1}
+    if depth == 0:
+        return value
+    if isinstance(value, dict):
+        return {key: _swap_binary(item, attachments, depth - 1) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_swap_binary(item, attachments, depth - 1) for item in value]
+    return value
+
+
+def encoded_size(obj):
+    """Bytes a Socket.IO packet carrying obj takes: its JSON text plus any binary attachments"""
+    attachments = []
+    obj = _swap_binary(obj, attachments, 2)
+    return len(dumps(obj, separators=(',', ':')).encode()) + sum(attachments)
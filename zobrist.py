@@ -0,0 +1,50 @@
+"""Zobrist keys for OnlineChessBoard positions.
+
+Keys come from a fixed seed so every process agrees on them, which lets
+hashes be shared between workers and stored alongside saved games.
+"""
+import random
+
+from bitboard import BLACK, KING, ROOK, WHITE, piece_code
+
+_rng = random.Random(0x5EED)
+
+# PIECE_KEYS[color * 6 + piece_type][square], matching the bitboard layout
+PIECE_KEYS = [[_rng.getrandbits(64) for _ in range(64)] for _ in range(12)]
+BLACK_TO_MOVE_KEY = _rng.getrandbits(64)
+_CASTLING_RIGHT_KEYS = [_rng.getrandbits(64) for _ in range(4)]
+
+# (king square, rook square, color) for each castling right, in bit order
+CASTLING_SQUARES = [
+    (60, 63, WHITE),
+    (60, 56, WHITE),
+    (4, 7, BLACK),
+    (4, 0, BLACK),
+]
+
+
+def _castling_key(rights):
+    key = 0
+    for bit, right_key in enumerate(_CASTLING_RIGHT_KEYS):
+        if rights >> bit & 1:
+            key ^= right_key
+    return key
+
+
+# CASTLING_KEYS[rights] for every 4-bit combination of castling rights
+CASTLING_KEYS = [_castling_key(rights) for rights in range(16)]
+
+
+def castling_rights(squares, moved):
+    """Castling rights as a 4-bit mask, from unmoved kings and rooks on their home squares.
+    
+    squares holds a piece code per square and moved is a bitboard of squares
+    whose piece has moved, as kept by OnlineChessBoard.
+    """
+    rights = 0
+    for bit, (king_sq, rook_sq, color) in enumerate(CASTLING_SQUARES):
+        if (squares[king_sq] == piece_code(color, KING) and
+                squares[rook_sq] == piece_code(color, ROOK) and
+                not (moved >> king_sq) & 1 and not (moved >> rook_sq) & 1):
+            rights |= 1 << bit
+    return rights